@@ -0,0 +1,106 @@
+"""
+Модуль для асинхронных HTTP-запросов (aiohttp).
+Хранит общий цикл событий в фоновом потоке и пул соединений (keep-alive) для каждого цикла событий.
+Синхронные классы (DodoISParser, YandexDisk, Bot) выполняют свои корутины через run_sync,
+поэтому все запросы процесса проходят через один цикл событий и один пул соединений.
+"""
+
+import asyncio
+import atexit
+import threading
+import weakref
+from concurrent.futures import Future
+from typing import Awaitable, Dict, Optional
+
+import aiohttp
+
+import config
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+# пул соединений для каждого цикла событий
+_connectors: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.TCPConnector]' = \
+    weakref.WeakKeyDictionary()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Возвращает общий цикл событий, при первом вызове запускает его в фоновом потоке.
+    :return: цикл событий
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='async_http', daemon=True).start()
+            atexit.register(close)
+        return _loop
+
+
+def submit(coro: Awaitable) -> Future:
+    """
+    Запускает корутину в общем цикле событий, не дожидаясь результата.
+    :param coro: корутина
+    :return: concurrent.futures.Future с результатом корутины
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def run_sync(coro: Awaitable):
+    """
+    Выполняет корутину в общем цикле событий и возвращает результат. Можно вызывать из любого потока,
+    кроме потока самого цикла событий.
+    :param coro: корутина
+    :return: результат корутины
+    """
+    return submit(coro).result()
+
+
+def session(cookie_jar: aiohttp.abc.AbstractCookieJar = None, headers: Dict = None) -> aiohttp.ClientSession:
+    """
+    Создает сессию поверх общего пула соединений текущего цикла событий. Вызывается только внутри корутины.
+    Закрытие сессии не закрывает соединения пула.
+    :param cookie_jar: хранилище cookies; по умолчанию cookies не сохраняются
+    :param headers: заголовки по умолчанию
+    :return: сессия aiohttp
+    """
+    loop = asyncio.get_running_loop()
+    connector = _connectors.get(loop)
+    if connector is None or connector.closed:
+        connector = aiohttp.TCPConnector(limit=config.HTTP_POOL_SIZE,
+                                         limit_per_host=config.HTTP_POOL_SIZE_PER_HOST,
+                                         keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT)
+        _connectors[loop] = connector
+    # общее время запроса не ограничиваем: выгрузки Додо ИС за несколько месяцев формируются дольше
+    # CONNECT_TIMEOUT, а ожидание свободного соединения пула не должно считаться зависанием сервера;
+    # ограничены только установка соединения и пауза между данными ответа (как у выгрузки в storage.YandexDisk)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=config.CONNECT_TIMEOUT, sock_read=config.CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector,
+                                 connector_owner=False,
+                                 cookie_jar=cookie_jar if cookie_jar is not None else aiohttp.DummyCookieJar(),
+                                 headers=headers,
+                                 timeout=timeout)
+
+
+async def close_connector():
+    """
+    Закрывает пул соединений текущего цикла событий.
+    :return: None
+    """
+    connector = _connectors.pop(asyncio.get_running_loop(), None)
+    if connector is not None:
+        await connector.close()
+
+
+def close():
+    """
+    Закрывает пул соединений общего цикла событий и останавливает цикл.
+    :return: None
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            return
+        loop, _loop = _loop, None
+    asyncio.run_coroutine_threadsafe(close_connector(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
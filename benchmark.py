@@ -0,0 +1,209 @@
+"""
+Микробенчмарки разбора выгрузок Додо ИС на синтетических файлах (synthetic.py).
+Замеряются этапы: чтение Excel (_read_response), обработка (_process_df_*), склейка кусков (_concatenate_*)
+и преобразование датафрейма в параметры запроса (DodoISStorer._to_params с нормализацией телефонов).
+Для каждого этапа - минимальное и медианное время по нескольким повторам и пик памяти по tracemalloc
+(отдельным прогоном, чтобы трассировка не влияла на время).
+Результаты сохраняются в BENCHMARK_DIR/<коммит>.json; --compare сравнивает с сохраненным файлом и завершается
+с кодом 1, если какой-то этап стал медленнее в --threshold раз (и больше чем на --min-delta секунд).
+Миллионы строк задаются количеством кусков: в один лист Excel помещается чуть больше миллиона строк.
+
+Пример: python benchmark.py --rows 100000 --chunks 4 --compare benchmark_results/1a2b3c4.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+from dodois import DodoISParser, DodoISStorer
+from phones import normalize_phones
+
+BENCHMARK_DIR = 'benchmark_results'
+TIMEZONE = 'Europe/Moscow'
+
+
+def _measure(func: Callable, repeat: int) -> Dict[str, float]:
+    """
+    :return: {'min': секунды, 'median': секунды, 'peak_mb': пик памяти}
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'min': round(min(times), 4), 'median': round(statistics.median(times), 4),
+            'peak_mb': round(peak / 2 ** 20, 1)}
+
+
+def _workbooks(report_type: str, rows: int, chunks: int, cache_dir: str) -> List[bytes]:
+    """
+    Синтетические выгрузки отчета, разбитые на куски по 30 дней, как при выгрузке длинного периода.
+    Файлы кешируются в cache_dir: генерация миллионов строк занимает минуты.
+    """
+    contents = []
+    end = datetime(2024, 1, 31)
+    chunk_rows = max(rows // chunks, 1)
+    for chunk in range(chunks):
+        chunk_end = end - timedelta(days=30 * (chunks - chunk - 1))
+        kwargs = {'start': chunk_end - timedelta(days=30), 'end': chunk_end}
+        if report_type == 'clients_statistic':
+            # одни и те же клиенты в разных кусках, чтобы склейка объединяла повторы
+            kwargs['phone_pool'] = int(chunk_rows * 1.5)
+        # в имени файла - все параметры генерации, чтобы не взять из кеша выгрузку с другими параметрами
+        name = f'{report_type}_{chunk_rows}_{chunk}_{kwargs["start"]:%Y%m%d}_{chunk_end:%Y%m%d}_' \
+               f'{kwargs.get("phone_pool", 0)}.xlsx'
+        path = os.path.join(cache_dir, name) if cache_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+            continue
+        content = synthetic.workbook(report_type, chunk_rows, seed=chunk, **kwargs)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        contents.append(content)
+    return contents
+
+
+def run_benchmarks(rows: int, chunks: int, repeat: int, reports: List[str], cache_dir: str) -> Dict[str, Dict]:
+    """
+    :param rows: строк в отчете (всего по всем кускам)
+    :param chunks: количество кусков отчета
+    :param repeat: повторов каждого замера
+    :param reports: типы отчетов
+    :param cache_dir: папка для кеша синтетических файлов
+    :return: {этап_отчет: результат _measure}
+    """
+    results = {}
+    for report_type in reports:
+        report = DodoISParser.REPORTS[report_type]
+        print(f'generating {report_type}: {rows} rows in {chunks} chunks...')
+        contents = _workbooks(report_type, rows, chunks, cache_dir)
+
+        def read():
+            return [DodoISParser._read_response(content, skiprows=report['rows'], dtypes=report['dtypes'])
+                    for content in contents]
+
+        raw = read()
+        processor = getattr(DodoISParser, report['processor'])
+
+        def process():
+            return [processor(df.copy(), TIMEZONE) for df in raw]
+
+        processed = process()
+        concatenate = getattr(DodoISParser, f'_concatenate_{report_type}')
+
+        def concat():
+            return concatenate([df.copy() for df in processed])
+
+        concatenated = concat()
+        results[f'read_response_{report_type}'] = _measure(read, repeat)
+        results[f'process_df_{report_type}'] = _measure(process, repeat)
+        results[f'concatenate_{report_type}'] = _measure(concat, repeat)
+
+        # преобразование в параметры INSERT, как в DodoISStorer.store
+        phone_column = {'clients_statistic': '№ телефона', 'orders': 'Номер телефона'}.get(report_type)
+        if phone_column:
+            def to_params():
+                df = concatenated.copy()
+                df[phone_column] = normalize_phones(df[phone_column])
+                return DodoISStorer._to_params(df.dropna(subset=[phone_column]))
+
+            results[f'to_params_{report_type}'] = _measure(to_params, repeat)
+
+        for name, result in results.items():
+            if name.endswith(report_type):
+                print(f'{name:40} min {result["min"]:9.4f} s  median {result["median"]:9.4f} s  '
+                      f'peak {result["peak_mb"]:8.1f} MB')
+    return results
+
+
+def git_commit() -> str:
+    """
+    :return: короткий хэш текущего коммита или unknown
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results: Dict[str, Dict], baseline_path: str, threshold: float, min_delta: float) -> List[str]:
+    """
+    Сравнивает результаты с сохраненными.
+    :return: список этапов, которые стали медленнее в threshold раз и больше чем на min_delta секунд
+        (по минимальному времени; этапы в миллисекунды слишком шумные для одного порога)
+    """
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('rows') is not None:
+        print(f'baseline: commit {baseline.get("commit")}, {baseline.get("rows")} rows')
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]
+        ratio = result['min'] / old['min'] if old['min'] else np.inf
+        mark = ''
+        if ratio > threshold and result['min'] - old['min'] > min_delta:
+            mark = '  <-- REGRESSION'
+            regressions.append(name)
+        print(f'{name:40} {old["min"]:9.4f} s -> {result["min"]:9.4f} s  x{ratio:5.2f}  '
+              f'peak {old["peak_mb"]:8.1f} -> {result["peak_mb"]:8.1f} MB{mark}')
+    return regressions
+
+
+def main(argv: List[str] = None):
+    arg_parser = argparse.ArgumentParser(description='Микробенчмарки разбора выгрузок Додо ИС')
+    arg_parser.add_argument('--rows', type=int, default=100000, help='строк в отчете (всего)')
+    arg_parser.add_argument('--chunks', type=int, default=4, help='кусков по 30 дней')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='повторов каждого замера')
+    arg_parser.add_argument('--reports', nargs='+', default=list(DodoISParser.REPORTS),
+                            choices=list(DodoISParser.REPORTS))
+    arg_parser.add_argument('--cache-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                            help='кеш синтетических файлов ("" - без кеша)')
+    arg_parser.add_argument('--output', help=f'файл результатов, по умолчанию {BENCHMARK_DIR}/<коммит>.json')
+    arg_parser.add_argument('--compare', help='файл результатов для сравнения')
+    arg_parser.add_argument('--threshold', type=float, default=1.2, help='замедление, которое считается регрессией')
+    arg_parser.add_argument('--min-delta', type=float, default=0.01,
+                            help='минимальное замедление в секундах, которое считается регрессией')
+    args = arg_parser.parse_args(argv)
+
+    results = run_benchmarks(args.rows, args.chunks, args.repeat, args.reports, args.cache_dir)
+    commit = git_commit()
+    output = args.output or os.path.join(BENCHMARK_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'),
+                   'python': platform.python_version(), 'pandas': pd.__version__,
+                   'rows': args.rows, 'chunks': args.chunks, 'repeat': args.repeat,
+                   'results': results}, f, ensure_ascii=False, indent=2)
+    print(f'results saved to {output}')
+
+    if args.compare and compare(results, args.compare, args.threshold, args.min_delta):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,27 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Callable, List
+
+import async_http
 import config
-import requests
+
+# максимальная длина сообщения телеграм-бота в байтах
+MESSAGE_MAX_BYTES = 4096
+# порядок уровней важности в сводке и их заголовки
+SEVERITIES = OrderedDict([('error', 'Ошибки'), ('warning', 'Предупреждения'), ('info', 'Сообщения')])
 
 
-class Bot:
+class AsyncBot:
     """
     Класс реализует взаимодействие с телеграм-ботом @dodozvon_bot.
     Поддерживает метод send_message для отправки простого текстового сообщения.
+    Запросы выполняются асинхронно через общий пул соединений (async_http). Синхронная обертка - Bot.
     """
     def __init__(self):
 
         # URL API - ссылка на АПИ бота
-        self._api_url = 'https://api.telegram.org/'
+        self._api_url = config.TG_API_URL
 
         # токен для доступа к боту - формируется в модуле config из данных, хранящихся в .env
         self._token = config.TG_BOT_TOKEN
@@ -18,17 +29,31 @@ class Bot:
         # - список ID пользователей в формате INT - формируется в модуле config из данных, хранящихся в .env
         self._admin_ids = config.TG_ADMIN_ID
 
-    def _get_updates(self) -> None:
+    async def send_message(self, message_text: str) -> None:
         """
-        Метод отправляет Get-запрос боту для получения накопленных входящих сообщений и ничего с ними не делает.
-        Таким образом реализуется "очистка кеша".
-        По сути мы не ожидаем входящих сообщений - эта функция - просто страховка.
+        Отправляет сообщение админам. Список админов в .env в переменной TG_ADMIN_ID
+        :param message_text: строка с текстом сообщения. Максимальная длина - 4096 байтов (см. АПИ телеграм-ботов).
         :return: None
         """
-        url = f'{self._api_url}bot{self._token}/getUpdates'
 
-        # отправляем GET-запрос
-        requests.get(url)
+        # формируем URL для отправки данных
+        url = f'{self._api_url}bot{self._token}/sendMessage'
+
+        async def post(data: dict):
+            async with session.post(url, data=data) as response:
+                await response.read()
+
+        # для всех ID в списке админов отправляем сообщения одновременно
+        async with async_http.session() as session:
+            # формируем словарь (фигурные скобки) согласно АПИ телеграм-ботов
+            await asyncio.gather(*(post({'chat_id': str(admin_id), 'text': message_text})
+                                   for admin_id in self._admin_ids))
+
+
+class Bot(AsyncBot):
+    """
+    Синхронная обертка над AsyncBot: запросы выполняются в общем цикле событий модуля async_http.
+    """
 
     def send_message(self, message_text: str) -> None:
         """
@@ -36,17 +61,125 @@ class Bot:
         :param message_text: строка с текстом сообщения. Максимальная длина - 4096 байтов (см. АПИ телеграм-ботов).
         :return: None
         """
+        async_http.run_sync(super().send_message(message_text))
 
-        # вызываем метод для очистки входящих
-        self._get_updates()
 
-        # формируем URL для отправки данных
-        url = f'{self._api_url}bot{self._token}/sendMessage'
+def split_message(text: str, max_bytes: int = MESSAGE_MAX_BYTES) -> List[str]:
+    """
+    Разбивает текст на сообщения не длиннее max_bytes байтов (в UTF-8), по возможности по границам строк.
+    :param text: текст
+    :param max_bytes: максимальная длина сообщения в байтах
+    :return: список сообщений
+    """
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        # слишком длинную строку режем на куски по символам
+        while len(line.encode()) > max_bytes:
+            cut = max_bytes
+            while len(line[:cut].encode()) > max_bytes:
+                cut -= 1
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:cut])
+            line = line[cut:]
+        candidate = f'{current}\n{line}' if current else line
+        if len(candidate.encode()) > max_bytes:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+class DigestNotifier:
+    """
+    Буфер сообщений для админов. Сообщения не отправляются сразу, а копятся и отправляются сводками:
+    в фоновом потоке раз в NOTIFY_FLUSH_INTERVAL секунд и при закрытии (close или выход из блока with).
+    В сводке сообщения сгруппированы по важности и пиццерии, одинаковые сообщения склеиваются со счетчиком,
+    сводка разбивается на сообщения по MESSAGE_MAX_BYTES байтов.
+    """
+    def __init__(self, bot: Bot = None, flush_interval: float = None, send: Callable[[str], None] = None):
+        """
+        :param bot: бот для отправки, по умолчанию Bot()
+        :param flush_interval: период отправки сводок в секундах, по умолчанию config.NOTIFY_FLUSH_INTERVAL
+        :param send: функция отправки сообщения вместо бота (например, print для отладки)
+        """
+        self._send = send or (bot or Bot()).send_message
+        self._flush_interval = flush_interval if flush_interval is not None else config.NOTIFY_FLUSH_INTERVAL
+        # {(важность, пиццерия): {сообщение: количество}}
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, name='digest_notifier', daemon=True)
+        self._thread.start()
+
+    def notify(self, message: str, unit: str = None, severity: str = 'error'):
+        """
+        Добавляет сообщение в буфер.
+        :param message: текст сообщения
+        :param unit: пиццерия, к которой относится сообщение
+        :param severity: важность: 'error', 'warning' или 'info'
+        :return: None
+        """
+        with self._lock:
+            messages = self._buffer.setdefault((severity, unit), {})
+            messages[message] = messages.get(message, 0) + 1
+
+    def _digest(self) -> str:
+        """
+        Забирает сообщения из буфера и формирует текст сводки.
+        :return: текст сводки или пустая строка, если сообщений нет
+        """
+        with self._lock:
+            buffer, self._buffer = self._buffer, {}
+        lines = []
+        for severity, title in SEVERITIES.items():
+            groups = [(unit, messages) for (group_severity, unit), messages in buffer.items()
+                      if group_severity == severity]
+            if not groups:
+                continue
+            lines.append(f'{title} ({sum(sum(messages.values()) for _, messages in groups)}):')
+            for unit, messages in groups:
+                indent = ''
+                if unit is not None:
+                    lines.append(f'{unit}:')
+                    indent = '  '
+                for message, count in messages.items():
+                    lines.append(f'{indent}- {message}' + (f' (x{count})' if count > 1 else ''))
+        return '\n'.join(lines)
+
+    def flush(self):
+        """
+        Отправляет накопленные сообщения сводкой.
+        :return: None
+        """
+        digest = self._digest()
+        for part in split_message(digest) if digest else []:
+            self._send(part)
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # ошибка отправки не должна останавливать фоновый поток
+                print(f'Ошибка отправки сводки: {e}')
+
+    def close(self):
+        """
+        Останавливает фоновый поток и отправляет оставшиеся сообщения.
+        :return: None
+        """
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
 
-        # для всех ID в списке админов
-        for admin_id in self._admin_ids:
-            # формируем словарь (фигурные скобки) согласно АПИ телеграм-ботов c последующей передачей в requests
-            data = {'chat_id': admin_id,
-                    'text': message_text}
-            # сигнатура метода Python: requests.post('https://httpbin.org/post', data={'key':'value'})
-            requests.post(url, data=data)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,176 @@
+"""
+Нагрузочная проверка одновременной записи клиентов. N писателей (потоки, у каждого свое соединение с БД и своя
+пиццерия) одновременно записывают выгрузки "Статистика по клиентам" с пересекающимися телефонами (общий пул
+--phone-pool) через DodoISStorer.store, каждый --rounds раз. С --legacy те же строки записываются прежним способом:
+в порядке выгрузки, одним запросом и одной транзакцией на выгрузку, с повтором всей транзакции при взаимной
+блокировке.
+
+Печатает время записи (всего и по писателям), повторы пачек (ошибки этапа clients_batch), взаимные блокировки
+по pg_stat_database и проверяет, что в clients ровно одна строка на каждый записанный телефон. Завершается
+с кодом 1, если писатель завершился ошибкой или число строк не совпало. Таблицы units и clients в БД
+перезаписываются, поэтому нужна отдельная БД (как для sql_benchmark.py).
+
+Пример: python clients_stress.py --pg-database dodozvon_bench --writers 16 --rows 50000 --phone-pool 100000
+        python clients_stress.py --pg-database dodozvon_bench --writers 16 --rows 50000 --phone-pool 100000 --legacy
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import pandas as pd
+
+import metrics
+import synthetic
+from dodois import ClientsStatisticAggregator, DodoISParser, DodoISStorer
+from phones import normalize_phones
+from postgresql import Database
+
+TIMEZONE = 'Europe/Moscow'
+
+
+class StressDatabase(Database):
+    """
+    Соединение с отдельной БД для проверки.
+    """
+    def __init__(self, database: str):
+        super().__init__()
+        self._database = database
+
+
+def _frames(writers: int, rows: int, phone_pool: int) -> List[pd.DataFrame]:
+    """
+    Выгрузки писателей, подготовленные так же, как при парсинге (разбор Excel и свертка повторов телефона).
+    """
+    frames = []
+    for writer in range(writers):
+        df = DodoISParser.decode('clients_statistic',
+                                 synthetic.workbook('clients_statistic', rows, seed=writer, phone_pool=phone_pool),
+                                 TIMEZONE)
+        aggregator = ClientsStatisticAggregator()
+        aggregator.add(df)
+        frames.append(aggregator.result())
+    return frames
+
+
+def _legacy_store(db: Database, id_: int, df: pd.DataFrame, stats: Dict[str, int]):
+    """
+    Прежняя запись: строки в порядке выгрузки одним запросом, вся выгрузка - одна транзакция.
+    """
+    df = df[['№ телефона', 'Дата первого заказа', 'Отдел первого заказа', 'Дата последнего заказа',
+             'Отдел последнего заказа', 'first_order_type', 'Кол-во заказов', 'Сумма заказа']].copy()
+    df['№ телефона'] = normalize_phones(df['№ телефона'])
+    df = df.dropna(subset=['№ телефона'])
+    params = [(id_, *row, '', '', '') for row in DodoISStorer._to_params(df)]
+    while True:
+        try:
+            db.execute(DodoISStorer.UPSERT_CLIENTS, params)
+            db.commit()
+            return
+        except DodoISStorer.RETRYABLE_ERRORS:
+            db.rollback()
+            stats['transaction_retries'] += 1
+
+
+def _writer(database: str, id_: int, df: pd.DataFrame, rounds: int, legacy: bool, commit_batches: bool,
+            barrier: threading.Barrier, results: Dict[int, Dict]):
+    db = StressDatabase(database)
+    db.connect(init_schema=False)
+    stats = {'seconds': 0.0, 'transaction_retries': 0, 'error': None}
+    results[id_] = stats
+    barrier.wait()
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            if legacy:
+                _legacy_store(db, id_, df, stats)
+            else:
+                DodoISStorer(id_, db=db, commit_batches=commit_batches).store(df, None)
+                db.commit()
+            stats['seconds'] += time.perf_counter() - started
+    except Exception as e:
+        db.rollback()
+        stats['error'] = repr(e)
+    finally:
+        db.close()
+
+
+def _deadlocks(db: Database) -> int:
+    db.execute('SELECT deadlocks FROM pg_stat_database WHERE datname = current_database();')
+    return db.fetch(one=True)[0]
+
+
+def main(argv: List[str] = None):
+    arg_parser = argparse.ArgumentParser(description='Одновременная запись клиентов с пересекающимися телефонами')
+    arg_parser.add_argument('--pg-database', required=True, help='отдельная БД для проверки (перезаписывается)')
+    arg_parser.add_argument('--writers', type=int, default=8, help='одновременных писателей (пиццерий)')
+    arg_parser.add_argument('--rows', type=int, default=20000, help='строк в выгрузке писателя')
+    arg_parser.add_argument('--phone-pool', type=int, default=50000, help='разных телефонов у всех писателей')
+    arg_parser.add_argument('--rounds', type=int, default=3, help='сколько раз каждый писатель записывает выгрузку')
+    arg_parser.add_argument('--legacy', action='store_true', help='прежняя запись для сравнения')
+    arg_parser.add_argument('--commit-batches', action='store_true',
+                            help='фиксировать каждую пачку отдельной транзакцией (CLIENTS_UPSERT_COMMIT)')
+    args = arg_parser.parse_args(argv)
+
+    db = StressDatabase(args.pg_database)
+    db.connect()
+    db.execute('TRUNCATE units, clients RESTART IDENTITY CASCADE;')
+    db.execute("""
+        INSERT INTO units (country_code, unit_id, uuid, unit_name, tz_shift, begin_date_work)
+        SELECT 'ru', 1000 + g, md5(g::text), 'Тест ' || g, 3, current_date - 1000
+        FROM generate_series(1, %s) g;
+    """, (args.writers,))
+    db.commit()
+
+    print('preparing frames...')
+    frames = _frames(args.writers, args.rows, args.phone_pool)
+    expected = len(set().union(*(set(normalize_phones(df['№ телефона']).dropna()) for df in frames)))
+
+    deadlocks_before = _deadlocks(db)
+    db.commit()
+    metrics.reset()
+    barrier = threading.Barrier(args.writers)
+    results = {}
+    threads = [threading.Thread(target=_writer, args=(args.pg_database, id_, df, args.rounds, args.legacy,
+                                                      args.commit_batches, barrier, results))
+               for id_, df in enumerate(frames, start=1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # счетчики pg_stat_database обновляются с задержкой
+    time.sleep(1)
+    db.execute('SELECT pg_stat_clear_snapshot();')
+    deadlocks = _deadlocks(db) - deadlocks_before
+    db.execute('SELECT count(*), count(DISTINCT phone) FROM clients;')
+    rows, phones = db.fetch(one=True)
+    db.close()
+
+    batches = metrics.summary()
+    writer_seconds = [stats['seconds'] for stats in results.values()]
+    errors = {id_: stats['error'] for id_, stats in results.items() if stats['error']}
+    print(json.dumps({
+        'mode': 'legacy' if args.legacy else ('commit_batches' if args.commit_batches else 'batches'),
+        'writers': args.writers, 'rows': args.rows, 'phone_pool': args.phone_pool, 'rounds': args.rounds,
+        'elapsed_seconds': round(elapsed, 2),
+        'writer_seconds_max': round(max(writer_seconds), 2),
+        'writer_seconds_avg': round(sum(writer_seconds) / len(writer_seconds), 2),
+        'deadlocks': deadlocks,
+        'transaction_retries': sum(stats['transaction_retries'] for stats in results.values()),
+        'batch_retries': sum(stage['errors'] for name, stage in batches.items() if name.startswith('clients_batch')),
+        'clients_rows': rows, 'expected_rows': expected,
+        'errors': errors,
+    }, ensure_ascii=False, indent=2))
+
+    if errors or rows != expected or phones != rows:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
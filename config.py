@@ -3,6 +3,8 @@
 Также хранит основные переменные проекта.
 """
 
+import os
+
 from environs import Env
 
 env = Env()
@@ -16,19 +18,116 @@ PG_PORT = env.int('PG_PORT')
 
 TG_BOT_TOKEN = env.str('TG_BOT_TOKEN')
 TG_ADMIN_ID = env.list('TG_ADMIN_ID', subcast=int)
+TG_API_URL = env.str('TG_API_URL', 'https://api.telegram.org/')
 
 YANDEX_API_TOKEN = env.str('YANDEX_API_TOKEN')
+YANDEX_API_URL = env.str('YANDEX_API_URL', 'https://cloud-api.yandex.net/v1/disk/resources')
 YANDEX_NEW_CLIENTS_FOLDER = 'call_new_clients'
 YANDEX_LOST_CLIENTS_FOLDER = 'call_lost_clients'
 YANDEX_NEW_PROMO_FOLDER = 'promo_new_clients'
 YANDEX_LOST_PROMO_FOLDER = 'promo_lost_clients'
 YANDEX_ORDERS_FOLDER = 'orders'
+YANDEX_BUNDLE_FOLDER = 'report_bundles'
+
+# адреса Додо ИС (авторизация и офис менеджера) и публичного API Dodo; переопределяются, например,
+# для запуска против тестовых серверов (fake_services.py)
+DODOIS_AUTH_URL = env.str('DODOIS_AUTH_URL', 'https://auth.dodois.io/')
+DODOIS_OFFICE_MANAGER_URL = env.str('DODOIS_OFFICE_MANAGER_URL', 'https://officemanager.dodopizza.ru/')
+DODO_PUBLIC_API_URL = env.str('DODO_PUBLIC_API_URL', 'https://publicapi.dodois.io/ru/api/v1/unitinfo')
+# сколько секунд после последнего успешного запроса повторно использовать авторизацию пиццерии в Додо ИС
+# (сессия Додо ИС истекает примерно через 15 минут неактивности); 0 - входить заново для каждого парсера
+DODOIS_SESSION_TTL = env.int('DODOIS_SESSION_TTL', 600)
 
-# таймаут для запросов requests в секундах
+# таймаут HTTP-запросов в секундах: установка соединения и ожидание данных ответа (не общее время запроса)
 CONNECT_TIMEOUT = 180
-# количество повторений для попытки запросов requests парсера
+# количество повторений для попытки запросов парсера
 PARSE_ATTEMPTS = 5
 
+# размер общего пула HTTP-соединений (всего и на один хост) и время жизни неактивного соединения в секундах
+HTTP_POOL_SIZE = env.int('HTTP_POOL_SIZE', 100)
+HTTP_POOL_SIZE_PER_HOST = env.int('HTTP_POOL_SIZE_PER_HOST', 20)
+HTTP_KEEPALIVE_TIMEOUT = env.int('HTTP_KEEPALIVE_TIMEOUT', 60)
+
+# количество пиццерий, которые одновременно выгружаются из Додо ИС
+PARSE_CONCURRENCY = env.int('PARSE_CONCURRENCY', 8)
+# количество процессов для разбора Excel-файлов и число задач, после которого процесс пересоздается
+# (чтобы вернуть память pandas операционной системе)
+DECODE_PROCESSES = env.int('DECODE_PROCESSES', os.cpu_count() or 1)
+DECODE_MAX_TASKS_PER_CHILD = env.int('DECODE_MAX_TASKS_PER_CHILD', 20)
+
+# источник данных для таблицы clients:
+# 'clients_statistic' - выгружаем отчет "Статистика по клиентам" для каждой пиццерии,
+# 'orders' - пересчитываем клиентов в БД из таблицы orders, отчет не выгружаем
+CLIENTS_SOURCE = env.str('CLIENTS_SOURCE', 'clients_statistic')
+# доля пиццерий, для которых в режиме 'orders' всё равно выгружается "Статистика по клиентам" для сверки
+CLIENTS_RECONCILE_SHARE = env.float('CLIENTS_RECONCILE_SHARE', 0.05)
+# запись клиентов (DodoISStorer): строки пачки по CLIENTS_UPSERT_BATCH в порядке телефонов, при взаимной
+# блокировке пачка повторяется до CLIENTS_UPSERT_ATTEMPTS раз. CLIENTS_UPSERT_COMMIT - фиксировать каждую пачку
+# отдельной транзакцией (блокировки строк освобождаются сразу); в режиме clients_statistic при ошибке посреди
+# пиццерии уже зафиксированные пачки будут прибавлены повторно при следующей выгрузке, поэтому включать
+# рекомендуется с CLIENTS_SOURCE=orders, где клиенты пересчитываются из заказов
+CLIENTS_UPSERT_BATCH = env.int('CLIENTS_UPSERT_BATCH', 5000)
+CLIENTS_UPSERT_ATTEMPTS = env.int('CLIENTS_UPSERT_ATTEMPTS', 5)
+CLIENTS_UPSERT_COMMIT = env.bool('CLIENTS_UPSERT_COMMIT', False)
+
+# конвейер отчетов: потоки формирования xlsx, потоки выгрузки на Яндекс.Диск и размер очередей между этапами
+REPORT_RENDER_WORKERS = env.int('REPORT_RENDER_WORKERS', 2)
+REPORT_UPLOAD_WORKERS = env.int('REPORT_UPLOAD_WORKERS', 4)
+REPORT_QUEUE_SIZE = env.int('REPORT_QUEUE_SIZE', 8)
+# выгружать отчеты run_tasker одним zip-архивом (YANDEX_BUNDLE_FOLDER) и после архива выгружать ли
+# отдельные файлы в их папки
+REPORT_BUNDLE = env.bool('REPORT_BUNDLE', False)
+REPORT_BUNDLE_PUBLISH_FILES = env.bool('REPORT_BUNDLE_PUBLISH_FILES', True)
+
+# сколько секунд считать папку на Яндекс.Диске существующей без повторной проверки
+YANDEX_FOLDER_CACHE_TTL = env.int('YANDEX_FOLDER_CACHE_TTL', 3600)
+
+# число одновременных выгрузок файлов на Яндекс.Диск и попыток выгрузки одного файла
+YANDEX_UPLOAD_CONCURRENCY = env.int('YANDEX_UPLOAD_CONCURRENCY', 4)
+YANDEX_UPLOAD_ATTEMPTS = env.int('YANDEX_UPLOAD_ATTEMPTS', 3)
+
+# режим очереди: несколько run_parser делят пиццерии через аренду в таблице auth (см. work_queue.py).
+# WORKER_ID - имя воркера (по умолчанию "хост:pid"), WORK_QUEUE_BATCH - сколько пиццерий арендовать за раз,
+# WORK_QUEUE_LEASE_TTL - срок аренды в секундах, WORK_QUEUE_HEARTBEAT - период продления аренды в секундах,
+# WORK_QUEUE_RETRY_DELAY - через сколько секунд пиццерию с ошибкой можно взять снова
+WORK_QUEUE = env.bool('WORK_QUEUE', False)
+WORKER_ID = env.str('WORKER_ID', None)
+WORK_QUEUE_BATCH = env.int('WORK_QUEUE_BATCH', 8)
+WORK_QUEUE_LEASE_TTL = env.int('WORK_QUEUE_LEASE_TTL', 600)
+WORK_QUEUE_HEARTBEAT = env.int('WORK_QUEUE_HEARTBEAT', 60)
+WORK_QUEUE_RETRY_DELAY = env.int('WORK_QUEUE_RETRY_DELAY', 3600)
+
+# журнал запусков (таблица unit_runs): по скольким последним запускам считать ожидаемое время выгрузки пиццерии
+# и во сколько раз дольше медианы выгрузка считается замедлением
+LEDGER_HISTORY_RUNS = env.int('LEDGER_HISTORY_RUNS', 5)
+LEDGER_REGRESSION_FACTOR = env.float('LEDGER_REGRESSION_FACTOR', 2.0)
+
+# как часто (в секундах) отправлять админам накопленные сообщения сводкой
+NOTIFY_FLUSH_INTERVAL = env.int('NOTIFY_FLUSH_INTERVAL', 300)
+
+# папка для метрик этапов (файлы dodozvon_<скрипт>.prom для textfile collector node_exporter и JSON-сводки);
+# если не задана, сводка только печатается в конце запуска
+METRICS_DIR = env.str('METRICS_DIR', '')
+
+# профилирование (см. profiling.py): цели - id или названия пиццерий и названия отчетов через запятую,
+# папка для файлов .prof и .alloc.txt и количество мест с наибольшим приростом памяти в отчете tracemalloc
+PROFILE_TARGETS = env.list('PROFILE_TARGETS', [])
+PROFILE_DIR = env.str('PROFILE_DIR', 'profiles')
+PROFILE_TOP_ALLOCATIONS = env.int('PROFILE_TOP_ALLOCATIONS', 25)
+
+# оркестратор run_all (см. orchestrator.py): сколько задач каждого этапа выполняется одновременно.
+# Выгрузка пиццерий из Додо ИС ограничена PARSE_CONCURRENCY, запись пиццерий в БД - ORCHESTRATOR_STORE_CONCURRENCY,
+# отчеты клиентов по БД (новые, пропавшие, заказы) - ORCHESTRATOR_REPORT_CONCURRENCY,
+# отчеты клиентов о промокодах (выгрузка из Додо ИС) - ORCHESTRATOR_PROMO_CONCURRENCY
+ORCHESTRATOR_STORE_CONCURRENCY = env.int('ORCHESTRATOR_STORE_CONCURRENCY', 1)
+ORCHESTRATOR_REPORT_CONCURRENCY = env.int('ORCHESTRATOR_REPORT_CONCURRENCY', 2)
+ORCHESTRATOR_PROMO_CONCURRENCY = env.int('ORCHESTRATOR_PROMO_CONCURRENCY', 2)
+# демон (см. daemon.py): часовой пояс расписания и время запуска задач (ЧЧ:ММ через запятую, пусто - не запускать)
+DAEMON_TIMEZONE = env.str('DAEMON_TIMEZONE', 'Europe/Moscow')
+DAEMON_PARSER_TIMES = env.list('DAEMON_PARSER_TIMES', ['03:00'])
+DAEMON_CUSTOM_TIMES = env.list('DAEMON_CUSTOM_TIMES', ['06:00'])
+DAEMON_TASKER_TIMES = env.list('DAEMON_TASKER_TIMES', ['07:00'])
+
 TIMEZONES = {
     2: 'Europe/Kaliningrad',
     3: 'Europe/Moscow',
@@ -0,0 +1,208 @@
+"""
+Долгоживущий процесс вместо запусков по cron: встроенное расписание запускает run_parser, run_custom и run_tasker
+(время - DAEMON_*_TIMES в часовом поясе DAEMON_TIMEZONE). Между запусками остаются «теплыми»:
+- соединение с БД (схема создается один раз при старте, а не в каждом Database.connect);
+- пул процессов разбора Excel (ReportDecoder) с уже импортированным pandas;
+- пул HTTP-соединений общего цикла событий (async_http) и авторизации пиццерий в Додо ИС (DODOIS_SESSION_TTL);
+- ETag публичного API Dodo хранится в БД, поэтому неизмененный список пиццерий не выгружается заново.
+
+Задачи выполняются по одной в порядке расписания; если задача задержалась дольше следующего своего запуска,
+пропущенный запуск не повторяется. SIGTERM и SIGINT - мягкая остановка: текущая задача доработает, затем
+закрываются пулы. SIGHUP - перезагрузка: после текущей задачи процесс перезапускается с той же командной строкой
+и заново читает .env и код.
+
+Пример: python daemon.py
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from dateutil import tz
+
+import async_http
+import config
+import metrics
+import profiling
+import run_custom
+import run_parser
+import run_tasker
+from bot import Bot
+from decoder import ReportDecoder
+from dodois import clear_auth_sessions
+from postgresql import Database
+
+
+def _parse_times(times: List[str]) -> List[tuple]:
+    """
+    :param times: время в формате ЧЧ:ММ
+    :return: отсортированный список (часы, минуты)
+    """
+    result = []
+    for value in times:
+        hours, minutes = value.strip().split(':')
+        result.append((int(hours), int(minutes)))
+    return sorted(result)
+
+
+def next_run(times: List[tuple], after: datetime) -> datetime:
+    """
+    Ближайшее время запуска по расписанию строго после заданного момента.
+    :param times: расписание [(часы, минуты)]
+    :param after: момент с часовым поясом расписания
+    :return: время запуска
+    """
+    day = after.date()
+    while True:
+        for hours, minutes in times:
+            candidate = datetime(day.year, day.month, day.day, hours, minutes, tzinfo=after.tzinfo)
+            if candidate > after:
+                return candidate
+        day += timedelta(days=1)
+
+
+class Daemon:
+    """
+    Расписание задач и общее для них «теплое» состояние.
+    """
+    def __init__(self, schedule: Dict[str, List[str]] = None, timezone: str = None):
+        """
+        :param schedule: {имя задачи: [ЧЧ:ММ]}, по умолчанию из config (задачи с пустым расписанием не запускаются)
+        :param timezone: часовой пояс расписания, по умолчанию config.DAEMON_TIMEZONE
+        """
+        if schedule is None:
+            schedule = {'run_parser': config.DAEMON_PARSER_TIMES,
+                        'run_custom': config.DAEMON_CUSTOM_TIMES,
+                        'run_tasker': config.DAEMON_TASKER_TIMES}
+        self._tz = tz.gettz(timezone or config.DAEMON_TIMEZONE)
+        self._schedule = {name: _parse_times(times) for name, times in schedule.items() if times}
+        # задачи: парсер пишет в БД, поэтому при одновременном времени запуска идет первым
+        self._jobs: Dict[str, Callable[[], None]] = {
+            'run_parser': lambda: run_parser.run(self._get_db(), self._get_decoder()),
+            'run_custom': lambda: run_custom.run(self._get_db()),
+            'run_tasker': lambda: run_tasker.run(self._get_db()),
+        }
+        self._stop_event = threading.Event()
+        self._reload = False
+        self._db: Optional[Database] = None
+        self._schema_ready = False
+        self._decoder: Optional[ReportDecoder] = None
+
+    def _now(self) -> datetime:
+        return datetime.now(self._tz)
+
+    def _get_db(self) -> Database:
+        """
+        :return: соединение с БД; переподключается, если соединение закрыто сервером
+        """
+        if self._db is not None and not self._db.is_alive():
+            print('Database connection lost, reconnecting...')
+            self._db = None
+        if self._db is None:
+            db = Database()
+            db.connect(init_schema=not self._schema_ready)
+            self._db = db
+            self._schema_ready = True
+        return self._db
+
+    def _get_decoder(self) -> ReportDecoder:
+        if self._decoder is None:
+            self._decoder = ReportDecoder()
+        return self._decoder
+
+    def stop(self, reload: bool = False):
+        """
+        Просит демон остановиться после текущей задачи.
+        :param reload: перезапустить процесс после остановки
+        :return: None
+        """
+        self._reload = self._reload or reload
+        self._stop_event.set()
+
+    def run_job(self, name: str):
+        """
+        Выполняет задачу; ошибка задачи сообщается админам и не останавливает демон.
+        :param name: имя задачи
+        :return: None
+        """
+        print(f'{self._now():%Y-%m-%d %H:%M} starting {name}')
+        started = time.perf_counter()
+        # сводка метрик (metrics.report в конце задачи) - только по этой задаче
+        metrics.reset()
+        try:
+            self._jobs[name]()
+        except Exception as e:
+            traceback.print_exc()
+            if self._db is not None and self._db.is_alive():
+                self._db.rollback()
+            try:
+                Bot().send_message(f'Ошибка задачи {name}: {e}')
+            except Exception as send_error:
+                print(f'Ошибка отправки сообщения: {send_error}')
+        print(f'{name} finished in {time.perf_counter() - started:.0f} s')
+
+    def run(self):
+        """
+        Выполняет задачи по расписанию до вызова stop.
+        :return: None
+        """
+        now = self._now()
+        next_runs = {name: next_run(times, now) for name, times in self._schedule.items()}
+        for name, at in next_runs.items():
+            print(f'{name}: next run at {at:%Y-%m-%d %H:%M %Z}')
+        order = list(self._jobs)
+        while not self._stop_event.is_set() and next_runs:
+            name = min(next_runs, key=lambda name_: (next_runs[name_], order.index(name_)))
+            delay = (next_runs[name] - self._now()).total_seconds()
+            if delay > 0:
+                # ждем не дольше минуты, чтобы перевод часов не сдвигал запуск надолго
+                self._stop_event.wait(min(delay, 60))
+                continue
+            self.run_job(name)
+            next_runs[name] = next_run(self._schedule[name], self._now())
+            print(f'{name}: next run at {next_runs[name]:%Y-%m-%d %H:%M %Z}')
+
+    def close(self):
+        """
+        Закрывает пулы и соединения.
+        :return: None
+        """
+        if self._decoder is not None:
+            self._decoder.close()
+            self._decoder = None
+        if self._db is not None:
+            if self._db.is_alive():
+                self._db.close()
+            self._db = None
+        clear_auth_sessions()
+        async_http.close()
+
+    @property
+    def reload_requested(self) -> bool:
+        return self._reload
+
+
+def main():
+    profiling.configure()
+    daemon = Daemon()
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.stop(reload=True))
+    try:
+        daemon.run()
+    finally:
+        daemon.close()
+    if daemon.reload_requested:
+        print('Reloading...')
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    print('Stopped.')
+
+
+if __name__ == '__main__':  # явный запуск скрипта
+    main()
@@ -0,0 +1,70 @@
+import multiprocessing
+from typing import Dict, Tuple
+
+import pandas as pd
+
+import config
+import metrics
+from dodois import DodoISParser
+
+
+def _decode_measured(report_type: str, content: bytes, this_timezone: str) -> Tuple[pd.DataFrame, Dict]:
+    # выполняется в процессе пула: метрики этапов разбора возвращаются вместе с датафреймом,
+    # так как реестр метрик у каждого процесса свой
+    metrics.reset()
+    df = DodoISParser.decode(report_type, content, this_timezone)
+    return df, metrics.snapshot()
+
+
+class ReportDecoder:
+    """
+    Пул процессов для разбора Excel-отчетов Додо ИС.
+    pd.read_excel и обработка датафреймов загружают процессор и держат GIL, поэтому в потоках выгрузки
+    выполняется только сетевой обмен, а разбор файлов передается в отдельные процессы.
+    Процессы пересоздаются после max_tasks_per_child задач, чтобы освобождать память pandas.
+    Метод decode потокобезопасен: его можно вызывать одновременно из нескольких потоков.
+    """
+    def __init__(self, processes: int = None, max_tasks_per_child: int = None):
+        """
+        :param processes: количество процессов, по умолчанию config.DECODE_PROCESSES
+        :param max_tasks_per_child: количество задач до пересоздания процесса,
+        по умолчанию config.DECODE_MAX_TASKS_PER_CHILD
+        """
+        # forkserver не копирует потоки и соединения родителя, поэтому безопасен при запущенных потоках выгрузки
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # заранее импортируем pandas в сервере, чтобы пересоздание процессов было быстрым
+            context.set_forkserver_preload(['dodois'])
+        self._pool = context.Pool(processes or config.DECODE_PROCESSES,
+                                  maxtasksperchild=max_tasks_per_child or config.DECODE_MAX_TASKS_PER_CHILD)
+
+    def decode(self, report_type: str, content: bytes, this_timezone: str) -> pd.DataFrame:
+        """
+        Разбирает Excel-файл в одном из процессов пула и возвращает обработанный датафрейм.
+        Блокирует вызывающий поток до получения результата.
+        :param report_type: тип отчета (ключ DodoISParser.REPORTS)
+        :param content: Excel-файл
+        :param this_timezone: часовой пояс пиццерии
+        :return: обработанный датафрейм
+        """
+        df, stage_metrics = self._pool.apply(_decode_measured, (report_type, content, this_timezone))
+        metrics.merge(stage_metrics)
+        return df
+
+    def close(self):
+        """
+        Дожидается завершения задач и закрывает пул.
+        :return: None
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
@@ -1,10 +1,16 @@
-from typing import Dict
-
-import requests
+import hashlib
+import json
+from datetime import date
+from typing import Dict, List, Tuple, Union
 
+import async_http
+from config import DODO_PUBLIC_API_URL
 from parser import DatabaseWorker
 from postgresql import Database
 
+# параметры таблицы config для условного запроса: {заголовок ответа (Hash - хэш тела ответа): параметр}
+VALIDATOR_PARAMS = {'ETag': 'UnitInfoETag', 'Last-Modified': 'UnitInfoLastModified', 'Hash': 'UnitInfoHash'}
+
 
 class DodoOpenAPIParser:
     """
@@ -16,22 +22,41 @@ class DodoOpenAPIParser:
         """
         Инициализация DodoOpenAPIParser(). Без параметров.
         """
-        # создаём новую сессию
-        self._session = requests.Session()
         # сохраняем адрес API
-        self._public_api_address = 'https://publicapi.dodois.io/ru/api/v1/unitinfo'
+        self._public_api_address = DODO_PUBLIC_API_URL
 
-    def parse(self) -> Dict:
+    def parse(self, validators: Dict[str, str] = None) -> Union[None, Tuple[List, Dict[str, str]]]:
         """
-        Парсинг.
-        :return: словарь со значениями
+        Парсинг. Запрос условный: если переданы ETag и Last-Modified прошлого ответа и сервер ответил
+        304 Not Modified, или если ответ совпал с прошлым по хэшу, возвращаем None.
+        :param validators: ETag, Last-Modified и хэш (Hash) прошлого ответа (см. DodoOpenAPIStorer.get_validators)
+        :return: кортеж из списка пиццерий и новых ETag, Last-Modified и хэша, или None, если данные не изменились
         """
-        # отправляем get-запрос на сервер и сохраняем ответ в переменную result
-        result = self._session.get(self._public_api_address)
-        # закрываем сессию (чтобы не выдавались ошибки)
-        self._session.close()
+        # запрос выполняется в общем цикле событий async_http: отдельная библиотека HTTP-запросов
+        # ради одного запроса не загружается при запуске run_parser
+        return async_http.run_sync(self._parse(validators or {}))
+
+    async def _parse(self, validators: Dict[str, str]) -> Union[None, Tuple[List, Dict[str, str]]]:
+        headers = {}
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+        # отправляем get-запрос на сервер
+        async with async_http.session() as session:
+            async with session.get(self._public_api_address, headers=headers) as response:
+                if response.status == 304:
+                    return None
+                response.raise_for_status()
+                content = await response.read()
+        # сервер может не поддерживать условные запросы, поэтому сравниваем еще и хэш ответа
+        new_validators = {'ETag': response.headers.get('ETag'),
+                          'Last-Modified': response.headers.get('Last-Modified'),
+                          'Hash': hashlib.sha256(content).hexdigest()}
+        if new_validators['Hash'] == validators.get('Hash'):
+            return None
         # Читаем значение json-объекта
-        return result.json()
+        return json.loads(content), new_validators
 
 
 class DodoOpenAPIStorer(DatabaseWorker):
@@ -42,28 +67,71 @@ class DodoOpenAPIStorer(DatabaseWorker):
     def __init__(self, db: Database = None):
         super().__init__(db)
 
-    def store(self, json_: dict):
+    def get_validators(self) -> Dict[str, str]:
+        """
+        Получаем ETag, Last-Modified и хэш последнего сохраненного ответа из таблицы config.
+        :return: словарь {заголовок: значение}
+        """
+        self._db.execute("""
+            SELECT parameter, value
+            FROM config
+            WHERE parameter IN %s;
+        """, (tuple(VALIDATOR_PARAMS.values()),))
+        values = dict(self._db.fetch())
+        return {header: values.get(parameter) for header, parameter in VALIDATOR_PARAMS.items()}
+
+    def _get_units(self) -> Dict[int, Tuple]:
+        """
+        Получаем сохраненные пиццерии.
+        :return: словарь {unit_id: (uuid, unit_name, tz_shift, begin_date_work)}
+        """
+        self._db.execute("""
+            SELECT unit_id, uuid, unit_name, tz_shift, begin_date_work
+            FROM units
+            WHERE country_code = 'ru';
+        """)
+        return {unit_id: tuple(values) for unit_id, *values in self._db.fetch()}
+
+    def store(self, json_: list, validators: Dict[str, str] = None):
         """
         Сохраяем значения словаря в БД (таблица units).
         В ней хранятся данные всех пиццерий (название, id, uuid, часовой пояс).
+        Записываем только новые пиццерии и пиццерии, у которых изменились UUId, Name, TimeZoneShift
+        или BeginDateWork, остальные строки не трогаем.
         :param json_: словарь с параметрами
+        :param validators: ETag, Last-Modified и хэш ответа для следующего условного запроса
         :return: None
         """
+        units = self._get_units()
         params = []
         # Для каждой пиццерии в словаре
         for unit in json_:
             # unit - это словарь
             # если пиццерия запущена и не закрыта:
             if unit['Approve'] and not unit['IsTemporarilyClosed']:
-                # добавляем кортеж с параметрами в список
-                params.append(('ru', unit['Id'], unit['UUId'], unit['Name'], unit['TimeZoneShift'],
-                               unit['BeginDateWork']))
-        query = """INSERT INTO units (country_code, unit_id, uuid, unit_name, tz_shift, begin_date_work) VALUES %s
-                   ON CONFLICT (country_code, unit_id) DO UPDATE
-                   SET (uuid, unit_name, tz_shift, begin_date_work) = 
-                   (EXCLUDED.uuid, EXCLUDED.unit_name, EXCLUDED.tz_shift, EXCLUDED.begin_date_work);"""
-        # И отправляем всё одним запросом на сервер, иначе это занимает очень много времени
-        self._db.execute(query, params)
+                # дата приходит строкой вида 2015-06-01T00:00:00, в БД хранится только дата
+                begin_date_work = date.fromisoformat(unit['BeginDateWork'][:10]) if unit['BeginDateWork'] else None
+                values = (unit['UUId'], unit['Name'], unit['TimeZoneShift'], begin_date_work)
+                if units.get(unit['Id']) != values:
+                    # добавляем кортеж с параметрами в список
+                    params.append(('ru', unit['Id'], *values))
+        print(f'units: {len(params)} changed')
+        if len(params) > 0:
+            query = """INSERT INTO units (country_code, unit_id, uuid, unit_name, tz_shift, begin_date_work) VALUES %s
+                       ON CONFLICT (country_code, unit_id) DO UPDATE
+                       SET (uuid, unit_name, tz_shift, begin_date_work) = 
+                       (EXCLUDED.uuid, EXCLUDED.unit_name, EXCLUDED.tz_shift, EXCLUDED.begin_date_work);"""
+            # И отправляем всё одним запросом на сервер, иначе это занимает очень много времени
+            self._db.execute(query, params)
+
+        # сохраняем ETag, Last-Modified и хэш ответа (значения длиннее поля config.value не сохраняем)
+        for header, parameter in VALIDATOR_PARAMS.items():
+            value = (validators or {}).get(header)
+            if value is not None and len(value) <= 100:
+                self._db.execute("""
+                    INSERT INTO config (parameter, value) VALUES (%s, %s)
+                    ON CONFLICT (parameter) DO UPDATE SET value = EXCLUDED.value;
+                    """, (parameter, value))
 
         # закрываем соединение с БД
         self.db_close()
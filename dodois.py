@@ -1,20 +1,25 @@
+import asyncio
 import io
+import random
 import re
 import time
 from datetime import datetime, timedelta
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
+import aiohttp
+import numpy as np
 import pandas as pd
-import requests
 
 from pandas import CategoricalDtype
+from psycopg2.errors import DeadlockDetected, LockNotAvailable, SerializationFailure
 
+import async_http
 import config
-from psycopg2.errors import StringDataRightTruncation, NumericValueOutOfRange
-from config import CONNECT_TIMEOUT
+import metrics
+from frames import apply_dtypes, concat_frames
 from parser import DatabaseWorker
+from phones import normalize_phones, MOBILE_MIN, MOBILE_MAX
 from postgresql import Database
-from bs4 import BeautifulSoup
 
 
 
@@ -45,9 +50,175 @@ class DodoEmptyExcelError(Exception):
         super().__init__(self.message)
 
 
-class DodoISParser:
+# сохраненные авторизации в Додо ИС: {(логин, uuid пиццерии): [cookies, время последнего успешного запроса]}.
+# Используются всеми парсерами процесса (общий цикл событий async_http), поэтому повторная выгрузка пиццерии
+# (другой отчет, следующий запуск демона) не проходит вход заново, пока авторизация не истекла
+_auth_sessions: Dict[Tuple[str, str], list] = {}
+
+
+def clear_auth_sessions():
+    """
+    Забывает сохраненные авторизации в Додо ИС (например, при перезагрузке демона).
+    :return: None
+    """
+    _auth_sessions.clear()
+
+
+class FramesAggregator:
+    """
+    Накопитель датафреймов отчета: сохраняет все куски и склеивает их в конце (отчеты "Заказы", "Промокоды").
+    """
+    def __init__(self):
+        self._dfs = []
+
+    def add(self, df: pd.DataFrame) -> None:
+        """
+        Добавляет кусок отчета.
+        :param df: обработанный датафрейм
+        :return: None
+        """
+        self._dfs.append(df)
+
+    def result(self) -> pd.DataFrame:
+        """
+        :return: склеенный датафрейм
+        """
+        return concat_frames(self._dfs)
+
+
+class ClientsStatisticAggregator:
+    """
+    Потоковая склейка кусков отчета "Статистика по клиентам" с ограниченной памятью.
+    Каждый кусок сразу сворачивается в состояние: словарь {телефон: номер строки} и массивы столбцов numpy
+    с запасом, которые дописываются и обновляются на месте, поэтому в памяти хранится по одной строке на клиента,
+    а не все куски целиком, и кусок не копирует накопленное состояние. Датафрейм собирается один раз в result.
+    Для каждого клиента:
+     - поля первого заказа (дата, отдел, направление) берутся из первого куска, где встретился телефон,
+     - дата и отдел последнего заказа - из куска с самой поздней датой последнего заказа,
+     - количество и сумма заказов суммируются.
+    Результат совпадает с группировкой всех кусков после сортировки по дате последнего заказа,
+    если поля первого заказа одинаковы во всех кусках (так выгружает Додо ИС).
+    """
+    _phone = '№ телефона'
+    _first_cols = ['Дата первого заказа', 'Отдел первого заказа', 'first_order_type']
+    _last_cols = ['Дата последнего заказа', 'Отдел последнего заказа']
+    _sum_cols = ['Кол-во заказов', 'Сумма заказа']
+
+    def __init__(self):
+        # номер строки состояния для каждого телефона
+        self._positions: Dict[int, int] = {}
+        self._phones: List[int] = []
+        # столбцы состояния - массивы numpy с запасом (емкость растет вдвое), заполнено первые _size строк
+        self._columns: Dict[str, np.ndarray] = {}
+        self._size = 0
+        # типы столбцов первого куска (по ним собирается результат) и объединенные категории
+        self._dtypes: Optional[pd.Series] = None
+        self._phone_dtype = None
+        self._categories: Dict[str, pd.Index] = {}
+
+    @classmethod
+    def _fold_chunk(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Индексирует кусок по телефону и сворачивает повторы телефона внутри куска.
+        """
+        df = df.set_index(cls._phone)
+        if df.index.has_duplicates:
+            df = df.sort_values('Дата последнего заказа', ascending=False, kind='stable')
+            agg_dict = {column: 'first' for column in cls._first_cols + cls._last_cols}
+            agg_dict.update({column: 'sum' for column in cls._sum_cols})
+            df = df.groupby(level=0, observed=True).agg(agg_dict)
+        return df
+
+    def _values(self, chunk: pd.DataFrame, column: str) -> np.ndarray:
+        """
+        Значения столбца куска в виде массива numpy: категории - объектами (категории кусков объединяются),
+        даты с часовым поясом - в UTC без пояса.
+        """
+        series = chunk[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            self._categories[column] = self._categories[column].union(series.cat.categories) \
+                if column in self._categories else series.cat.categories
+            return series.astype(object).to_numpy()
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            return series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+        return series.to_numpy()
+
+    def _reserve(self, size: int, values: Dict[str, np.ndarray]):
+        """
+        Увеличивает емкость столбцов состояния до size строк и расширяет их типы под значения куска.
+        """
+        for column, chunk_values in values.items():
+            array = self._columns.get(column)
+            if array is None:
+                self._columns[column] = np.empty(max(size, 1024), dtype=chunk_values.dtype)
+                continue
+            dtype = np.result_type(array.dtype, chunk_values.dtype)
+            if size > len(array) or dtype != array.dtype:
+                grown = np.empty(max(size, 2 * len(array)) if size > len(array) else len(array), dtype=dtype)
+                grown[:self._size] = array[:self._size]
+                self._columns[column] = grown
+
+    def add(self, df: pd.DataFrame) -> None:
+        """
+        Сворачивает кусок отчета в состояние.
+        :param df: обработанный датафрейм
+        :return: None
+        """
+        chunk = self._fold_chunk(df)
+        if self._dtypes is None:
+            self._dtypes = chunk.dtypes
+            self._phone_dtype = chunk.index.dtype
+        values = {column: self._values(chunk, column) for column in self._first_cols + self._last_cols + self._sum_cols}
+        phones = chunk.index.tolist()
+        positions = np.fromiter((self._positions.get(phone, -1) for phone in phones), dtype=np.int64,
+                                count=len(phones))
+        known = positions >= 0
+        self._reserve(self._size + int((~known).sum()), values)
+
+        # клиенты, которые уже есть в состоянии
+        if known.any():
+            common = positions[known]
+            last_date = 'Дата последнего заказа'
+            newer = values[last_date][known] > self._columns[last_date][common]
+            for column in self._last_cols:
+                self._columns[column][common[newer]] = values[column][known][newer]
+            for column in self._sum_cols:
+                self._columns[column][common] += values[column][known]
+
+        # новые клиенты - в конец состояния
+        new = ~known
+        start, end = self._size, self._size + int(new.sum())
+        for column, chunk_values in values.items():
+            self._columns[column][start:end] = chunk_values[new]
+        new_phones = [phone for phone, is_new in zip(phones, new) if is_new]
+        self._positions.update(zip(new_phones, range(start, end)))
+        self._phones.extend(new_phones)
+        self._size = end
+
+    def result(self) -> pd.DataFrame:
+        """
+        :return: датафрейм по одной строке на клиента, отсортированный по телефону
+        """
+        if self._dtypes is None:
+            raise ValueError('No objects to concatenate')
+        df = pd.DataFrame(index=pd.Index(self._phones, dtype=self._phone_dtype, name=self._phone))
+        for column, dtype in self._dtypes.items():
+            array = self._columns[column][:self._size]
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[column] = pd.Categorical(array, categories=self._categories[column])
+            elif isinstance(dtype, pd.DatetimeTZDtype):
+                df[column] = pd.Series(array, index=df.index).dt.tz_localize('UTC').dt.tz_convert(dtype.tz)
+            else:
+                df[column] = array
+        df = df.sort_index().reset_index()
+        return df[[self._phone] + self._first_cols + self._last_cols + self._sum_cols]
+
+
+class AsyncDodoISParser:
     """
-    Класс для сбора данных из ДОДО ИС с заданными параметрами.
+    Класс для сбора данных из ДОДО ИС с заданными параметрами. Запросы выполняются асинхронно (aiohttp),
+    поэтому выгрузку нескольких пиццерий можно запускать одновременно в одном цикле событий.
+    Синхронная обертка - DodoISParser.
     При инициализации принимает параметры для парсинга одной пиццерии.
     Один экземпляр класса отвечает за доступ только к одной пиццерии. Если нужен доступ к нескольким пиццериям,
     нужно создать несколько экземпляров класса.
@@ -66,7 +237,7 @@ class DodoISParser:
     """
 
     def __init__(self, unit_id: int, uuid: str, unit_name: str, login: str, password: str, tz_shift: int,
-                 start_date: datetime, end_date: datetime, promos: str):
+                 start_date: datetime, end_date: datetime, promos: str, decoder: 'ReportDecoder' = None):
         # заголовки для запроса с авторизацией
         self._headers_auth = {'User-Agent': 'dodoextbot'}
         # данные для входа
@@ -74,14 +245,14 @@ class DodoISParser:
         self._password = password
         self._uuid = uuid
         # адреса страниц
-        self._auth_url = 'https://auth.dodois.io/'
-        self._ofman_url = 'https://officemanager.dodopizza.ru/'
-        # флаг для определения статуса авторизации
+        self._auth_url = config.DODOIS_AUTH_URL
+        self._ofman_url = config.DODOIS_OFFICE_MANAGER_URL
+        # флаг для определения статуса авторизации и признак того, что авторизация взята из _auth_sessions
         self._authorized = False
-        self._session = requests.session()
-        self._session.headers = self._headers_auth
-        # переменная для сохранения результата запроса
-        self._response = None
+        self._reused = False
+        # сессия создается в цикле событий при первом запросе, cookies авторизации хранятся между сессиями
+        self._session = None
+        self._cookie_jar = None
         self._unit_id = unit_id
         self._unit_name = unit_name
         self._start_date = start_date
@@ -90,6 +261,12 @@ class DodoISParser:
         self._promos = promos.split(',')
         # сохраняем значение часовой зоны строкой
         self._this_timezone = config.TIMEZONES[self._tz_shift]
+        # пул процессов для разбора Excel (decoder.ReportDecoder); если None, разбираем в текущем процессе
+        self._decoder = decoder
+        # статистика выгрузки для журнала запусков (ledger.RunLedger)
+        self._stats = {'chunks': 0, 'payload_bytes': 0, 'download_seconds': 0.0, 'decode_seconds': 0.0}
+        # текущий этап выгрузки (download или decode): по нему журнал запусков показывает, где произошла ошибка
+        self._stage = None
 
     @staticmethod
     def _split_time_params(start_date: datetime, end_date: datetime, max_days: int = 30) -> List[Tuple[datetime]]:
@@ -146,19 +323,116 @@ class DodoISParser:
         html = re.sub(r'>[\s]+', '>', html)  # remove whitespaces after closing tags
         return html
 
-    def _auth(self) -> None:
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Возвращает сессию пиццерии поверх общего пула соединений (async_http), создает при необходимости.
+        :return: сессия aiohttp
+        """
+        if self._session is None or self._session.closed:
+            if self._cookie_jar is None:
+                self._cookie_jar = aiohttp.CookieJar(unsafe=True)
+            self._session = async_http.session(cookie_jar=self._cookie_jar, headers=self._headers_auth)
+        return self._session
+
+    def _saved_auth(self) -> Optional[list]:
+        """
+        :return: сохраненная авторизация пиццерии, если она еще действует (см. DODOIS_SESSION_TTL)
+        """
+        saved = _auth_sessions.get((self._login, self._uuid))
+        if saved is not None and time.monotonic() - saved[1] < config.DODOIS_SESSION_TTL:
+            return saved
+        return None
+
+    def _touch_auth(self) -> None:
+        """
+        Отмечает успешный запрос: продлевает сохраненную авторизацию.
+        """
+        if config.DODOIS_SESSION_TTL > 0:
+            _auth_sessions[(self._login, self._uuid)] = [self._cookie_jar, time.monotonic()]
+
+    async def _authorize(self) -> None:
+        """
+        Авторизуется перед запросом: берет сохраненную авторизацию пиццерии или выполняет вход.
+        :return: None
+        """
+        if self._authorized:
+            return
+        saved = self._saved_auth()
+        if saved is not None:
+            await self.close()
+            self._cookie_jar = saved[0]
+            self._authorized = True
+            self._reused = True
+            metrics.observe('dodois_auth_reused', 0.0)
+            return
+        await self._auth()
+        self._touch_auth()
+
+    async def _reauthorize(self) -> None:
+        """
+        Сохраненная авторизация перестала действовать раньше срока: забывает ее и входит заново с новыми cookies.
+        :return: None
+        """
+        _auth_sessions.pop((self._login, self._uuid), None)
+        await self.close()
+        self._cookie_jar = None
+        self._authorized = False
+        self._reused = False
+        await self._authorize()
+
+    async def close(self) -> None:
+        """
+        Закрывает сессию. Cookies авторизации сохраняются, соединения возвращаются в общий пул.
+        :return: None
+        """
+        if self._session is not None:
+            await self._session.close()
+
+    def _cookies(self) -> Dict[str, str]:
+        """
+        Все cookies сессии в виде словаря.
+        """
+        return {morsel.key: morsel.value for morsel in self._cookie_jar}
+
+    @staticmethod
+    def _form(data: Dict) -> List[Tuple[str, str]]:
+        """
+        Преобразует словарь в поля формы: списки - в повторяющиеся поля, значения - в строки.
+        """
+        fields = []
+        for key, value in data.items():
+            for item in (value if isinstance(value, list) else [value]):
+                fields.append((key, str(item)))
+        return fields
+
+    async def _post(self, url: str, data: Dict, cookies: Dict = None) -> Tuple[str, str, Dict[str, str]]:
+        """
+        POST-запрос с формой.
+        :return: кортеж (адрес после редиректов, текст ответа, cookies из ответа)
+        """
+        session = await self._get_session()
+        async with session.post(url, data=self._form(data), cookies=cookies) as response:
+            return (str(response.url), await response.text(),
+                    {key: morsel.value for key, morsel in response.cookies.items()})
+
+    @metrics.timed('dodois_auth')
+    async def _auth(self) -> None:
         """
         Авторизуемся в Додо ИС с текущими параметрами. Авторизация выполняется один раз перед началом запросов.
         Срок действия авторизации в Додо ИС - около 15 минут в случае неактивности.
         :return: None
         """
+        # bs4 нужен только для входа, процессы разбора Excel (decoder) и run_tasker его не загружают
+        from bs4 import BeautifulSoup
 
         try:
             if not self._authorized:
+                session = await self._get_session()
 
                 # Шаг 1
-                response = self._session.get(self._ofman_url)
-                soup = BeautifulSoup(self.bs_preprocess(response.text), 'html.parser')
+                async with session.get(self._ofman_url) as response:
+                    text = await response.text()
+                soup = BeautifulSoup(self.bs_preprocess(text), 'html.parser')
                 r_vals = {'client_id': '', 'redirect_uri': '', 'response_type': '',
                           'scope': '', 'code_challenge': '', 'code_challenge_method': '',
                           'response_mode': '', 'nonce': '', 'state': ''}
@@ -166,19 +440,18 @@ class DodoISParser:
                     r_vals[key] = soup.find(attrs={'name': key})['value']
 
                 # step 2
-                self._session.headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
-                response = self._session.post(self._auth_url + 'connect/authorize', data=r_vals)
-                soup = BeautifulSoup(self.bs_preprocess(response.text), 'html.parser')
+                _, text, response_cookies = await self._post(self._auth_url + 'connect/authorize', data=r_vals)
+                soup = BeautifulSoup(self.bs_preprocess(text), 'html.parser')
                 request_verification_token = soup.find(attrs={'name': '__RequestVerificationToken'})['value']
                 return_url = soup.find(attrs={'name': 'ReturnUrl'})['value']
                 cookie_anti_forg_name = ''
                 cookie_anti_forg_val = ''
-                for cookie in response.cookies.keys():
+                for cookie in response_cookies.keys():
                     if cookie.startswith('.AspNetCore.Antiforgery.'):
                         cookie_anti_forg_name = cookie
-                        cookie_anti_forg_val = response.cookies[cookie]
+                        cookie_anti_forg_val = response_cookies[cookie]
                         break
-                cj = requests.utils.cookiejar_from_dict({cookie_anti_forg_name: cookie_anti_forg_val})
+                cj = {cookie_anti_forg_name: cookie_anti_forg_val}
 
                 # step 3
                 data = {
@@ -192,9 +465,8 @@ class DodoISParser:
                     'RememberLogin': 'false'
                 }
 
-                self._session.headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
-                response = self._session.post(self._auth_url + 'account/login', data=data, cookies=cj)
-                soup = BeautifulSoup(self.bs_preprocess(response.text), 'html.parser')
+                _, text, _ = await self._post(self._auth_url + 'account/login', data=data, cookies=cj)
+                soup = BeautifulSoup(self.bs_preprocess(text), 'html.parser')
                 r_vals = {'code': '', 'scope': '', 'state': '', 'session_state': ''}
                 for key in r_vals.keys():
                     r_vals[key] = soup.find(attrs={'name': key})['value']
@@ -202,7 +474,7 @@ class DodoISParser:
                 cookie_open_id_val = ''
                 cookie_corr_name = ''
                 cookie_corr_val = ''
-                c_dict = self._session.cookies.get_dict()
+                c_dict = self._cookies()
                 for cookie in c_dict.keys():
                     if cookie.startswith('.AspNetCore.OpenIdConnect.Nonce.'):
                         cookie_open_id_name = cookie
@@ -212,61 +484,62 @@ class DodoISParser:
                         cookie_corr_val = c_dict[cookie]
                 cookie_idsrv_s = c_dict['idsrv.session']
                 cookie_idsrv = c_dict['idsrv']
-                cj = requests.utils.cookiejar_from_dict({
+                cj = {
                     cookie_open_id_name: cookie_open_id_val,
                     cookie_corr_name: cookie_corr_val
-                })
+                }
 
                 # step 4
-                response = self._session.post(self._ofman_url + 'signin-oidc', data=r_vals, cookies=cj)
-                if 'OfficeManager/OperationalStatistics' not in response.url:
-                    soup = BeautifulSoup(self.bs_preprocess(response.text), 'html.parser')
+                url, text, response_cookies = await self._post(self._ofman_url + 'signin-oidc', data=r_vals,
+                                                                cookies=cj)
+                if 'OfficeManager/OperationalStatistics' not in url:
+                    soup = BeautifulSoup(self.bs_preprocess(text), 'html.parser')
                     request_verification_token = soup.find(attrs={'name': '__RequestVerificationToken'})['value']
 
                     cookie_anti_forg_name = ''
                     cookie_anti_forg_val = ''
-                    c_dict = self._session.cookies.get_dict()
+                    c_dict = self._cookies()
                     for cookie in c_dict.keys():
                         if cookie.startswith('.AspNetCore.Antiforgery.') and '-' not in cookie:
                             cookie_anti_forg_name = cookie
-                            cookie_anti_forg_val = response.cookies[cookie]
+                            cookie_anti_forg_val = response_cookies[cookie]
                     cookie_oidc_off = c_dict['.AspNetCore.oidc-offmngr-c']
                     cookie_sess_off = c_dict['.AspNetCore.Session.OfficeManager']
-                    cj = requests.utils.cookiejar_from_dict({
+                    cj = {
                         'AspNetCore.oidc-offmngr-c': cookie_oidc_off,
                         cookie_anti_forg_name: cookie_anti_forg_val,
                         '.AspNetCore.Session.OfficeManager': cookie_sess_off
-                    })
+                    }
 
                     # step 5
                     data = {'roleId': 7, '__RequestVerificationToken': request_verification_token}
-                    response = self._session.post(self._ofman_url + 'Infrastructure/Authenticate/SelectRole',
-                                                        data=data, cookies=cj)
-                    if 'OfficeManager/OperationalStatistics' not in response.url:
-                        soup = BeautifulSoup(self.bs_preprocess(response.text), 'html.parser')
+                    url, text, _ = await self._post(self._ofman_url + 'Infrastructure/Authenticate/SelectRole',
+                                                    data=data, cookies=cj)
+                    if 'OfficeManager/OperationalStatistics' not in url:
+                        soup = BeautifulSoup(self.bs_preprocess(text), 'html.parser')
                         request_verification_token = soup.find(attrs={'name': '__RequestVerificationToken'})['value']
-                        cookie_oidc_off = self._session.cookies.get_dict()['.AspNetCore.oidc-offmngr-c']
-                        cj = requests.utils.cookiejar_from_dict({
+                        cookie_oidc_off = self._cookies()['.AspNetCore.oidc-offmngr-c']
+                        cj = {
                             'AspNetCore.oidc-offmngr-c': cookie_oidc_off,
                             cookie_anti_forg_name: cookie_anti_forg_val,
                             '.AspNetCore.Session.OfficeManager': cookie_sess_off
-                        })
+                        }
 
                         # step 6
                         data = {'uuid': self._uuid, '__RequestVerificationToken': request_verification_token}
-                        response = self._session.post(self._ofman_url +
-                                                            'Infrastructure/Authenticate/SelectDepartment',
-                                                            data=data, cookies=cj)
-                    cookie_oidc_off = c_dict = self._session.cookies.get_dict()['.AspNetCore.oidc-offmngr-c']
-                    cj = requests.utils.cookiejar_from_dict({
+                        await self._post(self._ofman_url + 'Infrastructure/Authenticate/SelectDepartment',
+                                         data=data, cookies=cj)
+                    cookie_oidc_off = self._cookies()['.AspNetCore.oidc-offmngr-c']
+                    cj = {
                         'AspNetCore.oidc-offmngr-c': cookie_oidc_off,
                         cookie_anti_forg_name: cookie_anti_forg_val,
                         '.AspNetCore.Session.OfficeManager': cookie_sess_off
-                    })
+                    }
 
                 # send test request to update session cookies
-                self._session.get(self._ofman_url + 'OfficeManager/OperationalStatistics',
-                                        cookies=cj)
+                async with session.get(self._ofman_url + 'OfficeManager/OperationalStatistics',
+                                       cookies=cj) as response:
+                    await response.read()
 
                 self._authorized = True
                 return
@@ -274,43 +547,60 @@ class DodoISParser:
             print(f'Ошибка авторизации для пиццерии {self._unit_id}')
             raise e
 
-    def _parse_clients_statistic(self, **kwargs) -> None:
+    @metrics.timed('dodois_export')
+    async def _export(self, url: str, data: Dict) -> bytes:
         """
-        Парсим отчет "Статистика по клиентам" и сохраняем результат в self._response.
+        Запрашивает выгрузку отчета и возвращает содержимое ответа (Excel-файл).
+        :param url: адрес выгрузки
+        :param data: параметры отчета
+        :return: бинарная строка
+        """
+        session = await self._get_session()
+        async with session.post(url, data=self._form(data)) as response:
+            # истекшая сессия отвечает 401/403 или перенаправляет на страницу входа
+            expired = self._reused and (response.status in (401, 403) or str(response.url).startswith(self._auth_url))
+            if not expired:
+                if not response.ok:
+                    raise DodoResponseError
+                content = await response.read()
+                self._touch_auth()
+                return content
+        await self._reauthorize()
+        return await self._export(url, data)
+
+    async def _parse_clients_statistic(self, **kwargs) -> bytes:
+        """
+        Парсим отчет "Статистика по клиентам" и возвращаем содержимое ответа.
         :param start_date: Начало интервала
         :param end_date: Конец интервала
         Если интервал более 30 дней, необходимо разбить на части. self._split_time_params()
-        :return: None
+        :return: Excel-файл
         """
         # Сначала авторизуемся
-        if not self._authorized:
-            self._auth()
+        await self._authorize()
 
-        # Отправляем запрос к отчету и записываем в атрибут self._response
-        # Ответ ожидается в виде Excel-файла.
-        self._response = self._session.post('https://officemanager.dodopizza.ru/Reports/ClientsStatistic/Export',
+        # Отправляем запрос к отчету, ответ ожидается в виде Excel-файла.
+        return await self._export(self._ofman_url + 'Reports/ClientsStatistic/Export',
                                             data={
                                                 'unitsIds': self._unit_id,
                                                 'beginDate': kwargs['start_date'].strftime('%d.%m.%Y'),
                                                 'endDate': kwargs['end_date'].strftime('%d.%m.%Y'),
                                                 'hidePhoneNumbers': 'false'})
 
-    def _parse_promo(self, **kwargs) -> None:
+    async def _parse_promo(self, **kwargs) -> bytes:
         """
-        Парсим отчет "Расход промо-кодов" и сохраняем результат в self._response.
+        Парсим отчет "Расход промо-кодов" и возвращаем содержимое ответа.
         :param start_date: Начало интервала
         :param end_date: Конец интервала
         :param promos: Список промокодов
         Если интервал более 30 дней, необходимо разбить на части. self._split_time_params()
-        :return: None
+        :return: Excel-файл
         """
         # Сначала авторизуемся
-        if not self._authorized:
-            self._auth()
+        await self._authorize()
 
-        # Отправляем запрос к отчету и записываем в атрибут self._response
-        # Ответ ожидается в виде Excel-файла.
-        self._response = self._session.post('https://officemanager.dodopizza.ru/Reports/PromoCodeUsed/Export',
+        # Отправляем запрос к отчету, ответ ожидается в виде Excel-файла.
+        return await self._export(self._ofman_url + 'Reports/PromoCodeUsed/Export',
                                             data={
                                                 'filterType': '',
                                                 'unitsIds': self._unit_id,
@@ -324,21 +614,19 @@ class DodoISParser:
                                                 'OnlyComposition': 'false'
                                             })
 
-    def _parse_orders(self, **kwargs) -> None:
+    async def _parse_orders(self, **kwargs) -> bytes:
         """
-        Парсим отчет "Заказы" и сохраняем результат в self._response.
+        Парсим отчет "Заказы" и возвращаем содержимое ответа.
         :param start_date: Начало интервала
         :param end_date: Конец интервала
         Если интервал более 30 дней, необходимо разбить на части. self._split_time_params()
-        :return: None
+        :return: Excel-файл
         """
         # Сначала авторизуемся
-        if not self._authorized:
-            self._auth()
+        await self._authorize()
 
-        # Отправляем запрос к отчету и записываем в атрибут self._response
-        # Ответ ожидается в виде Excel-файла.
-        self._response = self._session.post('https://officemanager.dodopizza.ru/Reports/Orders/Export',
+        # Отправляем запрос к отчету, ответ ожидается в виде Excel-файла.
+        return await self._export(self._ofman_url + 'Reports/Orders/Export',
                                             data={
                                                 'filterType': 'AllOrders',
                                                 'unitsIds': self._unit_id,
@@ -348,24 +636,33 @@ class DodoISParser:
                                                 'endDate': kwargs['end_date'].strftime('%d.%m.%Y'),
                                                 'orderTypes': ['Delivery', 'Pickup', 'Stationary']})
 
-    def _read_response(self, skiprows: int) -> pd.DataFrame:
+    @staticmethod
+    @metrics.timed('read_response')
+    def _read_response(content: bytes, skiprows: int, dtypes: Dict[str, str] = None) -> pd.DataFrame:
         """
-        Преобразует ответ в датафрейм pandas.
+        Преобразует содержимое ответа в датафрейм pandas.
+        :param content: Excel-файл
+        :param skiprows: количество строк заголовка отчета, которые нужно пропустить
+        :param dtypes: схема отчета {столбец: тип} (см. frames.apply_dtypes); читаются только эти столбцы.
+        Если схема не задана, читаются все столбцы с типом "object".
         :return: датафрейм.
         """
-        if self._response.ok:
-            result = io.BytesIO(self._response.content)
+        result = io.BytesIO(content)
 
+        if dtypes is None:
             # При чтении вручную сохраняем все в тип "object" - аналог строки в pandas.
-            # Конвертацию в правильные типы произведем позднее.
             return pd.read_excel(result, skiprows=skiprows, dtype='object')
-        else:
-            raise DodoResponseError
+        # Читаем только нужные столбцы и сразу приводим к компактным типам
+        df = pd.read_excel(result, skiprows=skiprows, usecols=list(dtypes), dtype='object')
+        return apply_dtypes(df, dtypes)
 
-    def _process_df_clients_statistics(self, df: pd.DataFrame) -> pd.DataFrame:
+    @staticmethod
+    @metrics.timed('process_df', report='clients_statistic')
+    def _process_df_clients_statistics(df: pd.DataFrame, this_timezone: str) -> pd.DataFrame:
         """
         Обрабатываем сырой датафрейм, применяем фильтры и возвращаем в виде, готовом для записи в БД.
         :param df: сырой датафрейм
+        :param this_timezone: часовой пояс пиццерии
         :return: датафрейм
         """
         if len(df) == 0:
@@ -376,15 +673,15 @@ class DodoISParser:
         df['first_order_type'] = df['Направление первого заказа'].astype(order_type).cat.codes
 
         # Сохраняем tz в даты
-        df['Дата первого заказа'] = df['Дата первого заказа'].dt.tz_localize(self._this_timezone)
-        df['Дата последнего заказа'] = df['Дата последнего заказа'].dt.tz_localize(self._this_timezone)
+        df['Дата первого заказа'] = df['Дата первого заказа'].dt.tz_localize(this_timezone)
+        df['Дата последнего заказа'] = df['Дата последнего заказа'].dt.tz_localize(this_timezone)
 
         # Переводим всё в UTC
         df['Дата первого заказа'] = df['Дата первого заказа'].dt.tz_convert('UTC')
         df['Дата последнего заказа'] = df['Дата последнего заказа'].dt.tz_convert('UTC')
 
         # Номер начинается на +79
-        df = df.drop(df[~df['№ телефона'].str.startswith('+79')].index)
+        df = df[df['№ телефона'].between(MOBILE_MIN, MOBILE_MAX).fillna(False).astype(bool)]
 
         # Удаляем лишние столбцы
         df = df[['№ телефона', 'Дата первого заказа', 'Отдел первого заказа', 'Дата последнего заказа',
@@ -392,20 +689,26 @@ class DodoISParser:
 
         return df
 
-    def _process_df_promo(self, df: pd.DataFrame) -> pd.DataFrame:
+    @staticmethod
+    @metrics.timed('process_df', report='promo')
+    def _process_df_promo(df: pd.DataFrame, this_timezone: str) -> pd.DataFrame:
         """
         Обрабатываем сырой датафрейм, применяем фильтры и возвращаем в виде, готовом для записи в БД.
         :param df: сырой датафрейм
+        :param this_timezone: часовой пояс пиццерии
         :return: датафрейм
         """
         if len(df) == 0:
             raise DodoEmptyExcelError
         return df
 
-    def _process_df_orders(self, df: pd.DataFrame) -> pd.DataFrame:
+    @staticmethod
+    @metrics.timed('process_df', report='orders')
+    def _process_df_orders(df: pd.DataFrame, this_timezone: str) -> pd.DataFrame:
         """
         Обрабатываем сырой датафрейм, применяем фильтры и возвращаем в виде, готовом для записи в БД.
         :param df: сырой датафрейм
+        :param this_timezone: часовой пояс пиццерии
         :return: датафрейм
         """
         if len(df) == 0:
@@ -419,7 +722,7 @@ class DodoISParser:
         df['Статус заказа'] = df['Статус заказа'].astype(status_type).cat.codes
 
         # Сохраняем tz в даты
-        df['Дата'] = df['Дата'].dt.tz_localize(self._this_timezone)
+        df['Дата'] = df['Дата'].dt.tz_localize(this_timezone)
 
         # Переводим всё в UTC
         df['Дата'] = df['Дата'].dt.tz_convert('UTC')
@@ -442,29 +745,14 @@ class DodoISParser:
          - отдел последнего заказа (берем самый поздний),
          - количество заказов (суммируем)
          - сумма заказа (суммируем)
+        Куски сворачиваются по одному (ClientsStatisticAggregator), без общей склейки и сортировки.
         :param dfs: список датафреймов с одинаковыми столбцами
         :return: склеенный датафрейм
         """
-        # сначала склеиваем как есть
-        df = pd.concat(dfs)
-        # сортируем по дате последнего заказа по убыванию
-        df = df.sort_values('Дата последнего заказа', ascending=False)
-        # поля, по которым группируем (уникальные для каждого номера телефона)
-        groupby_cols = ['№ телефона', 'Дата первого заказа', 'Отдел первого заказа', 'first_order_type']
-        # правила агрегирования:
-        # - верхняя дата последнего заказа и отдел последнего заказа: т.к. мы отсортировали по дате,
-        #   первой будет самая поздняя дата и соответствующий ей отдел
-        # - сумма количества заказов
-        # - сумма сумм заказов
-        agg_dict = {
-            'Дата последнего заказа': 'first',
-            'Отдел последнего заказа': 'first',
-            'Кол-во заказов': 'sum',
-            'Сумма заказа': 'sum'
-        }
-        # группируем и возвращаем
-        df = df.groupby(groupby_cols, as_index=False).agg(agg_dict)
-        return df
+        aggregator = ClientsStatisticAggregator()
+        for df in dfs:
+            aggregator.add(df)
+        return aggregator.result()
 
     @staticmethod
     def _concatenate_promo(dfs: List[pd.DataFrame]) -> pd.DataFrame:
@@ -473,7 +761,7 @@ class DodoISParser:
         :param dfs: список датафреймов с одинаковыми столбцами
         :return: склеенный датафрейм
         """
-        df = pd.concat(dfs)
+        df = concat_frames(dfs)
         return df
 
     @staticmethod
@@ -483,31 +771,92 @@ class DodoISParser:
         :param dfs: список датафреймов с одинаковыми столбцами
         :return: склеенный датафрейм
         """
-        df = pd.concat(dfs)
+        df = concat_frames(dfs)
         return df
 
-    def parse(self, report_type: str) -> pd.DataFrame:
+    # методы выгрузки и обработки для каждого типа отчета, aggregator - склейка кусков по мере выгрузки,
+    # rows - количество строк заголовка,
+    # dtypes - читаемые столбцы и их типы (None - все столбцы как object)
+    REPORTS = {'clients_statistic':
+                   {'parser': '_parse_clients_statistic',
+                    'processor': '_process_df_clients_statistics',
+                    'aggregator': ClientsStatisticAggregator,
+                    'rows': 10,
+                    'dtypes': {'№ телефона': 'phone',
+                               'Дата первого заказа': 'datetime64[ns]',
+                               'Отдел первого заказа': 'category',
+                               'Направление первого заказа': 'category',
+                               'Дата последнего заказа': 'datetime64[ns]',
+                               'Отдел последнего заказа': 'category',
+                               'Кол-во заказов': 'int32',
+                               'Сумма заказа': 'int32'}},
+               'promo':
+                   {'parser': '_parse_promo',
+                    'processor': '_process_df_promo',
+                    'aggregator': FramesAggregator,
+                    'rows': 4,
+                    'dtypes': None},
+               'orders':
+                   {'parser': '_parse_orders',
+                    'processor': '_process_df_orders',
+                    'aggregator': FramesAggregator,
+                    'rows': 7,
+                    'dtypes': {'Дата': 'datetime64[ns]',
+                               '№ заказа': 'object',
+                               'Тип заказа': 'category',
+                               'Номер телефона': 'phone',
+                               'Сумма заказа': 'int32',
+                               'Статус заказа': 'category'}}
+               }
+
+    @classmethod
+    def decode(cls, report_type: str, content: bytes, this_timezone: str) -> pd.DataFrame:
+        """
+        Разбор выгруженного Excel-файла: чтение и обработка датафрейма.
+        Не зависит от состояния экземпляра, поэтому может выполняться в отдельном процессе (decoder.ReportDecoder).
+        :param report_type: тип отчета (ключ REPORTS)
+        :param content: Excel-файл
+        :param this_timezone: часовой пояс пиццерии
+        :return: обработанный датафрейм
+        """
+        report = cls.REPORTS[report_type]
+        df = cls._read_response(content, skiprows=report['rows'], dtypes=report['dtypes'])
+        return getattr(cls, report['processor'])(df, this_timezone)
+
+    async def _decode(self, report_type: str, content: bytes) -> pd.DataFrame:
+        """
+        Разбирает Excel-файл в пуле процессов, если он передан при инициализации, иначе в текущем процессе.
+        Разбор выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+        """
+        loop = asyncio.get_running_loop()
+        if self._decoder is not None:
+            return await loop.run_in_executor(None, self._decoder.decode, report_type, content,
+                                              self._this_timezone)
+        return await loop.run_in_executor(None, self.decode, report_type, content, self._this_timezone)
+
+    @property
+    def stats(self) -> Dict:
+        """
+        Статистика выгрузок этого парсера: количество кусков, размер выгруженных файлов в байтах,
+        время выгрузки и разбора в секундах.
+        """
+        return dict(self._stats)
+
+    @property
+    def stage(self) -> Optional[str]:
+        """
+        Этап, на котором находится (или остановилась с ошибкой) выгрузка: download или decode.
+        """
+        return self._stage
+
+    async def parse(self, report_type: str) -> pd.DataFrame:
         """
         Парсинг отчетов
         :return: словарь
         """
-        parse_functions = {'clients_statistic':
-                               {'parser': self._parse_clients_statistic,
-                                'processor': self._process_df_clients_statistics,
-                                'concatenator': self._concatenate_clients_statistic,
-                                'rows': 10},
-                           'promo':
-                               {'parser': self._parse_promo,
-                                'processor': self._process_df_promo,
-                                'concatenator': self._concatenate_promo,
-                                'rows': 4},
-                           'orders':
-                               {'parser': self._parse_orders,
-                                'processor': self._process_df_orders,
-                                'concatenator': self._concatenate_orders,
-                                'rows': 7}
-                           }
-        dfs = []
+        report = self.REPORTS[report_type]
+        # куски сворачиваются по мере выгрузки
+        aggregator = report['aggregator']()
         # делим общий интервал на субинтервалы
         for start_date, end_date in self._split_time_params(self._start_date, self._end_date):
             # print(f'parsing from {start_date:%d.%m.%Y} to {end_date:%d.%m.%Y}')
@@ -518,11 +867,20 @@ class DodoISParser:
                     attempts -= 5
                     try:
                         # парсим отчет с субинтервалом в качестве начала и конца
-                        parse_functions[report_type]['parser'](start_date=start_date, end_date=end_date, promo=promo)
-                        # читаем и получаем датафрейм
-                        df = self._read_response(skiprows=parse_functions[report_type]['rows'])
-                        # добавляем к списку
-                        dfs.append(parse_functions[report_type]['processor'](df))
+                        started = time.perf_counter()
+                        self._stage = 'download'
+                        content = await getattr(self, report['parser'])(start_date=start_date, end_date=end_date,
+                                                                        promo=promo)
+                        downloaded = time.perf_counter()
+                        # читаем, обрабатываем и добавляем датафрейм к накопителю
+                        self._stage = 'decode'
+                        df = await self._decode(report_type, content)
+                        with metrics.span('concatenate', report=report_type):
+                            aggregator.add(df)
+                        self._stats['download_seconds'] += downloaded - started
+                        self._stats['decode_seconds'] += time.perf_counter() - downloaded
+                        self._stats['chunks'] += 1
+                        self._stats['payload_bytes'] += len(content)
                         attempts = 0  # если всё получилось и исключение не сработало, обнуляем счетчик попыток сразу
                     except DodoEmptyExcelError:
                         # ничего не делаем, логируем, пробуем дальше
@@ -537,56 +895,121 @@ class DodoISParser:
                                 # если это была последняя попытка, выкидываем ошибку
                                 raise DodoEmptyExcelError
                             # в противном случае спим 2 секунды и пробуем заново
-                            time.sleep(2)
+                            await asyncio.sleep(2)
                     except Exception as e:
                         # если вылезло другое исключение, выкидываем ошибку, если последняя попытка, или спим
                         if attempts == 0:
                             raise e
-                        time.sleep(2)
+                        await asyncio.sleep(2)
         # закрываем сессию и возвращаем датафрейм
-        self._session.close()
-        return parse_functions[report_type]['concatenator'](dfs)
+        await self.close()
+        with metrics.span('concatenate', report=report_type):
+            return aggregator.result()
+
+
+class DodoISParser(AsyncDodoISParser):
+    """
+    Синхронная обертка над AsyncDodoISParser: запросы выполняются в общем цикле событий модуля async_http.
+    Параметры те же, что у AsyncDodoISParser.
+    """
+
+    def parse(self, report_type: str) -> pd.DataFrame:
+        """
+        Парсинг отчетов
+        :return: датафрейм
+        """
+        return async_http.run_sync(super().parse(report_type))
 
 
 class DodoISStorer(DatabaseWorker):
     """
     Класс записывает результат парсинга в датафрейме в БД в таблицу clients.
+    Один телефон может быть у клиентов нескольких пиццерий, поэтому пиццерии, которые записываются одновременно,
+    обновляют одни и те же строки clients. Чтобы они не блокировали друг друга взаимно, строки clients записываются
+    пачками в порядке возрастания телефона (все писатели блокируют строки в одном порядке), а пачка, на которой
+    Postgres все же обнаружил взаимную блокировку, откатывается до точки сохранения и повторяется.
     """
-    def __init__(self, id_: int, db: Database = None):
+    UPSERT_CLIENTS = """INSERT INTO clients (db_unit_id, phone, first_order_datetime, first_order_city, 
+                       last_order_datetime, last_order_city, first_order_type, orders_amt, orders_sum,
+                       sms_text, sms_text_city, ftp_path_city) VALUES %s
+                       ON CONFLICT (phone) DO UPDATE
+                       SET (db_unit_id, last_order_datetime, last_order_city, orders_amt, orders_sum) = 
+                       (EXCLUDED.db_unit_id, EXCLUDED.last_order_datetime, EXCLUDED.last_order_city, 
+                       EXCLUDED.orders_amt + clients.orders_amt, EXCLUDED.orders_sum + clients.orders_sum)
+                       WHERE EXCLUDED.last_order_datetime > clients.last_order_datetime;
+                       """
+    # ошибки блокировок, после которых пачку можно повторить
+    RETRYABLE_ERRORS = (DeadlockDetected, SerializationFailure, LockNotAvailable)
+
+    def __init__(self, id_: int, db: Database = None, commit_batches: bool = None):
+        """
+        :param id_: id пиццерии (units.id)
+        :param db: открытое соединение с БД (см. DatabaseWorker)
+        :param commit_batches: фиксировать каждую пачку клиентов, по умолчанию config.CLIENTS_UPSERT_COMMIT
+        """
         super().__init__(db)
         self._id = id_
+        self._commit_batches = config.CLIENTS_UPSERT_COMMIT if commit_batches is None else commit_batches
 
-    def store(self, df_clients: pd.DataFrame, df_orders: pd.DataFrame):
+    def _write_batches(self, query: str, rows: List, write: Callable[[List], None]):
+        """
+        Записывает строки пачками по CLIENTS_UPSERT_BATCH. Каждая пачка выполняется в своей точке сохранения:
+        при взаимной блокировке (или ошибке сериализации) откатывается и повторяется только эта пачка,
+        с растущей случайной паузой, до CLIENTS_UPSERT_ATTEMPTS раз.
+        :param query: название запроса для метрик
+        :param rows: строки, отсортированные по телефону
+        :param write: функция записи одной пачки
+        :return: None
+        """
+        size = config.CLIENTS_UPSERT_BATCH
+        for start in range(0, len(rows), size):
+            batch = rows[start:start + size]
+            for attempt in range(1, config.CLIENTS_UPSERT_ATTEMPTS + 1):
+                self._db.savepoint('clients_batch')
+                try:
+                    # ошибки этапа clients_batch в метриках - повторы пачек
+                    with metrics.span('clients_batch', query=query):
+                        write(batch)
+                except self.RETRYABLE_ERRORS as e:
+                    self._db.rollback_to_savepoint('clients_batch')
+                    if attempt == config.CLIENTS_UPSERT_ATTEMPTS:
+                        raise e
+                    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+                    continue
+                self._db.release_savepoint('clients_batch')
+                if self._commit_batches:
+                    self._db.commit()
+                break
+
+    @metrics.timed('store')
+    def store(self, df_clients: pd.DataFrame, df_orders: pd.DataFrame, derive_clients: bool = False):
         """
         Записываем построчно результат из датафрейма в БД.
         Предполагаем, что датафрейм уже подготовленный.
-        :param df: датафрейм с результатами
+        :param df_clients: датафрейм со статистикой по клиентам или None
+        :param df_orders: датафрейм с заказами или None
+        :param derive_clients: пересчитать клиентов из таблицы orders по телефонам из df_orders
+        (режим CLIENTS_SOURCE = 'orders')
         :return: None
         """
         # клиентская статистика
         if df_clients is not None:
-            params = []
-            for row in df_clients.iterrows():
-                params.append((self._id, row[1]['№ телефона'], row[1]['Дата первого заказа'],
-                               row[1]['Отдел первого заказа'], row[1]['Дата последнего заказа'],
-                               row[1]['Отдел последнего заказа'], row[1]['first_order_type'],
-                               row[1]['Кол-во заказов'], row[1]['Сумма заказа'], '', '', ''))
-            query = """INSERT INTO clients (db_unit_id, phone, first_order_datetime, first_order_city, 
-                       last_order_datetime, last_order_city, first_order_type, orders_amt, orders_sum,
-                       sms_text, sms_text_city, ftp_path_city) VALUES %s
-                       ON CONFLICT (phone) DO UPDATE
-                       SET (db_unit_id, last_order_datetime, last_order_city, orders_amt, orders_sum) = 
-                       (EXCLUDED.db_unit_id, EXCLUDED.last_order_datetime, EXCLUDED.last_order_city, 
-                       EXCLUDED.orders_amt + clients.orders_amt, EXCLUDED.orders_sum + clients.orders_sum)
-                       WHERE EXCLUDED.last_order_datetime > clients.last_order_datetime;
-                       """
-            self._db.execute(query, params)
+            df = df_clients[['№ телефона', 'Дата первого заказа', 'Отдел первого заказа', 'Дата последнего заказа',
+                             'Отдел последнего заказа', 'first_order_type', 'Кол-во заказов', 'Сумма заказа']].copy()
+            df['№ телефона'] = normalize_phones(df['№ телефона'])
+            df = df.dropna(subset=['№ телефона'])
+            # по возрастанию телефона; разные записи телефона после нормализации сворачиваются в строку с самым
+            # поздним последним заказом (один INSERT ... ON CONFLICT не может обновить строку дважды)
+            df = df.sort_values(['№ телефона', 'Дата последнего заказа'], na_position='first', kind='stable')
+            df = df.drop_duplicates('№ телефона', keep='last')
+            params = [(self._id, *row, '', '', '') for row in self._to_params(df)]
+            self._write_batches('clients', params, lambda batch: self._db.execute(self.UPSERT_CLIENTS, batch))
 
         # заказы
         if df_orders is not None:
-            params = []
-            for row in df_orders.iterrows():
-                params.append((self._id, *row[1]))
+            df_orders = df_orders.copy()
+            df_orders['Номер телефона'] = normalize_phones(df_orders['Номер телефона'])
+            params = [(self._id, *row) for row in self._to_params(df_orders)]
             query = """INSERT INTO orders (
                             db_unit_id, date, order_id, order_type, phone, order_sum, status
                        ) VALUES %s 
@@ -594,6 +1017,10 @@ class DodoISStorer(DatabaseWorker):
                     """
             self._db.execute(query, params)
 
+            # клиенты из заказов: пересчитываем только тех, у кого появились заказы
+            if derive_clients and len(df_orders) > 0:
+                self.update_clients_from_orders([int(phone) for phone in df_orders['Номер телефона'].dropna().unique()])
+
         # записываем дату последнего обновления в таблицу auth
         if df_clients is not None or df_orders is not None:
             self._db.execute("""
@@ -604,3 +1031,119 @@ class DodoISStorer(DatabaseWorker):
 
         # закрываем соединение, если открывали
         self.db_close()
+
+    @staticmethod
+    def _to_params(df: pd.DataFrame) -> List[Tuple]:
+        """
+        Преобразует датафрейм в список кортежей для записи в БД: значения numpy/pandas - в типы Python,
+        пропуски - в None.
+        """
+        return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+    def update_clients_from_orders(self, phones: List[int] = None):
+        """
+        Пересчитывает строки таблицы clients по таблице orders.
+        Для каждого телефона заново считаются все поля по всей истории заказов (из всех пиццерий), поэтому
+        повторный пересчет не задваивает количество и сумму заказов.
+        - первый заказ: дата, отдел (название пиццерии) и тип самого раннего заказа;
+        - последний заказ: дата и отдел самого позднего заказа, db_unit_id - пиццерия последнего заказа;
+        - количество и сумма - по всем заказам, кроме отказов.
+        Поля отличаются от отчета "Статистика по клиентам", если история заказов в БД неполная.
+        Телефоны пересчитываются пачками по возрастанию, как в store.
+        :param phones: список телефонов для пересчета; если None - пересчитываем всю таблицу clients.
+        :return: None
+        """
+        if phones is None:
+            self._update_clients_from_orders(None)
+        else:
+            self._write_batches('clients_from_orders', sorted(phones), self._update_clients_from_orders)
+
+    def _update_clients_from_orders(self, phones: Optional[List[int]]):
+        phones_filter = 'AND o.phone = ANY(%s)' if phones is not None else ''
+        params = (MOBILE_MIN, MOBILE_MAX) + ((phones,) if phones is not None else ())
+        self._db.execute(f"""
+            WITH o AS (
+                SELECT o.db_unit_id, o.date, o.order_type, o.phone, o.order_sum, u.unit_name
+                FROM orders o
+                JOIN units u ON u.id = o.db_unit_id
+                WHERE o.status <> 1  -- 1 - Отказ
+                    AND o.phone BETWEEN %s AND %s
+                    {phones_filter}
+            ),
+            firsts AS (
+                SELECT DISTINCT ON (phone) phone, date, unit_name, order_type
+                FROM o
+                ORDER BY phone, date
+            ),
+            lasts AS (
+                SELECT DISTINCT ON (phone) phone, db_unit_id, date, unit_name
+                FROM o
+                ORDER BY phone, date DESC
+            ),
+            totals AS (
+                SELECT phone, count(*) AS orders_amt, sum(order_sum) AS orders_sum
+                FROM o
+                GROUP BY phone
+            )
+            INSERT INTO clients (db_unit_id, phone, first_order_datetime, first_order_city, 
+                last_order_datetime, last_order_city, first_order_type, orders_amt, orders_sum,
+                sms_text, sms_text_city, ftp_path_city)
+            SELECT l.db_unit_id, t.phone, f.date, f.unit_name, l.date, l.unit_name, f.order_type,
+                t.orders_amt, t.orders_sum, '', '', ''
+            FROM totals t
+            JOIN firsts f ON f.phone = t.phone
+            JOIN lasts l ON l.phone = t.phone
+            ORDER BY t.phone
+            ON CONFLICT (phone) DO UPDATE
+            SET (db_unit_id, first_order_datetime, first_order_city, last_order_datetime, last_order_city,
+                 first_order_type, orders_amt, orders_sum) = 
+            (EXCLUDED.db_unit_id, EXCLUDED.first_order_datetime, EXCLUDED.first_order_city, 
+             EXCLUDED.last_order_datetime, EXCLUDED.last_order_city, EXCLUDED.first_order_type,
+             EXCLUDED.orders_amt, EXCLUDED.orders_sum);
+        """, params)
+
+    def reconcile(self, df_clients: pd.DataFrame, df_orders: pd.DataFrame) -> Dict[str, int]:
+        """
+        Сверка клиентов, посчитанных из заказов, с выгруженным отчетом "Статистика по клиентам".
+        Оба датафрейма должны быть выгружены за один и тот же период.
+        Количество, сумма и дата последнего заказа сравниваются с заказами за этот период (df_orders),
+        поля первого заказа - с таблицей clients (вызывать после store(..., derive_clients=True)).
+        :param df_clients: обработанный отчет "Статистика по клиентам"
+        :param df_orders: обработанный отчет "Заказы" за тот же период
+        :return: словарь: количество сверенных телефонов и количество расхождений по каждому полю
+        """
+        # агрегаты из заказов за период
+        orders = df_orders.assign(phone=normalize_phones(df_orders['Номер телефона']))
+        orders = orders[(orders['Статус заказа'] != 1) & orders['phone'].between(MOBILE_MIN, MOBILE_MAX)]
+        from_orders = orders.groupby('phone').agg(
+            orders_amt=('№ заказа', 'count'),
+            orders_sum=('Сумма заказа', 'sum'),
+            last_order_datetime=('Дата', 'max'))
+
+        # поля первого заказа из таблицы clients
+        sample = df_clients.assign(phone=normalize_phones(df_clients['№ телефона'])).dropna(subset=['phone'])
+        sample = sample.set_index('phone')
+        phones = [int(phone) for phone in sample.index]
+        self._db.execute("""
+            SELECT phone, first_order_datetime, first_order_city, first_order_type
+            FROM clients
+            WHERE phone = ANY(%s);
+        """, (phones,))
+        from_db = pd.DataFrame(self._db.fetch(), columns=[
+            'phone', 'first_order_datetime', 'first_order_city', 'first_order_type'
+        ]).astype({'phone': 'Int64'}).set_index('phone')
+
+        derived = from_orders.join(from_db, how='outer').reindex(sample.index)
+        checks = {
+            'orders_amt': sample['Кол-во заказов'].astype('float') != derived['orders_amt'].astype('float'),
+            'orders_sum': sample['Сумма заказа'].astype('float') != derived['orders_sum'].astype('float'),
+            'last_order_datetime': sample['Дата последнего заказа'] != derived['last_order_datetime'],
+            'first_order_datetime': sample['Дата первого заказа'] != derived['first_order_datetime'],
+            'first_order_city': sample['Отдел первого заказа'] != derived['first_order_city'],
+            'first_order_type': sample['first_order_type'].astype('float') !=
+                                derived['first_order_type'].astype('float'),
+        }
+        result = {'phones': len(sample)}
+        for field, mismatch in checks.items():
+            result[field] = int(mismatch.sum())
+        return result
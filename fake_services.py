@@ -0,0 +1,306 @@
+"""
+Локальные тестовые серверы Додо ИС, публичного API Dodo, Яндекс.Диска и Telegram Bot API в одном приложении aiohttp.
+Нужны для запуска run_parser, run_custom и run_tasker без доступа к настоящим сервисам (см. load_harness.py).
+Адреса для config (BASE - адрес сервера, например http://127.0.0.1:8900):
+    DODOIS_AUTH_URL=BASE/auth/
+    DODOIS_OFFICE_MANAGER_URL=BASE/ofman/
+    DODO_PUBLIC_API_URL=BASE/publicapi/unitinfo
+    YANDEX_API_URL=BASE/yandex/resources
+    TG_API_URL=BASE/telegram/
+Сервер повторяет вход через форму OIDC (шаги и cookies, которые ожидает AsyncDodoISParser._auth), отдает
+синтетические Excel-выгрузки (synthetic.py) за запрошенный период с заданной задержкой и долей ошибок,
+список пиццерий unitinfo с ETag, принимает файлы Яндекс.Диска и сообщения бота. Счетчики - GET /_stats.
+
+Запуск: python fake_services.py --port 8900 --units 1000 --rows 200 --latency 0.05 --failure-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Dict
+
+from aiohttp import web
+
+import synthetic
+
+# отчеты Додо ИС: {путь выгрузки: тип отчета synthetic}
+EXPORTS = {'ClientsStatistic': 'clients_statistic', 'Orders': 'orders', 'PromoCodeUsed': 'promo'}
+# cookie сессии офиса менеджера, без нее выгрузка отвечает 401
+SESSION_COOKIE = '.AspNetCore.Session.OfficeManager'
+STOP_LIST_PATH = '/main_base/MainBase.xlsm'
+
+
+def _form(fields: Dict[str, str], action: str = '') -> str:
+    inputs = ''.join(f'<input type="hidden" name="{name}" value="{value}"/>' for name, value in fields.items())
+    return f'<html><body><form method="post" action="{action}">{inputs}</form></body></html>'
+
+
+def _html(text: str) -> web.Response:
+    return web.Response(text=text, content_type='text/html')
+
+
+class FakeServices:
+    """
+    Состояние тестовых серверов: пиццерии, файлы Диска, счетчики запросов.
+    """
+    def __init__(self, units: int = 1000, rows: int = 200, latency: float = 0.05, failure_rate: float = 0.0,
+                 upload_failure_rate: float = 0.0, history_days: int = 90, phone_pool: int = None,
+                 stop_list_rows: int = 1000, seed: int = 0):
+        """
+        :param units: количество пиццерий в unitinfo
+        :param rows: строк в одной выгрузке (за период до 30 дней)
+        :param latency: средняя задержка ответа выгрузки в секундах (экспоненциальное распределение)
+        :param failure_rate: доля выгрузок, которые отвечают 500
+        :param upload_failure_rate: доля выгрузок файлов на Диск, которые отвечают 503
+        :param history_days: сколько дней назад пиццерии начали работу (длина первой выгрузки)
+        :param phone_pool: количество разных телефонов во всех выгрузках, по умолчанию units * rows
+        :param stop_list_rows: строк в файле обзвоненных клиентов
+        :param seed: зерно генератора
+        """
+        self._rows = rows
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._upload_failure_rate = upload_failure_rate
+        self._phone_pool = phone_pool or units * rows
+        self._random = random.Random(seed)
+        begin = (date.today() - timedelta(days=history_days)).isoformat() + 'T00:00:00'
+        self.units = [{'Id': 1000 + i, 'UUId': uuid.UUID(int=i + 1).hex, 'Name': f'Тест {i // 10 + 1}-{i % 10 + 1}',
+                       'TimeZoneShift': 3 if i % 4 else 5, 'BeginDateWork': begin, 'Approve': True,
+                       'IsTemporarilyClosed': False, 'CountryCode': 'ru'} for i in range(units)]
+        self._unit_names = {unit['Id']: unit['Name'] for unit in self.units}
+        self._unitinfo = json.dumps(self.units, ensure_ascii=False).encode()
+        self._unitinfo_etag = '"' + hashlib.md5(self._unitinfo).hexdigest() + '"'
+        # Яндекс.Диск: папки и размеры файлов; содержимое хранится только у файла обзвоненных
+        self.folders = {'/main_base'}
+        self.files = {STOP_LIST_PATH: len(b'')}
+        self._stop_list = synthetic.stop_list_workbook(stop_list_rows, seed, phone_pool=self._phone_pool)
+        self.files[STOP_LIST_PATH] = len(self._stop_list)
+        self.stats = Counter()
+
+    async def _delay(self):
+        if self._latency > 0:
+            await asyncio.sleep(self._random.expovariate(1 / self._latency))
+
+    # --- Додо ИС: вход через форму OIDC ---
+
+    async def office_manager(self, request: web.Request) -> web.Response:
+        # шаг 1: страница входа с параметрами авторизации
+        self.stats['auth_start'] += 1
+        return _html(_form({'client_id': 'officemanager', 'redirect_uri': 'signin-oidc', 'response_type': 'code',
+                            'scope': 'openid', 'code_challenge': 'challenge', 'code_challenge_method': 'S256',
+                            'response_mode': 'form_post', 'nonce': uuid.uuid4().hex, 'state': uuid.uuid4().hex}))
+
+    async def authorize(self, request: web.Request) -> web.Response:
+        # шаг 2: форма логина и cookie защиты от подделки (в имени есть "-", как у настоящего сервера)
+        response = _html(_form({'__RequestVerificationToken': uuid.uuid4().hex, 'ReturnUrl': '/connect/callback'}))
+        response.set_cookie('.AspNetCore.Antiforgery.auth-' + uuid.uuid4().hex[:8], uuid.uuid4().hex)
+        return response
+
+    async def login(self, request: web.Request) -> web.Response:
+        # шаг 3: проверка логина, cookies сеанса и форма с кодом авторизации
+        data = await request.post()
+        if not data.get('Username') or data.get('Password') == 'wrong':
+            self.stats['auth_failed'] += 1
+            return _html(_form({'__RequestVerificationToken': uuid.uuid4().hex, 'ReturnUrl': '/connect/callback'}))
+        response = _html(_form({'code': uuid.uuid4().hex, 'scope': 'openid', 'state': uuid.uuid4().hex,
+                                'session_state': uuid.uuid4().hex}))
+        response.set_cookie('.AspNetCore.OpenIdConnect.Nonce.' + uuid.uuid4().hex[:8], 'N')
+        response.set_cookie('.AspNetCore.Correlation.' + uuid.uuid4().hex[:8], 'C')
+        response.set_cookie('idsrv.session', uuid.uuid4().hex)
+        response.set_cookie('idsrv', uuid.uuid4().hex)
+        return response
+
+    async def signin_oidc(self, request: web.Request) -> web.Response:
+        # шаг 4: выбор роли, cookies офиса менеджера
+        response = _html(_form({'__RequestVerificationToken': uuid.uuid4().hex}))
+        response.set_cookie('.AspNetCore.Antiforgery.offmngr', uuid.uuid4().hex)
+        response.set_cookie('.AspNetCore.oidc-offmngr-c', uuid.uuid4().hex)
+        response.set_cookie(SESSION_COOKIE, uuid.uuid4().hex)
+        return response
+
+    async def select_role(self, request: web.Request) -> web.Response:
+        # шаг 5: выбор пиццерии
+        return _html(_form({'__RequestVerificationToken': uuid.uuid4().hex}))
+
+    async def select_department(self, request: web.Request) -> web.Response:
+        # шаг 6: вход завершен
+        self.stats['auth_ok'] += 1
+        raise web.HTTPFound(request.app.router['operational_statistics'].url_for())
+
+    async def operational_statistics(self, request: web.Request) -> web.Response:
+        return _html('<html><body>OperationalStatistics</body></html>')
+
+    # --- Додо ИС: выгрузки ---
+
+    async def export(self, request: web.Request) -> web.Response:
+        report_type = EXPORTS[request.match_info['report']]
+        self.stats[f'export_{report_type}'] += 1
+        if SESSION_COOKIE not in request.cookies:
+            self.stats['export_unauthorized'] += 1
+            return web.Response(status=401)
+        data = await request.post()
+        await self._delay()
+        if self._random.random() < self._failure_rate:
+            self.stats['export_failed'] += 1
+            return web.Response(status=500, text='Internal Server Error')
+        unit_id = int(data['unitsIds'])
+        start = datetime.strptime(data['beginDate'], '%d.%m.%Y')
+        end = datetime.strptime(data['endDate'], '%d.%m.%Y') + timedelta(days=1) - timedelta(seconds=1)
+        seed = unit_id * 100000 + start.toordinal() % 100000
+        loop = asyncio.get_running_loop()
+        # генерация Excel загружает процессор, поэтому выполняется вне цикла событий
+        content = await loop.run_in_executor(None, lambda: synthetic.to_excel(
+            report_type,
+            synthetic.FRAMES[report_type](self._rows, seed, start=start, end=end, phone_pool=self._phone_pool,
+                                          departments=[self._unit_names.get(unit_id, 'Тест')]),
+            unit_name=self._unit_names.get(unit_id, 'Тест')))
+        self.stats['export_bytes'] += len(content)
+        return web.Response(body=content,
+                            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    # --- публичный API Dodo ---
+
+    async def unitinfo(self, request: web.Request) -> web.Response:
+        self.stats['unitinfo'] += 1
+        if request.headers.get('If-None-Match') == self._unitinfo_etag:
+            self.stats['unitinfo_not_modified'] += 1
+            return web.Response(status=304)
+        return web.Response(body=self._unitinfo, content_type='application/json',
+                            headers={'ETag': self._unitinfo_etag})
+
+    # --- Яндекс.Диск ---
+
+    def _json(self, data: Dict, status: int = 200) -> web.Response:
+        return web.json_response(data, status=status)
+
+    async def resource_meta(self, request: web.Request) -> web.Response:
+        path = request.query['path']
+        self.stats['disk_meta'] += 1
+        if path in self.folders:
+            return self._json({'path': f'disk:{path}', 'type': 'dir'})
+        if path in self.files:
+            meta = {'path': f'disk:{path}', 'type': 'file', 'size': self.files[path],
+                    'modified': '2024-01-31T12:00:00+00:00'}
+            if path == STOP_LIST_PATH:
+                meta['md5'] = hashlib.md5(self._stop_list).hexdigest()
+            return self._json(meta)
+        return self._json({'error': 'DiskNotFoundError', 'description': 'Resource not found.'}, status=404)
+
+    async def create_folder(self, request: web.Request) -> web.Response:
+        path = request.query['path']
+        self.stats['disk_create_folder'] += 1
+        if path in self.folders:
+            return self._json({'error': 'DiskPathPointsToExistentDirectoryError'}, status=409)
+        self.folders.add(path)
+        return self._json({'href': str(request.url), 'method': 'GET'}, status=201)
+
+    async def upload_link(self, request: web.Request) -> web.Response:
+        path = request.query['path']
+        self.stats['disk_upload_link'] += 1
+        if path.rsplit('/', 1)[0] not in self.folders:
+            return self._json({'error': 'DiskPathDoesntExistsError'}, status=409)
+        href = request.url.with_path(str(request.app.router['disk_upload'].url_for())).with_query(path=path)
+        return self._json({'href': str(href), 'method': 'PUT', 'templated': False})
+
+    async def upload(self, request: web.Request) -> web.Response:
+        await self._delay()
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        if self._random.random() < self._upload_failure_rate:
+            self.stats['disk_upload_failed'] += 1
+            return web.Response(status=503)
+        self.files[request.query['path']] = size
+        self.stats['disk_uploads'] += 1
+        self.stats['disk_upload_bytes'] += size
+        return web.Response(status=201)
+
+    async def download_link(self, request: web.Request) -> web.Response:
+        path = request.query['path']
+        if path != STOP_LIST_PATH:
+            return self._json({'error': 'DiskNotFoundError'}, status=404)
+        href = request.url.with_path(str(request.app.router['disk_file'].url_for())).with_query(path=path)
+        return self._json({'href': str(href), 'method': 'GET'})
+
+    async def download(self, request: web.Request) -> web.Response:
+        self.stats['disk_downloads'] += 1
+        return web.Response(body=self._stop_list)
+
+    # --- Telegram Bot API ---
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        self.stats['telegram_messages'] += 1
+        self.stats['telegram_bytes'] += len(data.get('text', '').encode())
+        return self._json({'ok': True, 'result': {'message_id': self.stats['telegram_messages']}})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return self._json(dict(self.stats))
+
+    def app(self) -> web.Application:
+        """
+        :return: приложение aiohttp со всеми тестовыми серверами
+        """
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes([
+            web.get('/ofman/', self.office_manager),
+            web.post('/auth/connect/authorize', self.authorize),
+            web.post('/auth/account/login', self.login),
+            web.post('/ofman/signin-oidc', self.signin_oidc),
+            web.post('/ofman/Infrastructure/Authenticate/SelectRole', self.select_role),
+            web.post('/ofman/Infrastructure/Authenticate/SelectDepartment', self.select_department),
+            web.get('/ofman/OfficeManager/OperationalStatistics', self.operational_statistics,
+                    name='operational_statistics'),
+            web.post('/ofman/Reports/{report}/Export', self.export),
+            web.get('/publicapi/unitinfo', self.unitinfo),
+            web.get('/yandex/resources', self.resource_meta),
+            web.put('/yandex/resources', self.create_folder),
+            web.get('/yandex/resources/upload', self.upload_link),
+            web.put('/yandex/upload', self.upload, name='disk_upload'),
+            web.get('/yandex/resources/download', self.download_link),
+            web.get('/yandex/files', self.download, name='disk_file'),
+            web.post('/telegram/{bot}/sendMessage', self.send_message),
+            web.get('/_stats', self.get_stats),
+        ])
+        return app
+
+
+def urls(base: str) -> Dict[str, str]:
+    """
+    Переменные окружения config для работы с тестовыми серверами.
+    :param base: адрес сервера, например http://127.0.0.1:8900
+    :return: {переменная: адрес}
+    """
+    return {'DODOIS_AUTH_URL': f'{base}/auth/',
+            'DODOIS_OFFICE_MANAGER_URL': f'{base}/ofman/',
+            'DODO_PUBLIC_API_URL': f'{base}/publicapi/unitinfo',
+            'YANDEX_API_URL': f'{base}/yandex/resources',
+            'TG_API_URL': f'{base}/telegram/'}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Тестовые серверы Додо ИС, Яндекс.Диска и Telegram')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8900)
+    arg_parser.add_argument('--units', type=int, default=1000)
+    arg_parser.add_argument('--rows', type=int, default=200, help='строк в одной выгрузке')
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка выгрузки, с')
+    arg_parser.add_argument('--failure-rate', type=float, default=0.0, help='доля выгрузок с ошибкой 500')
+    arg_parser.add_argument('--upload-failure-rate', type=float, default=0.0, help='доля выгрузок на Диск с 503')
+    arg_parser.add_argument('--history-days', type=int, default=90)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    services = FakeServices(units=args.units, rows=args.rows, latency=args.latency, failure_rate=args.failure_rate,
+                            upload_failure_rate=args.upload_failure_rate, history_days=args.history_days,
+                            seed=args.seed)
+    print(json.dumps(urls(f'http://{args.host}:{args.port}'), indent=2))
+    web.run_app(services.app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
+import io
 from datetime import datetime, timezone
 from typing import Union, Tuple
 
 import pandas as pd
 
 from parser import DatabaseWorker
+from phones import normalize_phones
 from postgresql import Database
 from storage import YandexDisk
 
+# столбцы файла обзвоненных, которые нужны для стоп-листа
+STOP_LIST_COLUMNS = ['Телефон', 'Дата завершения', 'forbiden']
+
 
 class FeedbackParser:
     """
@@ -18,17 +23,22 @@ class FeedbackParser:
         """
         self._storage = YandexDisk()
 
-    def parse(self, last_modified_date: Union[str, None]) -> Union[None, Tuple[datetime, pd.DataFrame]]:
+    def parse(self, last_modified_date: Union[str, None],
+              last_md5: str = None) -> Union[None, Tuple[datetime, pd.DataFrame, str]]:
         """
-        Получаем файл из хранилища, считываем дату последнего изменения. Сравниваем с сохраненной датой.
-        Если дата изменилась (файл обновился), считываем новый файл, записываем в датафрейм, возвращаем
-        кортеж из новой даты изменения и датафрейма с данными. Если файл не изменился, возвращаем None.
+        Получаем метаинформацию файла из хранилища: дату последнего изменения и md5. Если md5 файла известен
+        с прошлого раза, сравниваем его, иначе сравниваем дату изменения с сохраненной датой.
+        Если файл изменился, скачиваем и считываем его, возвращаем кортеж из новой даты изменения, датафрейма
+        с данными и md5 файла. Если файл не изменился, возвращаем None, файл не скачивается.
         :param last_modified_date: дата последнего изменения файла из БД.
+        :param last_md5: md5 файла при прошлом обновлении из БД.
         :return:
         """
         filename = 'main_base/MainBase.xlsm'
-        # получаем дату последнего изменения файла
-        stop_list_modified_date = self._storage.get_modified_date(filename)
+        # получаем дату последнего изменения и контрольную сумму файла
+        meta = self._storage.get_meta(filename)
+        stop_list_modified_date = datetime.strptime(meta['modified'], '%Y-%m-%dT%H:%M:%S%z')
+        md5 = meta.get('md5')
         # преобразуем входящий параметр к типу datetime, т.к. он нам поступает как строка
         try:
             # либо так
@@ -37,15 +47,18 @@ class FeedbackParser:
             # либо если не получилось, предполагаем, что нет в БД еще даты, или произошла другая ошибка, поэтому
             # будем перезаписывать заново. Для этого считаем, что выгрузили 1.1.1970 - максимально раннюю дату.
             last_modified_date = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
-        # сравниваем реальную дату с датой в базе. Если дата в базе None, то сравниваем с 1.1.1970, значит
-        # дата обновления в любом случае позже, значит обновляем.
-        if last_modified_date < stop_list_modified_date:
-            # читаем и сохраняем файл
-            fh = self._storage.download(filename)
-            # читаем в датафрейм
-            df = pd.read_excel(fh, dtype='object')
+        if last_md5 is not None and md5 is not None:
+            # файл могли пересохранить без изменений - тогда дата меняется, а md5 нет
+            changed = md5 != last_md5
+        else:
+            # сравниваем реальную дату с датой в базе. Если дата в базе None, то сравниваем с 1.1.1970, значит
+            # дата обновления в любом случае позже, значит обновляем.
+            changed = last_modified_date < stop_list_modified_date
+        if changed:
+            # читаем файл, из него только нужные столбцы
+            df = self._read_stop_list(self._storage.download(filename))
             # создаем поле stop_list, 0 - если в forbiden пусто, 1 - если в forbiden что-то есть
-            df['stop_list'] = df['forbiden'].str.len() > 0
+            df['stop_list'] = df['forbiden'].map(lambda value: isinstance(value, str) and len(value) > 0)
             # выкидываем лишние столбцы
             df = df[['Телефон', 'Дата завершения', 'stop_list']]
             # выкидываем строки с пустыми номерами
@@ -55,11 +68,32 @@ class FeedbackParser:
             # группируем по телефону и оставляем только самую позднюю дату завершения.
             df = df.sort_values('Дата завершения', ascending=False)
             df = df.groupby(['Телефон'], as_index=False).agg({'Дата завершения': 'first', 'stop_list': 'first'})
-            # возвращаем новую дату и датафрейм
-            return stop_list_modified_date, df
+            # возвращаем новую дату, датафрейм и md5
+            return stop_list_modified_date, df, md5
         # если файл не обновился, возвращаем None
         return None
 
+    @staticmethod
+    def _read_stop_list(content: bytes) -> pd.DataFrame:
+        """
+        Считывает из файла обзвоненных только нужные столбцы (STOP_LIST_COLUMNS). Лист читается построчно
+        в режиме read_only, остальные столбцы не преобразуются.
+        :param content: содержимое xlsm-файла
+        :return: датафрейм со столбцами STOP_LIST_COLUMNS
+        """
+        # openpyxl нужен только при изменении файла, поэтому импортируется здесь, а не при запуске скрипта
+        import openpyxl
+        workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True, keep_links=False)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            # если какого-то столбца нет, выкидываем ValueError, как и pandas
+            indices = [header.index(column) for column in STOP_LIST_COLUMNS]
+            data = [tuple(row[i] if i < len(row) else None for i in indices) for row in rows]
+        finally:
+            workbook.close()
+        return pd.DataFrame(data, columns=STOP_LIST_COLUMNS, dtype='object')
+
 
 class FeedbackStorer(DatabaseWorker):
     """
@@ -68,34 +102,40 @@ class FeedbackStorer(DatabaseWorker):
     def __init__(self, db: Database = None):
         super().__init__(db)
 
-    def store(self, last_modified_date: datetime, df: pd.DataFrame):
+    def store(self, last_modified_date: datetime, df: pd.DataFrame, md5: str = None):
         """
-        Этот метод отвечает за запись в базу датафрейма и новой даты последнего изменения
+        Этот метод отвечает за запись в базу датафрейма и новой даты последнего изменения.
+        Записываются только телефоны, которых нет в стоп-листе или у которых изменились дата звонка или отметка
+        "не звонить": сравнение выполняется в БД, неизмененные строки таблицы не перезаписываются.
         :param last_modified_date: дата последнего изменения файла
         :param df: датафрейм
+        :param md5: md5 файла
         :return: None
         """
-        # сохраняем датафрейм
-        params = []
-        for row in df.iterrows():
-            # преобразуем телефон к строке и добавляем "+" при необходимости
-            phone = str(row[1]['Телефон'])
-            if phone[0] != '+':
-                phone = '+' + phone
-            params.append((phone, row[1]['Дата завершения'], row[1]['stop_list']))
+        # сохраняем датафрейм: телефоны приводим к числу, после нормализации оставляем самую позднюю запись
+        df = df.assign(phone=normalize_phones(df['Телефон'])).dropna(subset=['phone'])
+        df = df.sort_values('Дата завершения', ascending=False).drop_duplicates('phone')
+        df = df[['phone', 'Дата завершения', 'stop_list']]
+        params = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
         if len(params) > 0:
             query = """
                 INSERT INTO stop_list (phone, last_call_date, do_not_call) VALUES %s
                 ON CONFLICT (phone) DO UPDATE 
-                SET (last_call_date, do_not_call) = (EXCLUDED.last_call_date, EXCLUDED.do_not_call);
+                SET (last_call_date, do_not_call) = (EXCLUDED.last_call_date, EXCLUDED.do_not_call)
+                WHERE (stop_list.last_call_date, stop_list.do_not_call)
+                    IS DISTINCT FROM (EXCLUDED.last_call_date, EXCLUDED.do_not_call);
             """
             self._db.execute(query, params)
 
-        # сохраняем дату
-        self._db.execute("""
-            INSERT INTO config (parameter, value) VALUES (%s, %s)
-            ON CONFLICT (parameter) DO UPDATE SET value = EXCLUDED.value;
-            """, ('StopListLastModifiedDate', last_modified_date.strftime('%Y-%m-%dT%H:%M:%S%z')))
+        # сохраняем дату и md5
+        config_params = [('StopListLastModifiedDate', last_modified_date.strftime('%Y-%m-%dT%H:%M:%S%z'))]
+        if md5 is not None:
+            config_params.append(('StopListMd5', md5))
+        for parameter, value in config_params:
+            self._db.execute("""
+                INSERT INTO config (parameter, value) VALUES (%s, %s)
+                ON CONFLICT (parameter) DO UPDATE SET value = EXCLUDED.value;
+                """, (parameter, value))
 
         # закрываем соединение с БД, если открывали
         self.db_close()
@@ -0,0 +1,49 @@
+"""
+Модуль для работы с типами столбцов датафреймов.
+Столбцы с повторяющимися строками (отделы, города, типы) храним как category, счетчики и суммы - как int32,
+телефоны - как Int64, чтобы не держать в памяти объекты Python для каждой ячейки.
+"""
+
+from typing import Dict, List
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from phones import normalize_phones
+
+
+def apply_dtypes(df: pd.DataFrame, dtypes: Dict[str, str]) -> pd.DataFrame:
+    """
+    Приводит столбцы датафрейма к заданным типам.
+    Поддерживаемые типы: 'category', 'int32' (пропуски -> 0), 'phone' (номер телефона -> Int64),
+    'datetime64[ns]' (без часового пояса), 'object' (без изменений).
+    :param df: датафрейм
+    :param dtypes: словарь {столбец: тип}
+    :return: датафрейм с приведенными типами
+    """
+    df = df.copy()
+    for column, dtype in dtypes.items():
+        if dtype == 'phone':
+            df[column] = normalize_phones(df[column])
+        elif dtype == 'int32':
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype('int32')
+        elif dtype == 'datetime64[ns]':
+            df[column] = pd.to_datetime(df[column]).astype('datetime64[ns]')
+        elif dtype != 'object':
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def concat_frames(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Склеивает датафреймы, сохраняя категорийные столбцы категорийными
+    (pd.concat превращает их в object, если наборы категорий различаются).
+    :param dfs: список датафреймов с одинаковыми столбцами
+    :return: склеенный датафрейм
+    """
+    if len(dfs) > 1:
+        for column, dtype in dfs[0].dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                categories = union_categoricals([df[column] for df in dfs], ignore_order=True).categories
+                dfs = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in dfs]
+    return pd.concat(dfs)
@@ -0,0 +1,94 @@
+"""
+Проверка времени запуска скриптов: каждый модуль импортируется в отдельном интерпретаторе с -X importtime
+несколько раз, берется минимальное время. Скрипт завершается с кодом 1, если время импорта больше бюджета
+или при импорте загрузилась библиотека, которая нужна только на отдельных путях выполнения
+(bs4 - вход в Додо ИС, openpyxl - чтение файла обзвоненных, dodois в run_tasker).
+Бюджеты заданы не в мс, а в долях времени импорта pandas, измеренного в том же запуске (калибровка): так
+проверка не зависит от скорости машины и ее загрузки. Бюджеты - примерно полуторное время импорта после переноса
+тяжелых импортов; при необходимости их можно масштабировать через --scale.
+
+Пример: python import_budget.py --repeat 5 --scale 0.8
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# модуль, время импорта которого - единица бюджетов
+CALIBRATION = 'pandas'
+# {модуль: (бюджет импорта во времени импорта CALIBRATION, модули, которые не должны загружаться при импорте)}
+BUDGETS = {
+    'run_parser': (2.8, ['bs4', 'openpyxl', 'requests']),
+    'run_tasker': (2.8, ['bs4', 'openpyxl', 'requests', 'dodois']),
+    'run_custom': (2.8, ['bs4', 'openpyxl', 'requests']),
+    # процессы разбора Excel (импортируются в forkserver)
+    'decoder': (2.7, ['bs4', 'openpyxl', 'requests']),
+}
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def measure(module: str) -> Tuple[float, Dict[str, Tuple[int, int]]]:
+    """
+    Импортирует модуль в новом интерпретаторе.
+    :param module: имя модуля
+    :return: время импорта модуля в мс и {загруженный модуль: (собственное время мкс, время с зависимостями мкс)}
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode:
+        raise RuntimeError(f'import {module} failed:\n{completed.stderr}')
+    modules = {}
+    for match in LINE.finditer(completed.stderr):
+        self_us, cumulative_us, _, name = match.groups()
+        modules[name] = (int(self_us), int(cumulative_us))
+    return modules[module][1] / 1000, modules
+
+
+def check(module: str, budget_ms: float, forbidden: List[str], repeat: int, top: int) -> List[str]:
+    """
+    :return: список нарушений (пустой, если модуль уложился в бюджет)
+    """
+    runs = [measure(module) for _ in range(repeat)]
+    milliseconds, modules = min(runs, key=lambda run: run[0])
+    problems = []
+    if milliseconds > budget_ms:
+        problems.append(f'{module}: {milliseconds:.0f} ms > {budget_ms:.0f} ms')
+    for name in forbidden:
+        if name in modules:
+            problems.append(f'{module}: imports {name}')
+    print(f'{module:12} {milliseconds:7.0f} ms (budget {budget_ms:.0f} ms)')
+    # самые тяжелые пакеты верхнего уровня по собственному времени с подмодулями
+    packages = {}
+    for name, (self_us, _) in modules.items():
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f'    {package:24} {self_us / 1000:7.1f} ms')
+    return problems
+
+
+def main(argv: List[str] = None):
+    arg_parser = argparse.ArgumentParser(description='Проверка времени импорта скриптов')
+    arg_parser.add_argument('modules', nargs='*', default=list(BUDGETS), help='модули для проверки')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='запусков каждого импорта (берется минимум)')
+    arg_parser.add_argument('--scale', type=float, default=1.0, help='множитель бюджетов')
+    arg_parser.add_argument('--top', type=int, default=8, help='сколько самых тяжелых пакетов выводить')
+    args = arg_parser.parse_args(argv)
+
+    calibration_ms = min(measure(CALIBRATION)[0] for _ in range(args.repeat))
+    print(f'{CALIBRATION:12} {calibration_ms:7.0f} ms (calibration)')
+    problems = []
+    for module in args.modules:
+        budget, forbidden = BUDGETS.get(module, (float('inf'), []))
+        problems += check(module, budget * calibration_ms * args.scale, forbidden, args.repeat, args.top)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Модуль журнала запусков парсера.
+Для каждой пиццерии в каждом запуске run_parser в таблицу unit_runs пишется строка: время этапов
+(выгрузка, разбор, запись в БД), количество кусков и строк, размер выгруженных файлов, ошибка и этап, на котором
+она произошла.
+По журналу ParametersGetter и UnitWorkQueue упорядочивают пиццерии от самых долгих к самым быстрым
+(longest job first), а в конце запуска находятся пиццерии, которые стали выгружаться заметно дольше обычного.
+"""
+
+import os
+import socket
+import uuid
+from typing import Dict, List, Tuple
+
+import config
+from parser import DatabaseWorker
+from postgresql import Database
+
+# ожидаемое время выгрузки пиццерии: среднее по последним LEDGER_HISTORY_RUNS успешным запускам.
+# Подставляется в запросы ParametersGetter и UnitWorkQueue как LEFT JOIN LATERAL ... expected ON true
+# (параметр - количество запусков).
+EXPECTED_SECONDS_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT avg(r.total_seconds) AS seconds
+        FROM (
+            SELECT total_seconds
+            FROM unit_runs
+            WHERE unit_runs.db_unit_id = u.id AND unit_runs.error IS NULL
+            ORDER BY unit_runs.finished_at DESC
+            LIMIT %s
+        ) r
+    ) expected ON true
+"""
+
+
+class RunLedger(DatabaseWorker):
+    """
+    Журнал выгрузки пиццерий в рамках одного запуска.
+    """
+    def __init__(self, db: Database = None, run_id: str = None, worker_id: str = None):
+        """
+        :param db: открытое соединение с БД (см. DatabaseWorker)
+        :param run_id: идентификатор запуска, по умолчанию случайный
+        :param worker_id: имя воркера, по умолчанию config.WORKER_ID или "хост:pid"
+        """
+        super().__init__(db)
+        self._run_id = run_id or uuid.uuid4().hex
+        self._worker_id = (worker_id or config.WORKER_ID or f'{socket.gethostname()}:{os.getpid()}')[:64]
+
+    @property
+    def run_id(self) -> str:
+        return self._run_id
+
+    def record(self, db_unit_id: int, stats: Dict = None, error: str = None, stage: str = None):
+        """
+        Записывает результат выгрузки пиццерии. Запись попадает в ту же транзакцию, что и данные пиццерии.
+        :param db_unit_id: id пиццерии (units.id)
+        :param stats: статистика: total_seconds, download_seconds, decode_seconds, store_seconds, chunks, rows,
+            payload_bytes (отсутствующие значения записываются как NULL)
+        :param error: текст ошибки, если выгрузка не удалась
+        :param stage: этап, на котором произошла ошибка: download, decode или store
+        :return: None
+        """
+        stats = stats or {}
+        self._db.execute("""
+            INSERT INTO unit_runs (run_id, db_unit_id, worker_id, total_seconds, download_seconds, decode_seconds,
+                                   store_seconds, chunks, rows, payload_bytes, error, failed_stage)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+        """, (self._run_id, db_unit_id, self._worker_id, stats.get('total_seconds'), stats.get('download_seconds'),
+              stats.get('decode_seconds'), stats.get('store_seconds'), stats.get('chunks'), stats.get('rows'),
+              stats.get('payload_bytes'), error, stage))
+
+    def regressions(self, factor: float = None, history: int = None) -> List[Tuple[int, str, float, float]]:
+        """
+        Находит пиццерии, которые в этом запуске выгружались дольше обычного: время больше медианы
+        прошлых успешных запусков в factor раз.
+        :param factor: во сколько раз дольше медианы, по умолчанию config.LEDGER_REGRESSION_FACTOR
+        :param history: сколько прошлых запусков учитывать, по умолчанию config.LEDGER_HISTORY_RUNS
+        :return: список (id пиццерии, название, время в этом запуске, медиана прошлых запусков)
+        """
+        self._db.execute("""
+            WITH current_runs AS (
+                SELECT db_unit_id, total_seconds
+                FROM unit_runs
+                WHERE run_id = %s AND error IS NULL
+            ),
+            previous_runs AS (
+                SELECT db_unit_id, total_seconds,
+                       row_number() OVER (PARTITION BY db_unit_id ORDER BY finished_at DESC) AS n
+                FROM unit_runs
+                WHERE run_id <> %s AND error IS NULL
+                    AND db_unit_id IN (SELECT db_unit_id FROM current_runs)
+            ),
+            medians AS (
+                SELECT db_unit_id, percentile_cont(0.5) WITHIN GROUP (ORDER BY total_seconds) AS median
+                FROM previous_runs
+                WHERE n <= %s
+                GROUP BY db_unit_id
+            )
+            SELECT c.db_unit_id, u.unit_name, c.total_seconds, m.median
+            FROM current_runs c
+            JOIN medians m ON m.db_unit_id = c.db_unit_id
+            JOIN units u ON u.id = c.db_unit_id
+            WHERE c.total_seconds > %s * m.median
+            ORDER BY c.total_seconds / m.median DESC;
+        """, (self._run_id, self._run_id, history or config.LEDGER_HISTORY_RUNS,
+              factor or config.LEDGER_REGRESSION_FACTOR))
+        return self._db.fetch()
@@ -0,0 +1,174 @@
+"""
+Сквозная нагрузочная проверка run_parser, run_tasker и run_custom на тестовых серверах (fake_services.py)
+и локальной БД Postgres. Скрипт запускает тестовые серверы, заполняет БД пиццериями (units, auth, manager),
+запускает рабочие скрипты отдельными процессами с адресами тестовых серверов в окружении и для каждого
+скрипта выводит время, пиццерий в секунду, запросы к тестовым серверам и сводку этапов metrics.
+
+БД должна быть отдельной: таблицы auth и manager перезаписываются. Имя БД задается явно (--pg-database),
+остальные параметры подключения берутся из .env.
+
+Пример: python load_harness.py --pg-database dodozvon_load --units 1000 --rows 200 --latency 0.05
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Dict, List
+from urllib.request import urlopen
+
+import fake_services
+
+SCRIPTS = ['run_parser', 'run_tasker', 'run_custom']
+# клиентов (customer_id), между которыми распределяются пиццерии
+CUSTOMERS = 20
+
+
+def _stats(base: str) -> Dict[str, int]:
+    with urlopen(f'{base}/_stats', timeout=5) as response:
+        return json.load(response)
+
+
+def _start_services(args: argparse.Namespace, base: str) -> subprocess.Popen:
+    """
+    Запускает тестовые серверы отдельным процессом и ждет, пока они начнут отвечать.
+    """
+    process = subprocess.Popen([sys.executable, 'fake_services.py', '--port', str(args.port),
+                                '--units', str(args.units), '--rows', str(args.rows),
+                                '--latency', str(args.latency), '--failure-rate', str(args.failure_rate),
+                                '--upload-failure-rate', str(args.upload_failure_rate),
+                                '--history-days', str(args.history_days)],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            _stats(base)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('fake_services.py завершился при запуске')
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('fake_services.py не ответил за 60 секунд')
+
+
+def _seed(units: int):
+    """
+    Заполняет БД: пиццерии из тестового unitinfo, доступы в Додо ИС и настройки отчетов.
+    Импорты внутри функции: config читает окружение, которое harness меняет перед вызовом.
+    """
+    from dodo_openapi import DodoOpenAPIParser, DodoOpenAPIStorer
+    from postgresql import Database
+
+    db = Database()
+    db.connect()
+    storer = DodoOpenAPIStorer(db=db)
+    api_result = DodoOpenAPIParser().parse()
+    storer.store(*api_result)
+
+    db.execute("""
+        SELECT id, unit_name
+        FROM units
+        WHERE country_code = 'ru' AND unit_id >= 1000 AND unit_id < %s
+        ORDER BY unit_id;
+    """, (1000 + units,))
+    rows = db.fetch()
+    ids = [id_ for id_, _ in rows]
+    db.execute('DELETE FROM auth WHERE db_unit_id = ANY(%s);', (ids,))
+    db.execute('DELETE FROM manager WHERE db_unit_id = ANY(%s);', (ids,))
+    db.execute("""
+        INSERT INTO auth (db_unit_id, login, password, is_active, last_update) VALUES %s;
+    """, [(id_, f'load{id_}', 'password', True, None) for id_ in ids])
+
+    today = date.today()
+    custom_start = today - timedelta(days=30)
+    lost_start = today - timedelta(days=60)
+    db.execute("""
+        INSERT INTO manager (db_unit_id, customer_id, new_start_date, new_shop_exclude, new_city,
+            new_source_deliv, new_source_rest, new_source_pickup, new_promo_deliv, new_promo_rest, new_promo_pickup,
+            pizzeria, new_is_active_deliv, new_is_active_rest, new_is_active_pickup,
+            lost_start_date, lost_shift_months, lost_shop_exclude, lost_city, lost_source, lost_is_active, lost_promo,
+            new_clients_promos_all, lost_clients_promos_all, custom_start_date, custom_end_date) VALUES %s;
+    """, [(id_, index % CUSTOMERS + 1, custom_start, False, 'Тест',
+           'Звонок', 'Звонок', 'Звонок', 'НОВЫЙ', 'НОВЫЙ', 'НОВЫЙ',
+           unit_name[:30], True, True, True,
+           lost_start, 1, False, 'Тест', 'Звонок', True, 'ВЕРНИСЬ',
+           'НОВЫЙ', 'ВЕРНИСЬ', custom_start, today)
+          for index, (id_, unit_name) in enumerate(rows)])
+    db.commit()
+    db.close()
+    print(f'seeded {len(ids)} units')
+
+
+def _run_script(script: str, env: Dict[str, str], base: str, metrics_dir: str, units: int) -> Dict:
+    """
+    Запускает рабочий скрипт и собирает результат: время, код завершения, запросы к серверам, сводку metrics.
+    """
+    before = _stats(base)
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, f'{script}.py'], env=env)
+    seconds = time.perf_counter() - started
+    after = _stats(base)
+    summary_path = os.path.join(metrics_dir, f'dodozvon_{script}.json')
+    stages = {}
+    if os.path.exists(summary_path):
+        with open(summary_path, encoding='utf-8') as f:
+            stages = json.load(f)
+    return {'returncode': completed.returncode,
+            'seconds': round(seconds, 1),
+            'units_per_second': round(units / seconds, 2) if seconds else None,
+            'requests': {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)},
+            'stages': stages}
+
+
+def main(argv: List[str] = None):
+    arg_parser = argparse.ArgumentParser(description='Нагрузочная проверка на тестовых серверах')
+    arg_parser.add_argument('--pg-database', required=True, help='отдельная БД для проверки (перезаписывается)')
+    arg_parser.add_argument('--port', type=int, default=8900)
+    arg_parser.add_argument('--units', type=int, default=1000)
+    arg_parser.add_argument('--rows', type=int, default=200, help='строк в одной выгрузке')
+    arg_parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка выгрузки, с')
+    arg_parser.add_argument('--failure-rate', type=float, default=0.0, help='доля выгрузок с ошибкой 500')
+    arg_parser.add_argument('--upload-failure-rate', type=float, default=0.0, help='доля выгрузок на Диск с 503')
+    arg_parser.add_argument('--history-days', type=int, default=90)
+    arg_parser.add_argument('--scripts', nargs='+', default=SCRIPTS, choices=SCRIPTS)
+    arg_parser.add_argument('--output', help='файл для результатов в JSON')
+    args = arg_parser.parse_args(argv)
+
+    base = f'http://127.0.0.1:{args.port}'
+    metrics_dir = tempfile.mkdtemp(prefix='dodozvon_load_')
+    env = dict(os.environ, **fake_services.urls(base), PG_DATABASE=args.pg_database, METRICS_DIR=metrics_dir)
+    # config читает окружение при импорте: _seed импортирует его уже с адресами тестовых серверов
+    os.environ.update(env)
+
+    services = _start_services(args, base)
+    results = {}
+    try:
+        _seed(args.units)
+        for script in args.scripts:
+            print(f'--- {script} ---')
+            results[script] = _run_script(script, env, base, metrics_dir, args.units)
+    finally:
+        services.terminate()
+        services.wait()
+
+    print(f'\n{"script":12} {"code":>4} {"seconds":>9} {"units/s":>8}  requests')
+    for script, result in results.items():
+        requests = ', '.join(f'{key}={value}' for key, value in sorted(result['requests'].items()))
+        print(f'{script:12} {result["returncode"]:>4} {result["seconds"]:>9} {result["units_per_second"]:>8}  '
+              f'{requests}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'units': args.units, 'rows': args.rows, 'latency': args.latency,
+                       'failure_rate': args.failure_rate, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'results saved to {args.output}')
+    if any(result['returncode'] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Модуль метрик этапов выгрузки: авторизация и выгрузка из Додо ИС, разбор Excel, обработка датафреймов,
+запись в БД, запросы отчетов, формирование xlsx, выгрузка на Яндекс.Диск.
+Время этапов собирается через span (контекстный менеджер) и timed (декоратор для функций и корутин)
+в общий реестр процесса. В конце запуска report печатает JSON-сводку и, если задан METRICS_DIR, записывает
+метрики в формате Prometheus для textfile collector node_exporter и JSON-сводку в файлы.
+Метрики из процессов пула разбора Excel передаются в основной процесс через snapshot/merge.
+Файлы называются dodozvon_<скрипт>.prom и dodozvon_<скрипт>.json.
+"""
+
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+import config
+
+# префикс имен метрик Prometheus
+PREFIX = 'dodozvon'
+
+_lock = threading.Lock()
+# {(этап, ((метка, значение), ...)): [количество, сумма секунд, максимум секунд, количество ошибок]}
+_stages: Dict[Tuple, list] = {}
+
+
+def _key(stage: str, labels: Dict[str, str]) -> Tuple:
+    return stage, tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(stage: str, seconds: float, error: bool = False, **labels):
+    """
+    Добавляет одно измерение времени этапа.
+    :param stage: имя этапа
+    :param seconds: длительность в секундах
+    :param error: этап завершился исключением
+    :param labels: метки (например, report='orders')
+    :return: None
+    """
+    key = _key(stage, labels)
+    with _lock:
+        values = _stages.setdefault(key, [0, 0.0, 0.0, 0])
+        values[0] += 1
+        values[1] += seconds
+        values[2] = max(values[2], seconds)
+        values[3] += int(error)
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """
+    Измеряет время блока with.
+    :param stage: имя этапа
+    :param labels: метки
+    """
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, error, **labels)
+
+
+def timed(stage: str, **labels) -> Callable:
+    """
+    Декоратор: измеряет время каждого вызова функции или корутины.
+    :param stage: имя этапа
+    :param labels: метки
+    :return: декоратор
+    """
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot() -> Dict[Tuple, list]:
+    """
+    :return: копия реестра метрик
+    """
+    with _lock:
+        return {key: list(values) for key, values in _stages.items()}
+
+
+def merge(other: Dict[Tuple, list]):
+    """
+    Добавляет в реестр метрики из снимка другого процесса.
+    :param other: результат snapshot
+    :return: None
+    """
+    with _lock:
+        for key, (count, total, maximum, errors) in other.items():
+            values = _stages.setdefault(key, [0, 0.0, 0.0, 0])
+            values[0] += count
+            values[1] += total
+            values[2] = max(values[2], maximum)
+            values[3] += errors
+
+
+def reset():
+    """
+    Очищает реестр метрик.
+    :return: None
+    """
+    with _lock:
+        _stages.clear()
+
+
+def _format_labels(labels: Tuple, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def prometheus_text(script: str) -> str:
+    """
+    Метрики в текстовом формате Prometheus.
+    :param script: имя скрипта (метка script)
+    :return: текст
+    """
+    lines = [f'# HELP {PREFIX}_stage_seconds Время этапов выгрузки в секундах',
+             f'# TYPE {PREFIX}_stage_seconds summary']
+    items = sorted(snapshot().items())
+    for (stage, labels), (count, total, _, _) in items:
+        label_text = _format_labels(labels, script=script, stage=stage)
+        lines.append(f'{PREFIX}_stage_seconds_sum{label_text} {total:.6f}')
+        lines.append(f'{PREFIX}_stage_seconds_count{label_text} {count}')
+    lines += [f'# HELP {PREFIX}_stage_seconds_max Максимальное время этапа в секундах',
+              f'# TYPE {PREFIX}_stage_seconds_max gauge']
+    for (stage, labels), (_, _, maximum, _) in items:
+        lines.append(f'{PREFIX}_stage_seconds_max{_format_labels(labels, script=script, stage=stage)} {maximum:.6f}')
+    lines += [f'# HELP {PREFIX}_stage_errors_total Количество этапов, завершившихся ошибкой',
+              f'# TYPE {PREFIX}_stage_errors_total counter']
+    for (stage, labels), (_, _, _, errors) in items:
+        lines.append(f'{PREFIX}_stage_errors_total{_format_labels(labels, script=script, stage=stage)} {errors}')
+    lines += [f'# HELP {PREFIX}_last_run_timestamp_seconds Время окончания запуска',
+              f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge',
+              f'{PREFIX}_last_run_timestamp_seconds{_format_labels((), script=script)} {time.time():.0f}']
+    return '\n'.join(lines) + '\n'
+
+
+def summary() -> Dict[str, Dict]:
+    """
+    Сводка по этапам: {'этап{метки}': {count, total_seconds, avg_seconds, max_seconds, errors}}
+    """
+    result = {}
+    for (stage, labels), (count, total, maximum, errors) in sorted(snapshot().items()):
+        result[stage + _format_labels(labels)] = {'count': count,
+                                                  'total_seconds': round(total, 3),
+                                                  'avg_seconds': round(total / count, 3) if count else 0,
+                                                  'max_seconds': round(maximum, 3),
+                                                  'errors': errors}
+    return result
+
+
+def _write_atomic(path: str, text: str):
+    # textfile collector может прочитать файл в момент записи, поэтому пишем во временный и переименовываем
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def report(script: str):
+    """
+    Печатает JSON-сводку метрик запуска. Если задан METRICS_DIR, записывает туда dodozvon_<script>.prom
+    (для textfile collector) и dodozvon_<script>.json.
+    :param script: имя скрипта (run_parser, run_tasker, run_custom)
+    :return: None
+    """
+    summary_text = json.dumps({'script': script, 'stages': summary()}, ensure_ascii=False, indent=2)
+    print(summary_text)
+    if config.METRICS_DIR:
+        os.makedirs(config.METRICS_DIR, exist_ok=True)
+        _write_atomic(os.path.join(config.METRICS_DIR, f'{PREFIX}_{script}.prom'), prometheus_text(script))
+        _write_atomic(os.path.join(config.METRICS_DIR, f'{PREFIX}_{script}.json'), summary_text)
@@ -0,0 +1,26 @@
+"""
+Разовые миграции схемы БД (Database.migrate), которые не выполняются при каждом подключении:
+перевод телефонов в старых таблицах stop_list, clients и orders из строк в BIGINT (номера с 8 в начале
+приводятся к 7, совпавшие после этого записи схлопываются) и кодов в SMALLINT. На больших таблицах миграция
+переписывает таблицы и блокирует их, поэтому запускается один раз после обновления, до run_parser и daemon.
+Повторный запуск ничего не меняет.
+
+Пример: python migrate.py
+"""
+
+from postgresql import Database
+
+
+def main():
+    db = Database()
+    db.connect()
+    try:
+        print('Migrating...')
+        db.migrate()
+        print('Migration complete!')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
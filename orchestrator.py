@@ -0,0 +1,226 @@
+"""
+Модуль для выполнения работы в виде графа зависимостей (DAG): задача запускается, как только завершились
+все задачи, от которых она зависит. Каждый этап (stage) выполняется в своем пуле потоков, размер пула -
+ограничение одновременно выполняемых задач этапа. Задачи этапа запускаются в порядке добавления, поэтому
+порядок добавления задает приоритет. Если задача завершилась ошибкой, зависящие от нее задачи пропускаются,
+остальные продолжают выполняться. Результат задачи хранится, пока не завершатся (или не будут пропущены)
+все зависимые от нее задачи, результаты задач без зависимых - до конца. Для этапа можно задать буфер:
+сколько его задач одновременно выполняются или хранят результат для зависимых задач; следующая задача этапа
+запускается, только когда освободится место (так выгрузки не копятся в памяти, если запись в БД медленнее).
+Используется скриптом run_all.
+"""
+
+import heapq
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional
+
+import metrics
+
+
+class Job:
+    """
+    Задача графа: функция без аргументов, результат доступен зависимым задачам через свойство result.
+    """
+    def __init__(self, stage: str, name: str, func: Callable, deps: Iterable['Job'] = ()):
+        """
+        :param stage: этап (определяет пул потоков)
+        :param name: название задачи для сообщений
+        :param func: функция задачи
+        :param deps: задачи, после которых выполняется эта задача
+        """
+        self.stage = stage
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.dependents: List['Job'] = []
+        # порядковый номер добавления (приоритет)
+        self.index = 0
+        # pending, running, done, failed, skipped
+        self.state = 'pending'
+        self.error: Optional[BaseException] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._future: Optional[Future] = None
+        # результат больше не нужен зависимым задачам (см. Orchestrator._release)
+        self._released = False
+
+    @property
+    def result(self):
+        """
+        :return: результат функции задачи (только для выполненной задачи, пока нужен зависимым задачам)
+        """
+        if self._future is None:
+            raise RuntimeError(f'Результат задачи {self} недоступен')
+        return self._future.result()
+
+    def __repr__(self):
+        return f'{self.stage}:{self.name}'
+
+
+class Orchestrator:
+    """
+    Выполняет задачи графа с ограничением одновременно выполняемых задач по этапам.
+    """
+    def __init__(self, limits: Dict[str, int], log_func: Callable[[str], None] = print,
+                 buffers: Dict[str, int] = None):
+        """
+        :param limits: {этап: количество одновременно выполняемых задач}; этапы без ограничения - по одной задаче
+        :param log_func: функция для сообщений об ошибках задач
+        :param buffers: {этап: сколько задач этапа могут одновременно выполняться или хранить результат,
+            который еще нужен зависимым задачам}; этапы без буфера не ограничиваются
+        """
+        self._limits = limits
+        self._buffers = buffers or {}
+        self._log_func = log_func
+        self._jobs: List[Job] = []
+        self._started: Optional[float] = None
+
+    @property
+    def jobs(self) -> List[Job]:
+        return self._jobs
+
+    def add(self, stage: str, name: str, func: Callable, deps: Iterable[Job] = ()) -> Job:
+        """
+        Добавляет задачу. Зависимости должны быть добавлены раньше, поэтому граф не может содержать циклов.
+        :param stage: этап
+        :param name: название задачи
+        :param func: функция без аргументов
+        :param deps: задачи, после которых выполняется эта задача
+        :return: задача
+        """
+        job = Job(stage, name, func, deps)
+        job.index = len(self._jobs)
+        for dep in job.deps:
+            dep.dependents.append(job)
+        self._jobs.append(job)
+        return job
+
+    def _call(self, job: Job):
+        job.started = time.monotonic()
+        try:
+            with metrics.span(f'dag_{job.stage}'):
+                return job.func()
+        finally:
+            job.finished = time.monotonic()
+
+    def _skip(self, job: Job, remaining: Dict[Job, int], held: Dict[str, int]):
+        if job.state != 'pending':
+            return
+        job.state = 'skipped'
+        self._release_deps(job, remaining, held)
+        for dependent in job.dependents:
+            self._skip(dependent, remaining, held)
+
+    def _release_deps(self, job: Job, remaining: Dict[Job, int], held: Dict[str, int]):
+        # задача больше не ждет зависимостей: результат зависимости, который не нужен другим задачам, освобождается
+        # (например, датафреймы выгрузки пиццерии после ее записи в БД)
+        for dep in job.deps:
+            remaining[dep] -= 1
+            # зависимость еще выполняется, если зависимая задача пропущена из-за ошибки другой зависимости;
+            # тогда результат освобождается по ее завершении
+            if remaining[dep] == 0 and dep.state in ('done', 'failed'):
+                self._release(dep, held)
+
+    @staticmethod
+    def _release(job: Job, held: Dict[str, int]):
+        # результат задачи больше не нужен зависимым задачам, место в буфере этапа освобождается
+        if job._released:
+            return
+        job._released = True
+        if job.dependents:
+            job._future = None
+        if job.stage in held:
+            held[job.stage] -= 1
+
+    def run(self):
+        """
+        Выполняет все задачи и возвращается, когда не осталось выполняемых задач.
+        :return: None
+        """
+        self._started = time.monotonic()
+        stages = {job.stage for job in self._jobs}
+        executors = {stage: ThreadPoolExecutor(max_workers=self._limits.get(stage, 1),
+                                               thread_name_prefix=f'dag_{stage}') for stage in stages}
+        waiting = {job: len(job.deps) for job in self._jobs}
+        # сколько зависимых задач еще не завершились и не пропущены
+        remaining = {job: len(job.dependents) for job in self._jobs}
+        running: Dict[Future, Job] = {}
+        # этапы с буфером: сколько задач выполняются или хранят результат, и готовые задачи в порядке добавления
+        held = {stage: 0 for stage in self._buffers}
+        ready: Dict[str, List] = {stage: [] for stage in self._buffers}
+
+        def submit(job_: Job):
+            if job_.stage in ready:
+                heapq.heappush(ready[job_.stage], (job_.index, job_))
+                return
+            start(job_)
+
+        def start(job_: Job):
+            job_.state = 'running'
+            job_._future = executors[job_.stage].submit(self._call, job_)
+            running[job_._future] = job_
+
+        def start_ready():
+            for stage, queue in ready.items():
+                while queue and held[stage] < self._buffers[stage]:
+                    held[stage] += 1
+                    start(heapq.heappop(queue)[1])
+            if not running:
+                # буфер занят результатами, которые не освободятся без запуска задачи этапа (например, зависимая
+                # задача ждет еще одну задачу этого этапа): запускаем следующую задачу сверх буфера
+                for stage, queue in ready.items():
+                    if queue:
+                        held[stage] += 1
+                        start(heapq.heappop(queue)[1])
+                        break
+
+        try:
+            for job in self._jobs:
+                if not job.deps:
+                    submit(job)
+            start_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                # зависимые задачи запускаются в порядке добавления
+                for future, job in sorted(((future, running.pop(future)) for future in done),
+                                          key=lambda item: item[1].index):
+                    job.error = future.exception()
+                    self._release_deps(job, remaining, held)
+                    if job.error is not None:
+                        job.state = 'failed'
+                        self._log_func(f'Задача {job} завершилась ошибкой: {job.error}')
+                        for dependent in job.dependents:
+                            self._skip(dependent, remaining, held)
+                    else:
+                        job.state = 'done'
+                        for dependent in job.dependents:
+                            waiting[dependent] -= 1
+                            if waiting[dependent] == 0 and dependent.state == 'pending':
+                                submit(dependent)
+                    if remaining[job] == 0:
+                        self._release(job, held)
+                start_ready()
+        finally:
+            for future in running:
+                future.cancel()
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+    def elapsed(self, job: Job) -> Optional[float]:
+        """
+        :return: сколько секунд от начала run до завершения задачи (None, если задача не выполнялась)
+        """
+        if job.finished is None or self._started is None:
+            return None
+        return job.finished - self._started
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: {этап: {состояние: количество задач}}
+        """
+        result = {}
+        for job in self._jobs:
+            states = result.setdefault(job.stage, {})
+            states[job.state] = states.get(job.state, 0) + 1
+        return result
@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta, timezone
 from typing import List, Tuple, Union
 
+import config
+from ledger import EXPECTED_SECONDS_JOIN
 from parser import DatabaseWorker
 from postgresql import Database
 
@@ -14,32 +16,39 @@ class ParametersGetter(DatabaseWorker):
     def __init__(self, db: Database = None):
         super().__init__(db)
 
-    def _get_units_from_db(self) -> List:
+    def _get_units_from_db(self, db_unit_ids: List[int] = None) -> List:
         """
         Возвращает все активные пиццерии из таблицы auth, которые не обновлялись сегодня по времени пиццерии.
+        Пиццерии упорядочены от самых долгих к самым быстрым по журналу запусков (unit_runs), сначала - пиццерии
+        без истории: при параллельной выгрузке долгие пиццерии не остаются на конец.
+        :param db_unit_ids: если передан, только пиццерии из этого списка (units.id)
         :return: список параметров для каждой активной пиццерии.
         """
         self._db.execute(
-            """
+            f"""
             SELECT u.id, u.unit_id, u.uuid, u.unit_name, u.tz_shift, a.login, a.password, a.last_update, u.begin_date_work
             FROM units u
             JOIN auth a ON u.id = a.db_unit_id
+            {EXPECTED_SECONDS_JOIN}
             WHERE a.is_active = true
             AND (a.last_update IS NULL OR 
-                 a.last_update < date_trunc('day', now() AT TIME ZONE 'UTC'));
-            """
+                 a.last_update < date_trunc('day', now() AT TIME ZONE 'UTC'))
+            AND (%s::bigint[] IS NULL OR u.id = ANY(%s::bigint[]))
+            ORDER BY expected.seconds DESC NULLS FIRST;
+            """, (config.LEDGER_HISTORY_RUNS, db_unit_ids, db_unit_ids)
         )
         return self._db.fetch()
 
-    def get_parsing_params(self) -> List[Tuple]:
+    def get_parsing_params(self, db_unit_ids: List[int] = None) -> List[Tuple]:
         """
         Собирает параметры для передачи в Додо парсер. Возвращает список кортежей.
+        :param db_unit_ids: если передан, только пиццерии из этого списка (units.id)
         :return: список параметров в кортежах.
         """
         units_to_parse = []
         for (
                 id_, unit_id, uuid, unit_name, tz_shift, login, password, last_update, begin_work_date
-        ) in self._get_units_from_db():
+        ) in self._get_units_from_db(db_unit_ids):
             # местное время пиццерии
             local_time = datetime.now(timezone.utc) + timedelta(hours=tz_shift)
             # конец интервала - всегда вчера
@@ -17,10 +17,13 @@ class DatabaseWorker:
             self._db = db
             self._external_db = True
 
-    def db_close(self):
+    def db_close(self, commit: bool = True):
         """
         Метод закрывает соединение с БД, если соединение устанавливалось при инициализации.
+        :param commit: сохранить изменения; если False, незафиксированные изменения откатываются
         :return: None
         """
         if not self._external_db:
+            if not commit:
+                self._db.rollback()
             self._db.close()
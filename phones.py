@@ -0,0 +1,33 @@
+"""
+Модуль для преобразования номеров телефонов.
+В БД номера хранятся числом BIGINT без "+" (79991234567), в отчетах выводятся строкой "+79991234567".
+"""
+
+import pandas as pd
+
+# диапазон российских мобильных номеров (+79...)
+MOBILE_MIN = 79000000000
+MOBILE_MAX = 79999999999
+
+
+def normalize_phones(phones: pd.Series) -> pd.Series:
+    """
+    Приводит номера телефонов к числу: оставляет только цифры, 8 в начале 11-значного номера
+    заменяет на 7 (89991234567 и +79991234567 - один номер).
+    Пустые и некорректные номера превращаются в <NA>.
+    :param phones: серия с номерами в любом формате (строки "+7...", числа)
+    :return: серия типа Int64
+    """
+    digits = phones.astype('string').str.replace(r'\.0$', '', regex=True).str.replace(r'\D', '', regex=True)
+    digits = digits.str.replace(r'^8(\d{10})$', r'7\1', regex=True)
+    digits = digits.where(digits.str.len().between(1, 18))
+    return pd.to_numeric(digits, errors='coerce').astype('Int64')
+
+
+def format_phones(phones: pd.Series) -> pd.Series:
+    """
+    Преобразует номера из БД в строки для отчетов: 79991234567 -> "+79991234567".
+    :param phones: серия с номерами-числами
+    :return: серия строк
+    """
+    return ('+' + phones.astype('Int64').astype('string')).astype(object)
@@ -1,3 +1,4 @@
+import threading
 from typing import Union, List, Tuple
 
 import psycopg2
@@ -16,9 +17,12 @@ class Database:
         self._conn = None
         self._cur = None
 
-    def connect(self):
+    def connect(self, init_schema: bool = True):
         """
         Connect to an existing database
+        :param init_schema: создать таблицы и функции и выполнить легкие миграции; дополнительные соединения
+            того же процесса (DatabasePool) схему не трогают: одновременный CREATE OR REPLACE FUNCTION
+            из нескольких соединений завершается ошибкой
         """
         self._conn = psycopg2.connect(dbname=self._database,
                                       user=self._user,
@@ -29,6 +33,10 @@ class Database:
         # Open a cursor to perform database operations
         self._cur = self._conn.cursor()
 
+        if init_schema:
+            self._init_schema()
+
+    def _init_schema(self):
         # Создать таблицы
         self._create_table_units()
         self._create_table_clients()
@@ -37,6 +45,10 @@ class Database:
         self._create_table_stop_list()
         self._create_table_config()
         self._create_table_orders()
+        self._create_table_unit_runs()
+
+        # Добавить в старую таблицу auth поля аренды для режима очереди
+        self._migrate_leases()
 
         # Создать функции
         self._create_functions()
@@ -45,6 +57,14 @@ class Database:
         # В 12-й версии нет CREATE OR REPLACE для триггеров, поэтому создаем только один раз, иначе ошибка
         # self._create_triggers()
 
+    def migrate(self):
+        """
+        Разовые миграции старых таблиц, которые не выполняются при каждом подключении (см. migrate.py):
+        перевод телефонов в BIGINT и кодов в SMALLINT.
+        :return: None
+        """
+        self._migrate_compact_types()
+
     def _create_table_units(self):
         self.execute("""
             CREATE TABLE IF NOT EXISTS units (
@@ -65,12 +85,12 @@ class Database:
             CREATE TABLE IF NOT EXISTS clients (
                 id BIGSERIAL PRIMARY KEY,
                 db_unit_id BIGINT,
-                phone VARCHAR(20),
+                phone BIGINT,
                 first_order_datetime TIMESTAMP WITH TIME ZONE,
                 first_order_city VARCHAR(40),
                 last_order_datetime TIMESTAMP WITH TIME ZONE,
                 last_order_city VARCHAR(40),
-                first_order_type INTEGER,
+                first_order_type SMALLINT,
                 orders_amt INTEGER,
                 orders_sum INTEGER,
                 sms_text VARCHAR(150),
@@ -94,6 +114,8 @@ class Database:
                 password VARCHAR(256),
                 is_active BOOLEAN,
                 last_update TIMESTAMP WITH TIME ZONE,
+                lease_owner VARCHAR(64),
+                lease_until TIMESTAMP WITH TIME ZONE,
                 CONSTRAINT fk_units
                     FOREIGN KEY (db_unit_id)
                         REFERENCES units(id)
@@ -133,7 +155,7 @@ class Database:
                 lost_clients_promos_all TEXT,
                 custom_start_date DATE,
                 custom_end_date DATE,
-                UNIQUE (country_code, unit_id),
+                UNIQUE (db_unit_id),
                 CONSTRAINT fk_units
                     FOREIGN KEY (db_unit_id)
                         REFERENCES units(id)
@@ -145,7 +167,7 @@ class Database:
         self.execute("""
             CREATE TABLE IF NOT EXISTS stop_list(
             id BIGSERIAL PRIMARY KEY,
-            phone VARCHAR(20) UNIQUE,
+            phone BIGINT UNIQUE,
             last_call_date TIMESTAMP WITH TIME ZONE,
             do_not_call BOOLEAN
             );
@@ -167,10 +189,10 @@ class Database:
                 db_unit_id BIGINT,
                 date TIMESTAMP WITH TIME ZONE,
                 order_id VARCHAR(11),
-                order_type INTEGER,
-                phone VARCHAR(20),
+                order_type SMALLINT,
+                phone BIGINT,
                 order_sum INTEGER,
-                status INTEGER,
+                status SMALLINT,
                 UNIQUE (db_unit_id, date, order_id),
                 CONSTRAINT fk_units
                     FOREIGN KEY (db_unit_id)
@@ -178,6 +200,95 @@ class Database:
                         ON DELETE CASCADE
             );
         """)
+        # индекс для пересчета клиентов из заказов (CLIENTS_SOURCE = 'orders')
+        self.execute("""
+            CREATE INDEX IF NOT EXISTS orders_phone_idx ON orders (phone);
+        """)
+
+    def _create_table_unit_runs(self):
+        # журнал выгрузки пиццерий: одна строка на пиццерию в каждом запуске run_parser (см. ledger.RunLedger)
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS unit_runs (
+                id BIGSERIAL PRIMARY KEY,
+                run_id VARCHAR(32),
+                db_unit_id BIGINT,
+                worker_id VARCHAR(64),
+                finished_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+                total_seconds REAL,
+                download_seconds REAL,
+                decode_seconds REAL,
+                store_seconds REAL,
+                chunks INTEGER,
+                rows INTEGER,
+                payload_bytes BIGINT,
+                error TEXT,
+                failed_stage VARCHAR(16),
+                CONSTRAINT fk_units
+                    FOREIGN KEY (db_unit_id)
+                        REFERENCES units(id)
+                        ON DELETE CASCADE
+            );
+        """)
+        self.execute("""
+            CREATE INDEX IF NOT EXISTS unit_runs_unit_idx ON unit_runs (db_unit_id, finished_at DESC);
+        """)
+
+    def _get_column_type(self, table: str, column: str) -> Union[str, None]:
+        self.execute("""
+            SELECT data_type
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s;
+        """, (table, column))
+        row = self.fetch(one=True)
+        return row[0] if row else None
+
+    def _migrate_compact_types(self):
+        # телефоны: VARCHAR(20) "+79991234567" -> BIGINT 79991234567, коды: INTEGER -> SMALLINT.
+        # Выполняется один раз для таблиц, созданных до перехода на компактные типы.
+        # Как в phones.normalize_phones, 8 в начале 11-значного номера заменяется на 7
+        def phone_to_bigint(column: str = 'phone') -> str:
+            return f"nullif(regexp_replace(regexp_replace({column}, '\\D', '', 'g'), '^8(\\d{{10}})$', '7\\1'), " \
+                   f"'')::bigint"
+
+        if self._get_column_type('stop_list', 'phone') != 'bigint':
+            # после нормализации номера могут совпасть - оставляем последнюю запись
+            self.execute(f"""
+                DELETE FROM stop_list sl
+                USING stop_list newer
+                WHERE {phone_to_bigint('sl.phone')} = 
+                      {phone_to_bigint('newer.phone')}
+                    AND sl.id < newer.id;
+                ALTER TABLE stop_list ALTER COLUMN phone TYPE BIGINT USING {phone_to_bigint()};
+            """)
+        if self._get_column_type('clients', 'phone') != 'bigint':
+            self.execute(f"""
+                DELETE FROM clients c
+                USING clients newer
+                WHERE {phone_to_bigint('c.phone')} = 
+                      {phone_to_bigint('newer.phone')}
+                    AND c.id < newer.id;
+                ALTER TABLE clients
+                    ALTER COLUMN phone TYPE BIGINT USING {phone_to_bigint()},
+                    ALTER COLUMN first_order_type TYPE SMALLINT;
+            """)
+        if self._get_column_type('orders', 'phone') != 'bigint':
+            self.execute(f"""
+                ALTER TABLE orders
+                    ALTER COLUMN phone TYPE BIGINT USING {phone_to_bigint()},
+                    ALTER COLUMN order_type TYPE SMALLINT,
+                    ALTER COLUMN status TYPE SMALLINT;
+            """)
+        self.commit()
+
+    def _migrate_leases(self):
+        # ALTER TABLE блокирует таблицу, поэтому выполняем только если полей еще нет
+        if self._get_column_type('auth', 'lease_owner') is None:
+            self.execute("""
+                ALTER TABLE auth
+                    ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(64),
+                    ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;
+            """)
+        self.commit()
 
     def _create_functions(self):
         # обновление промокодов для новых клиентов
@@ -269,9 +380,75 @@ class Database:
     def commit(self):
         self._conn.commit()
 
+    def rollback(self):
+        self._conn.rollback()
+
+    # точки сохранения выполняются напрямую курсором, минуя execute (его переопределяют, см. sql_benchmark)
+    def savepoint(self, name: str):
+        self._cur.execute(f'SAVEPOINT {name};')
+
+    def rollback_to_savepoint(self, name: str):
+        self._cur.execute(f'ROLLBACK TO SAVEPOINT {name};')
+
+    def release_savepoint(self, name: str):
+        self._cur.execute(f'RELEASE SAVEPOINT {name};')
+
+    def is_alive(self) -> bool:
+        """
+        Проверяет, что соединение живо (сервер мог закрыть его, пока демон ждал следующего запуска).
+        Незафиксированные изменения откатываются.
+        :return: True, если соединение работает
+        """
+        if self._conn is None or self._conn.closed:
+            return False
+        try:
+            self._conn.rollback()
+            self._cur.execute('SELECT 1;')
+            self._cur.fetchone()
+            self._conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
     def close(self):
         # Make the changes to the database persistent
         self._conn.commit()
         # Close communication with the database
         self._cur.close()
         self._conn.close()
+
+
+class DatabasePool:
+    """
+    Соединения с БД по одному на поток: Database не потокобезопасен, поэтому потоки, которые одновременно
+    работают с БД (этапы оркестратора run_all), получают каждый свое соединение. Соединение создается при первом
+    обращении из потока без создания схемы (ее создает основное соединение) и живет до close.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._connections: List[Database] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> Database:
+        """
+        :return: соединение текущего потока
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = Database()
+            db.connect(init_schema=False)
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def close(self):
+        """
+        Закрывает все соединения (с фиксацией, как Database.close). Вызывается после завершения потоков.
+        :return: None
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for db in connections:
+            db.close()
+        self._local = threading.local()
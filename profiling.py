@@ -0,0 +1,139 @@
+"""
+Модуль для профилирования отдельных пиццерий и отчетов в рабочих запусках.
+Цели задаются в PROFILE_TARGETS или аргументами --profile скриптов run_parser, run_custom и run_tasker:
+id пиццерии (units.id) или ее название (run_parser, промо и заказы run_custom), название отчета
+(promo и orders в run_custom - каждая пиццерия отдельно, new_clients и lost_clients в run_tasker - отчет целиком).
+Для каждой цели в PROFILE_DIR записываются <имя>.prof (cProfile, смотреть через
+python -m pstats или snakeviz) и <имя>.alloc.txt (места с наибольшим приростом памяти по tracemalloc).
+Если цели не заданы, profile возвращает пустой контекстный менеджер и профилирование ничего не стоит.
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+from contextlib import nullcontext
+from typing import Callable, List, Set
+
+import async_http
+import config
+
+# цели профилирования: строковые id пиццерий, названия пиццерий и отчетов
+_targets: Set[str] = set(config.PROFILE_TARGETS)
+
+
+def configure(argv: List[str] = None):
+    """
+    Добавляет к целям из PROFILE_TARGETS цели из аргументов командной строки (--profile, можно несколько раз).
+    :param argv: аргументы, по умолчанию sys.argv
+    :return: None
+    """
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--profile', action='append', default=[], metavar='TARGET',
+                            help='id или название пиццерии или название отчета для профилирования')
+    args, _ = arg_parser.parse_known_args(argv)
+    _targets.update(args.profile)
+
+
+def is_target(*keys) -> bool:
+    """
+    :param keys: id пиццерии, название пиццерии, название отчета
+    :return: нужно ли профилировать
+    """
+    return bool(_targets) and any(str(key) in _targets for key in keys if key is not None)
+
+
+def profile(name: str, *keys):
+    """
+    Контекстный менеджер профилирования блока, если хотя бы один из ключей - цель профилирования.
+    :param name: имя файлов результата
+    :param keys: id пиццерии, название пиццерии, название отчета
+    :return: UnitProfiler или пустой контекстный менеджер
+    """
+    if not is_target(*keys):
+        return nullcontext()
+    return UnitProfiler(name)
+
+
+class UnitProfiler:
+    """
+    Профилирует блок with: cProfile в вызывающем потоке и в потоке общего цикла событий async_http
+    (там выполняются запросы к Додо ИС и Яндекс.Диску), tracemalloc во всем процессе.
+    Разбор Excel выполняется в потоках пула, поэтому его нужно вызывать через call или передавать
+    профилировщик парсеру как decoder. Блок должен выполняться без других пиццерий, иначе их работа в цикле событий
+    тоже попадет в профиль.
+    """
+    def __init__(self, name: str, directory: str = None):
+        """
+        :param name: имя файлов результата
+        :param directory: папка для результатов, по умолчанию config.PROFILE_DIR
+        """
+        self._name = re.sub(r'[^\w.-]+', '_', name)
+        self._directory = directory or config.PROFILE_DIR
+        self._profile = cProfile.Profile()
+        self._loop_profile = cProfile.Profile()
+        # профили вызовов из других потоков (call)
+        self._call_profiles = []
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        self._memory_before = None
+
+    def decode(self, report_type: str, content: bytes, this_timezone: str):
+        """
+        Интерфейс decoder.ReportDecoder: профилировщик можно передать парсеру как decoder,
+        тогда Excel разбирается в текущем процессе под профилем.
+        """
+        from dodois import DodoISParser
+        return self.call(DodoISParser.decode, report_type, content, this_timezone)
+
+    def call(self, func: Callable, *args, **kwargs):
+        """
+        Вызывает функцию под отдельным профилем (для потоков, которые не профилируются целиком).
+        """
+        call_profile = cProfile.Profile()
+        try:
+            return call_profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._call_profiles.append(call_profile)
+
+    async def _enable_in_loop(self):
+        self._loop_profile.enable()
+
+    async def _disable_in_loop(self):
+        self._loop_profile.disable()
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._memory_before = tracemalloc.take_snapshot()
+        async_http.run_sync(self._enable_in_loop())
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._profile.disable()
+        async_http.run_sync(self._disable_in_loop())
+        memory_after = tracemalloc.take_snapshot()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(self._directory, self._name)
+        stats = pstats.Stats(self._profile)
+        for other in [self._loop_profile] + self._call_profiles:
+            try:
+                stats.add(other)
+            except TypeError:
+                # профиль без вызовов
+                pass
+        stats.dump_stats(f'{path}.prof')
+
+        top = memory_after.compare_to(self._memory_before, 'lineno')[:config.PROFILE_TOP_ALLOCATIONS]
+        with open(f'{path}.alloc.txt', 'w', encoding='utf-8') as f:
+            f.writelines(f'{line}\n' for line in top)
+        print(f'profile saved to {path}.prof, {path}.alloc.txt')
@@ -0,0 +1,209 @@
+import io
+import json
+import queue
+import threading
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+import config
+from reports import render_xlsx
+from storage import YandexUploadManager
+
+# сигнал остановки для потоков
+_STOP = object()
+
+
+class ReportPipeline:
+    """
+    Конвейер формирования и выгрузки отчетов.
+    Запросы к БД выполняются в вызывающем потоке (DatabaseTasker), готовые датафреймы через ограниченную очередь
+    передаются потокам формирования xlsx, а готовые файлы - потокам выгрузки на Яндекс.Диск.
+    Пока один отчет выгружается, следующий уже формируется, а следующий запрос уже выполняется.
+    Ошибки не прерывают конвейер, а собираются по customer_id (свойство errors).
+    Если очередь заполнена, submit ждет освобождения места, поэтому в памяти одновременно
+    находится ограниченное число отчетов. Время выгрузки каждого файла доступно в свойстве timings.
+
+    В режиме архива (bundle=True) готовые файлы не выгружаются по одному, а при закрытии конвейера
+    упаковываются в один zip-архив с манифестом (manifest.json) и выгружаются одним файлом в
+    YANDEX_BUNDLE_FOLDER. Если задан publish_files, после архива отдельные файлы выгружаются в свои папки
+    в фоне; дождаться их можно методом wait_published. В этом режиме все отчеты запуска хранятся в памяти
+    до закрытия конвейера.
+    """
+    def __init__(self, uploader: YandexUploadManager = None, render_workers: int = None, upload_workers: int = None,
+                 queue_size: int = None, bundle: bool = False, publish_files: bool = None):
+        """
+        :param uploader: менеджер выгрузки, по умолчанию YandexUploadManager()
+        :param render_workers: количество потоков формирования xlsx, по умолчанию config.REPORT_RENDER_WORKERS
+        :param upload_workers: количество потоков выгрузки, по умолчанию config.REPORT_UPLOAD_WORKERS
+        :param queue_size: размер очередей между этапами, по умолчанию config.REPORT_QUEUE_SIZE
+        :param bundle: выгружать все отчеты одним архивом
+        :param publish_files: в режиме архива выгружать также отдельные файлы,
+            по умолчанию config.REPORT_BUNDLE_PUBLISH_FILES
+        """
+        self._uploader = uploader or YandexUploadManager()
+        self._render_queue = queue.Queue(maxsize=queue_size or config.REPORT_QUEUE_SIZE)
+        self._upload_queue = queue.Queue(maxsize=queue_size or config.REPORT_QUEUE_SIZE)
+        self._errors = defaultdict(list)
+        self._timings = {}
+        self._lock = threading.Lock()
+        # готовые файлы для архива: (имя файла, папка, customer_id, содержимое)
+        self._bundle = [] if bundle else None
+        self._publish_files = config.REPORT_BUNDLE_PUBLISH_FILES if publish_files is None else publish_files
+        self._publish_thread = None
+        self._render_threads = [threading.Thread(target=self._render_worker, name=f'report_render_{i}', daemon=True)
+                                for i in range(render_workers or config.REPORT_RENDER_WORKERS)]
+        self._upload_threads = [threading.Thread(target=self._upload_worker, name=f'report_upload_{i}', daemon=True)
+                                for i in range(upload_workers or config.REPORT_UPLOAD_WORKERS)]
+        for thread in self._render_threads + self._upload_threads:
+            thread.start()
+        self._closed = False
+
+    @property
+    def errors(self) -> Dict[int, List[Tuple[str, Exception]]]:
+        """
+        Ошибки формирования и выгрузки по клиентам: {customer_id: [(имя файла, исключение), ...]}
+        """
+        with self._lock:
+            return {customer_id: list(errors) for customer_id, errors in self._errors.items()}
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        """
+        Время выгрузки успешно выгруженных файлов в секундах: {'папка/имя файла': секунды}
+        """
+        with self._lock:
+            return dict(self._timings)
+
+    def _add_error(self, customer_id: int, filename: str, error: Exception):
+        with self._lock:
+            self._errors[customer_id].append((filename, error))
+
+    def submit(self, df: pd.DataFrame, filename: str, folder: str, customer_id: int = None):
+        """
+        Ставит отчет в очередь на формирование и выгрузку.
+        :param df: датафрейм отчета
+        :param filename: имя файла в хранилище
+        :param folder: папка в хранилище
+        :param customer_id: клиент, к которому относится отчет (для группировки ошибок)
+        :return: None
+        """
+        if self._closed:
+            raise RuntimeError('Конвейер отчетов уже закрыт')
+        self._render_queue.put((df, filename, folder, customer_id))
+
+    def _render_worker(self):
+        while True:
+            job = self._render_queue.get()
+            if job is _STOP:
+                break
+            df, filename, folder, customer_id = job
+            try:
+                content = render_xlsx(df)
+            except Exception as e:
+                self._add_error(customer_id, filename, e)
+                continue
+            self._upload_queue.put((content, filename, folder, customer_id))
+
+    def _upload_worker(self):
+        while True:
+            job = self._upload_queue.get()
+            if job is _STOP:
+                break
+            content, filename, folder, customer_id = job
+            if self._bundle is not None:
+                with self._lock:
+                    self._bundle.append((filename, folder, customer_id, content))
+                continue
+            try:
+                elapsed = self._uploader.upload(filename, folder, content)
+                with self._lock:
+                    self._timings[f'{folder}/{filename}'] = elapsed
+                print(f'{filename} uploaded to {folder} in {elapsed:.1f} s.')
+            except Exception as e:
+                self._add_error(customer_id, filename, e)
+
+    def close(self) -> Dict[int, List[Tuple[str, Exception]]]:
+        """
+        Дожидается формирования и выгрузки всех отчетов из очереди и останавливает потоки.
+        :return: ошибки по клиентам (см. errors)
+        """
+        if not self._closed:
+            self._closed = True
+            for _ in self._render_threads:
+                self._render_queue.put(_STOP)
+            for thread in self._render_threads:
+                thread.join()
+            for _ in self._upload_threads:
+                self._upload_queue.put(_STOP)
+            for thread in self._upload_threads:
+                thread.join()
+            if self._bundle:
+                self._upload_bundle()
+        return self.errors
+
+    def _upload_bundle(self):
+        """
+        Упаковывает готовые файлы в zip-архив с манифестом и выгружает его. Если задан publish_files,
+        запускает фоновую выгрузку отдельных файлов.
+        :return: None
+        """
+        # московское время, как в именах файлов отчетов
+        now = datetime.now(timezone(timedelta(hours=3)))
+        archive = io.BytesIO()
+        manifest = []
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for filename, folder, customer_id, content in self._bundle:
+                data = content.getvalue()
+                zf.writestr(f'{folder}/{filename}', data)
+                manifest.append({'path': f'{folder}/{filename}', 'customer_id': customer_id, 'size': len(data)})
+            zf.writestr('manifest.json', json.dumps({'created': now.isoformat(), 'files': manifest},
+                                                    ensure_ascii=False, indent=2))
+        archive.seek(0)
+
+        bundle_name = f'{now:%Y-%m-%d_%H-%M-%S}_reports.zip'
+        try:
+            elapsed = self._uploader.upload(bundle_name, config.YANDEX_BUNDLE_FOLDER, archive)
+            with self._lock:
+                self._timings[f'{config.YANDEX_BUNDLE_FOLDER}/{bundle_name}'] = elapsed
+            print(f'{bundle_name} ({len(manifest)} files) uploaded to {config.YANDEX_BUNDLE_FOLDER} in {elapsed:.1f} s.')
+        except Exception as e:
+            # ошибка архива не относится к конкретному клиенту
+            self._add_error(None, bundle_name, e)
+
+        if self._publish_files:
+            self._publish_thread = threading.Thread(target=self._publish, name='report_publish', daemon=True)
+            self._publish_thread.start()
+
+    def _publish(self):
+        customers = {}
+        files = []
+        for filename, folder, customer_id, content in self._bundle:
+            content.seek(0)
+            customers[f'{folder}/{filename}'] = (customer_id, filename)
+            files.append((filename, folder, content))
+        for path, result in self._uploader.upload_many(files).items():
+            customer_id, filename = customers[path]
+            if isinstance(result, Exception):
+                self._add_error(customer_id, filename, result)
+            else:
+                with self._lock:
+                    self._timings[path] = result
+
+    def wait_published(self) -> Dict[int, List[Tuple[str, Exception]]]:
+        """
+        Дожидается фоновой выгрузки отдельных файлов в режиме архива.
+        :return: ошибки по клиентам с учетом ошибок выгрузки отдельных файлов (см. errors)
+        """
+        if self._publish_thread is not None:
+            self._publish_thread.join()
+        return self.errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
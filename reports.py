@@ -0,0 +1,61 @@
+"""
+Модуль для формирования Excel-отчетов в памяти.
+Отчет записывается построчно через xlsxwriter в режиме constant_memory (в памяти хранится одна строка листа)
+в буфер BytesIO, который сразу передается в хранилище без временного файла на диске.
+"""
+
+import io
+from datetime import date, datetime
+
+import pandas as pd
+import xlsxwriter
+
+import metrics
+
+# количество строк датафрейма, которые одновременно преобразуются в объекты Python
+RENDER_CHUNK_ROWS = 10000
+
+
+@metrics.timed('render_xlsx')
+def render_xlsx(df: pd.DataFrame) -> io.BytesIO:
+    """
+    Записывает датафрейм в Excel-файл в памяти: заголовок из названий столбцов, без индекса
+    (аналог df.to_excel(filename, index=False)).
+    :param df: датафрейм
+    :return: буфер с содержимым xlsx-файла, позиция в начале
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True, 'remove_timezone': True})
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    datetime_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+
+    for col, name in enumerate(df.columns):
+        worksheet.write_string(0, col, str(name), header_format)
+
+    row = 1
+    for start in range(0, len(df), RENDER_CHUNK_ROWS):
+        chunk = df.iloc[start:start + RENDER_CHUNK_ROWS]
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for values in chunk.itertuples(index=False, name=None):
+            for col, value in enumerate(values):
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    worksheet.write_string(row, col, value)
+                elif isinstance(value, bool):
+                    worksheet.write_boolean(row, col, value)
+                elif isinstance(value, (int, float)):
+                    worksheet.write_number(row, col, value)
+                elif isinstance(value, datetime):
+                    worksheet.write_datetime(row, col, value, datetime_format)
+                elif isinstance(value, date):
+                    worksheet.write_datetime(row, col, value, date_format)
+                else:
+                    worksheet.write_string(row, col, str(value))
+            row += 1
+
+    workbook.close()
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,213 @@
+"""
+Полный запуск одним процессом: выгрузка пиццерий из Додо ИС, стоп-лист, отчеты о новых и пропавших клиентах,
+отчеты по заказам и о промокодах. Работа выполняется графом задач (см. orchestrator.py): отчеты клиента
+начинают формироваться, как только записаны в БД его пиццерии и обновлен стоп-лист, не дожидаясь остальных
+клиентов; отчеты о промокодах не зависят от БД и выгружаются параллельно с пиццериями.
+Клиенты с меньшим количеством пиццерий выгружаются первыми, чтобы их отчеты были готовы раньше.
+
+Режимы REPORT_BUNDLE и WORK_QUEUE здесь не используются: отчеты выгружаются по мере готовности клиентов,
+пиццерии выгружает один процесс.
+"""
+
+import asyncio
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import async_http
+import config
+import metrics
+import profiling
+from bot import DigestNotifier
+from decoder import ReportDecoder
+from dodois import DodoEmptyExcelError
+from ledger import RunLedger
+from orchestrator import Job, Orchestrator
+from parameters import ParametersGetter
+from postgresql import Database, DatabasePool
+from report_pipeline import ReportPipeline
+from run_custom import create_promo_reports
+from run_parser import parse_unit, refresh_stop_list, store_unit, sync_units
+from run_tasker import send_errors
+from tasker import DatabaseTasker
+
+debug = False
+
+
+def _group(rows: List, key: Callable) -> Dict[int, List]:
+    """
+    :return: строки, сгруппированные по ключу {ключ: [строки]}
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+    return groups
+
+
+def run():
+    # сообщения для админов копятся и отправляются сводками, как в run_parser
+    try:
+        with DigestNotifier(send=print if debug else None) as notifier:
+            _run(notifier.notify)
+    finally:
+        # сводка по этапам выгрузки, в том числе при ошибке
+        metrics.report('run_all')
+
+
+def _run(log_func: Callable):
+    """
+    Выгрузка данных из Додо ИС в БД и формирование отчетов клиентов.
+    :param log_func: функция для сообщений админам (DigestNotifier.notify)
+    :return: None
+    """
+    db = Database()
+    db.connect()
+    # соединения задач графа: Database не потокобезопасен
+    pool = DatabasePool()
+
+    # список пиццерий нужен для построения графа, поэтому units обновляется до запуска задач
+    try:
+        print('Parsing OpenAPI...')
+        sync_units(db)
+        db.commit()
+    except Exception as e:
+        log_func(f'Ошибка выгрузки DodoOpenAPI: {e}')
+        raise e
+
+    try:
+        print('Getting params...')
+        parsing_params = {params_set[0]: params_set for params_set in ParametersGetter(db=db).get_parsing_params()}
+        tasker = DatabaseTasker(db=db)
+        customer_units = tasker.get_customer_units()
+        new_params = _group(tasker.get_new_params(), lambda row: row[0])
+        lost_params = _group(tasker.get_lost_params(), lambda row: row[0])
+        orders_params = _group(tasker.get_orders_params(), lambda row: row[3])
+        new_promo_params = _group(tasker.get_new_promo_params(), lambda row: row[1])
+        lost_promo_params = _group(tasker.get_lost_promo_params(), lambda row: row[1])
+    except Exception as e:
+        log_func(f'Ошибка получения параметров: {e}')
+        raise e
+
+    run_id = RunLedger(db=db).run_id
+    semaphore = asyncio.Semaphore(config.PARSE_CONCURRENCY)
+    orchestrator = Orchestrator({
+        'stop_list': 1,
+        'download': config.PARSE_CONCURRENCY,
+        'store': config.ORCHESTRATOR_STORE_CONCURRENCY,
+        'reports': config.ORCHESTRATOR_REPORT_CONCURRENCY,
+        'promo': config.ORCHESTRATOR_PROMO_CONCURRENCY,
+    }, log_func=log_func, buffers={
+        # выгрузки ждут записи в памяти: кроме выполняемых выгрузок храним по одной записываемой и одной
+        # ожидающей записи выгрузке на поток записи, следующая пиццерия выгружается, когда запись освободит место
+        'download': config.PARSE_CONCURRENCY + 2 * config.ORCHESTRATOR_STORE_CONCURRENCY,
+    })
+
+    with ReportDecoder() as decoder:
+        def update_stop_list():
+            stop_list_db = pool.get()
+            try:
+                refresh_stop_list(stop_list_db)
+                stop_list_db.commit()
+            except Exception as e:
+                stop_list_db.rollback()
+                raise RuntimeError(f'Ошибка выгрузки файла с обзвоненными клиентами: {e}') from e
+
+        def download(params_set: list) -> Future:
+            future = async_http.submit(parse_unit(params_set, decoder, semaphore))
+            # ошибки выгрузки разбирает store_unit, поэтому задача возвращает саму выгрузку
+            future.exception()
+            return future
+
+        def store(id_: int, params_set: list, download_job: Job):
+            store_db = pool.get()
+            try:
+                ledger = RunLedger(db=store_db, run_id=run_id)
+                store_unit(download_job.result, id_, params_set, store_db, log_func, ledger, None, [])
+            except Exception:
+                store_db.rollback()
+                raise
+
+        def reports(customer_id: int):
+            print(f'creating reports for customer {customer_id}...')
+            reports_db = pool.get()
+            with ReportPipeline() as pipeline:
+                customer_tasker = DatabaseTasker(db=reports_db, pipeline=pipeline)
+                try:
+                    customer_tasker.create_new_clients_tables(new_params.get(customer_id, []))
+                    customer_tasker.create_lost_clients_tables(lost_params.get(customer_id, []))
+                    try:
+                        customer_tasker.create_orders_tables(orders_params.get(customer_id, []))
+                    except DodoEmptyExcelError as e:
+                        print(e.message)
+                except Exception:
+                    # соединение потока используется следующими задачами
+                    reports_db.rollback()
+                    raise
+            # если какой-то отчет клиента не выгрузился, не сдвигаем его lost_start_date (как в run_tasker)
+            if pipeline.errors:
+                reports_db.rollback()
+            else:
+                reports_db.commit()
+            send_errors(log_func, pipeline.errors)
+
+        def promo(customer_id: int):
+            with ReportPipeline() as pipeline:
+                promo_tasker = DatabaseTasker(db=pool.get(), pipeline=pipeline)
+                create_promo_reports(promo_tasker, new_promo_params.get(customer_id, []), 'НК')
+                create_promo_reports(promo_tasker, lost_promo_params.get(customer_id, []), 'ПК')
+            send_errors(log_func, pipeline.errors)
+
+        def add_unit(id_: int, params_set: list) -> Job:
+            # выгрузка пиццерии и запись в БД; возвращает задачу записи
+            download_job = orchestrator.add('download', params_set[2], lambda: download(params_set))
+            return orchestrator.add('store', params_set[2], lambda: store(id_, params_set, download_job),
+                                    [download_job])
+
+        stop_list_job = orchestrator.add('stop_list', 'stop_list', update_stop_list)
+        # порядок добавления - приоритет: сначала клиенты с меньшим количеством пиццерий
+        customers = sorted(set(customer_units) | set(new_promo_params) | set(lost_promo_params),
+                           key=lambda customer_id: (len(customer_units.get(customer_id, [])), customer_id))
+        report_jobs = {}
+        for customer_id in customers:
+            store_jobs = []
+            for id_ in customer_units.get(customer_id, []):
+                if id_ not in parsing_params:
+                    continue
+                _, *params_set = parsing_params.pop(id_)  # (unit_id, unit_name, login... )
+                store_jobs.append(add_unit(id_, params_set))
+            if customer_id in customer_units:
+                report_jobs[customer_id] = orchestrator.add('reports', str(customer_id),
+                                                            lambda customer_id=customer_id: reports(customer_id),
+                                                            [stop_list_job] + store_jobs)
+            if customer_id in new_promo_params or customer_id in lost_promo_params:
+                orchestrator.add('promo', str(customer_id), lambda customer_id=customer_id: promo(customer_id))
+        # активные пиццерии без клиента: выгружаются, но отчетов по ним нет
+        for id_, *params_set in parsing_params.values():
+            add_unit(id_, params_set)
+
+        orchestrator.run()
+
+    # пиццерии, которые выгружались заметно дольше обычного
+    for _, unit_name, seconds, median in RunLedger(db=db, run_id=run_id).regressions():
+        log_func(f'выгрузка заняла {seconds:.0f} с, обычно {median:.0f} с', unit=unit_name, severity='warning')
+
+    # через сколько секунд после начала запуска были готовы отчеты клиентов
+    for customer_id, job in report_jobs.items():
+        elapsed = orchestrator.elapsed(job)
+        print(f'customer {customer_id}: {job.state}' + (f' in {elapsed:.1f} s' if elapsed is not None else ''))
+    print(orchestrator.summary())
+
+    pool.close()
+    db.close()
+
+    failed = [job for job in orchestrator.jobs if job.state == 'failed']
+    if failed:
+        raise RuntimeError(f'Задачи завершились ошибкой: {", ".join(map(str, failed))}')
+    log_func(f'Выгрузка отчётов завершена.\n'
+             f'Новые: https://disk.yandex.ru/client/disk/{config.YANDEX_NEW_CLIENTS_FOLDER}\n'
+             f'Пропавшие: https://disk.yandex.ru/client/disk/{config.YANDEX_LOST_CLIENTS_FOLDER}', severity='info')
+    print('all tasks completed.')
+
+
+if __name__ == '__main__':  # явный запуск скрипта
+    profiling.configure()
+    run()
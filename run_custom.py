@@ -1,33 +1,37 @@
+from typing import List, Tuple
 from zipfile import BadZipFile
 
+import metrics
+import profiling
 from dodois import DodoISParser, DodoAuthError, DodoResponseError, DodoEmptyExcelError
 from postgresql import Database
+from report_pipeline import ReportPipeline
 from tasker import DatabaseTasker
 
 
-def run():
-    """
-    Скрипт делает три вещи:
-    1. парсит промокоды из Додо ИС, с данными: пиццерии is_active + new_shop_exclude \ lost_shop_exclude, даты из
-    promos_start_date, promos_end_date;
-    2. делает excel файлы по спарcенным промо и выгружает на яндекс диск
-    3. выгружает заказы за период promos_start_date, promos_end_date по пиццериям is_active на яндекс диск
-    """
-
-    db = Database()
-    db.connect()
+# отчеты о промокодах: {суффикс файла: (название в сообщениях и профилях, название клиентов)}
+PROMO_REPORTS = {'НК': ('new', 'new clients'), 'ПК': ('lost', 'lost clients')}
 
-    tasker = DatabaseTasker(db=db)
 
-    # новые клиенты - промо
-
-    for id_, customer_id, *params in tasker.get_new_promo_params():
+def create_promo_reports(tasker: DatabaseTasker, units_params: List[Tuple], suffix: str):
+    """
+    Выгружает из Додо ИС расход промокодов пиццерий и формирует отчеты. Ошибки пиццерии не прерывают выгрузку
+    остальных пиццерий.
+    :param tasker: DatabaseTasker (с конвейером отчетов или без)
+    :param units_params: параметры пиццерий (DatabaseTasker.get_new_promo_params или get_lost_promo_params)
+    :param suffix: НК - новые клиенты, ПК - пропавшие клиенты
+    :return: None
+    """
+    kind, clients = PROMO_REPORTS[suffix]
+    for id_, customer_id, *params in units_params:
         try:
-            print(f'parsing new clients promos for id {id_}, params {params}')
-            dodois_parser = DodoISParser(*params)
-            dodois_result = dodois_parser.parse('promo')
-            tasker.create_promo_tables(dodois_result, customer_id, params[2], params[6], params[7], 'НК')
-            print(f'creating new clients promo report for id {id_} completed.')
+            print(f'parsing {clients} promos for id {id_}, params {params}')
+            with profiling.profile(f'run_custom_promo_{kind}_{id_}_{params[2]}', id_, params[2], 'promo') as profiler:
+                # профилировщик (если пиццерия - цель профилирования) разбирает Excel под профилем
+                dodois_parser = DodoISParser(*params, decoder=profiler)
+                dodois_result = dodois_parser.parse('promo')
+                tasker.create_promo_tables(dodois_result, customer_id, params[2], params[6], params[7], suffix)
+            print(f'creating {clients} promo report for id {id_} completed.')
 
         except (ValueError, BadZipFile) as e:
             print(f'{params[2]}: Что-то пошло не так ({e})')
@@ -37,32 +41,61 @@ def run():
             print(f'Ошибка выгрузки из Додо ИС: {e}')
             raise e
 
-    # потоерянные клиенты - промо
-    for id_, customer_id, *params in tasker.get_lost_promo_params():
+
+def run(db: Database = None):
+    """
+    :param db: открытое соединение с БД (демон держит его между запусками), по умолчанию новое
+    """
+    try:
+        _run(db)
+    finally:
+        # сводка по этапам выгрузки, в том числе при ошибке
+        metrics.report('run_custom')
+
+
+def _run(db: Database = None):
+    """
+    Скрипт делает три вещи:
+    1. парсит промокоды из Додо ИС, с данными: пиццерии is_active + new_shop_exclude \ lost_shop_exclude, даты из
+    promos_start_date, promos_end_date;
+    2. делает excel файлы по спарcенным промо и выгружает на яндекс диск
+    3. выгружает заказы за период promos_start_date, promos_end_date по пиццериям is_active на яндекс диск
+    :param db: открытое соединение с БД; если не передано, открывается здесь
+    """
+
+    if db is None:
+        db = Database()
+        db.connect()
+
+    # отчеты формируются и выгружаются в фоне, пока выгружаются следующие пиццерии;
+    # при выходе из блока дожидаемся выгрузки всех отчетов из очереди
+    with ReportPipeline() as pipeline:
+        tasker = DatabaseTasker(db=db, pipeline=pipeline)
+
+        # новые клиенты - промо
+        create_promo_reports(tasker, tasker.get_new_promo_params(), 'НК')
+
+        # потерянные клиенты - промо
+        create_promo_reports(tasker, tasker.get_lost_promo_params(), 'ПК')
+
+        # заказы
         try:
-            print(f'parsing lost clients promos for id {id_}, params {params}')
-            dodois_parser = DodoISParser(*params)
-            dodois_result = dodois_parser.parse('promo')
-            tasker.create_promo_tables(dodois_result, customer_id, params[2], params[6], params[7], 'ПК')
-            print(f'creating lost clients promo report for id {id_} completed.')
+            print('parsing orders...')
+            tasker.create_orders_tables()
+        except DodoEmptyExcelError as e:
+            print(e.message)
 
-        except (ValueError, BadZipFile) as e:
-            print(f'{params[2]}: Что-то пошло не так ({e})')
-        except (DodoAuthError, DodoResponseError, DodoEmptyExcelError) as e:
-            print(f'{params[2]}: {e.message}')
-        except Exception as e:
-            print(f'Ошибка выгрузки из Додо ИС: {e}')
-            raise e
+    for customer_id, customer_errors in pipeline.errors.items():
+        for filename, e in customer_errors:
+            print(f'Ошибка выгрузки отчёта {filename} для клиента {customer_id}: {getattr(e, "message", e)}')
 
-    # заказы
-    try:
-        print('parsing orders...')
-        tasker.create_orders_tables()
-    except DodoEmptyExcelError as e:
-        print(e.message)
+    # самые долгие выгрузки (обычно это отчеты по заказам)
+    for path, elapsed in sorted(pipeline.timings.items(), key=lambda item: item[1], reverse=True)[:5]:
+        print(f'{path}: {elapsed:.1f} s')
 
     print('all tasks completed.')
 
 
 if __name__ == '__main__':  # явный запуск скрипта
+    profiling.configure()
     run()
\ No newline at end of file
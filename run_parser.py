@@ -1,34 +1,249 @@
+import asyncio
+import contextlib
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from datetime import timezone, datetime
+from typing import Callable, Iterable, Optional, Tuple
 from zipfile import BadZipFile
 
-from bot import Bot
+import async_http
+import config
+import metrics
+import profiling
+from bot import DigestNotifier
 from dodo_openapi import DodoOpenAPIParser, DodoOpenAPIStorer
-from dodois import DodoISParser, DodoISStorer, DodoAuthError, DodoEmptyExcelError, DodoResponseError
+from decoder import ReportDecoder
+from dodois import AsyncDodoISParser, DodoISStorer, DodoAuthError, DodoEmptyExcelError, DodoResponseError
 from feedback import FeedbackParser, FeedbackStorer
+from ledger import RunLedger
 from parameters import ParametersGetter
 from postgresql import Database
+from work_queue import UnitWorkQueue
 
 debug = False
 
 
-def run():
-    db = Database()
-    db.connect()
+async def parse_unit(params_set: list, decoder: ReportDecoder, semaphore: asyncio.Semaphore) -> Tuple:
+    """
+    Выгружает отчеты одной пиццерии. Выполняется в общем цикле событий, разбор Excel-файлов - в пуле процессов.
+    :param params_set: параметры DodoISParser
+    :param decoder: пул процессов для разбора Excel (или профилировщик, см. profiling.UnitProfiler)
+    :param semaphore: ограничение количества одновременно выгружаемых пиццерий
+    :return: кортеж (статистика по клиентам, заказы, статистика по клиентам для сверки, статистика выгрузки).
+        При ошибке у исключения есть атрибуты unit_stats (статистика выгрузки до ошибки) и unit_stage
+        (этап ошибки: download или decode) для журнала запуска
+    """
+    async with semaphore:
+        print(f'parsing params {params_set}...')
+        started = time.perf_counter()
+        dodois_parser = AsyncDodoISParser(*params_set, decoder=decoder)
+        try:
+            if config.CLIENTS_SOURCE == 'orders':
+                dodois_orders = await dodois_parser.parse('orders')
+                reconcile_sample = None
+                if random.random() < config.CLIENTS_RECONCILE_SHARE:
+                    # сверка - только проверка: ошибка выгрузки выборки не должна мешать записи заказов
+                    try:
+                        reconcile_sample = await dodois_parser.parse('clients_statistic')
+                    except Exception as e:
+                        print(f'{params_set[2]}: сверка пропущена, не удалось выгрузить статистику по клиентам '
+                              f'({getattr(e, "message", e)})')
+                dodois_clients_statistic = None
+            else:
+                dodois_clients_statistic = await dodois_parser.parse('clients_statistic')
+                dodois_orders = await dodois_parser.parse('orders')
+                reconcile_sample = None
+        except Exception as e:
+            e.unit_stats = dict(dodois_parser.stats, total_seconds=time.perf_counter() - started)
+            e.unit_stage = dodois_parser.stage
+            raise
+        stats = dict(dodois_parser.stats, parse_seconds=time.perf_counter() - started)
+        return dodois_clients_statistic, dodois_orders, reconcile_sample, stats
 
-    bot = Bot()
 
-    if debug:
-        log_func = print
-    else:
-        log_func = bot.send_message
+def _parse_units(params: list, db: Database, decoder: ReportDecoder, log_func: Callable, ledger: RunLedger,
+                 work_queue: UnitWorkQueue = None):
+    """
+    Выгружает пиццерии и записывает результаты в БД. В режиме WORK_QUEUE новые пиццерии арендуются по мере того,
+    как освобождаются места, чтобы одновременно выгружалось около PARSE_CONCURRENCY пиццерий, пока очередь
+    не опустеет.
+    :param params: параметры пиццерий (ParametersGetter.get_parsing_params)
+    :param db: соединение с БД
+    :param decoder: пул процессов для разбора Excel
+    :param log_func: функция для сообщений админам
+    :param ledger: журнал запуска, в который пишется статистика каждой пиццерии
+    :param work_queue: очередь, из которой арендуются пиццерии (режим WORK_QUEUE)
+    :return: None
+    """
+    semaphore = asyncio.Semaphore(config.PARSE_CONCURRENCY)
+    # пиццерии для профилирования (по id или названию) выгружаются по одной после остальных,
+    # чтобы в профиль не попала работа других пиццерий
+    profiled = []
+    futures = {}
+
+    def submit(units: list):
+        for params_set in units:
+            if profiling.is_target(params_set[0], params_set[3]):
+                profiled.append(params_set)
+            else:
+                id_, *parser_params = params_set  # (unit_id, unit_name, login... )
+                futures[async_http.submit(parse_unit(parser_params, decoder, semaphore))] = (id_, parser_params)
+
+    def claim() -> bool:
+        # дозаполняем свободные места из очереди; False - очередь опустела
+        while len(futures) < config.PARSE_CONCURRENCY:
+            batch = work_queue.claim(min(config.WORK_QUEUE_BATCH, config.PARSE_CONCURRENCY - len(futures)))
+            if not batch:
+                return False
+            submit(batch)
+        return True
+
+    submit(params)
+    queue_open = work_queue is not None and claim()
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            # выгрузка удаляется сразу после записи, чтобы датафреймы записанных пиццерий не копились до конца
+            id_, params_set = futures.pop(future)
+            store_unit(future, id_, params_set, db, log_func, ledger, work_queue, futures)
+        if queue_open:
+            queue_open = claim()
+    for id_, *params_set in profiled:
+        with profiling.UnitProfiler(f'run_parser_{id_}_{params_set[2]}') as profiler:
+            # профилировщик разбирает Excel в этом процессе, чтобы разбор попал в профиль
+            future = async_http.submit(parse_unit(params_set, profiler, semaphore))
+            store_unit(future, id_, params_set, db, log_func, ledger, work_queue, [future])
+
+
+def store_unit(future: Future, id_: int, params_set: list, db: Database, log_func: Callable, ledger: RunLedger,
+                work_queue: Optional[UnitWorkQueue], futures: Iterable[Future]):
+    """
+    Дожидается выгрузки пиццерии и записывает результат в БД; ошибки пиццерии сообщаются админам.
+    :param future: выгрузка пиццерии (parse_unit)
+    :param id_: id пиццерии (units.id)
+    :param params_set: параметры DodoISParser
+    :param futures: все выгрузки, которые отменяются при непредвиденной ошибке
+    :return: None
+    """
+    stats = None
+    try:
+        dodois_clients_statistic, dodois_orders, reconcile_sample, stats = future.result()
+        store_started = time.perf_counter()
+        dodois_storer = DodoISStorer(id_, db=db)
+        if config.CLIENTS_SOURCE == 'orders':
+            # клиентов пересчитываем из заказов, статистика выгружена только для сверки по выборке
+            dodois_storer.store(None, dodois_orders, derive_clients=True)
+            if reconcile_sample is not None:
+                reconciliation = dodois_storer.reconcile(reconcile_sample, dodois_orders)
+                if any(value > 0 for key, value in reconciliation.items() if key != 'phones'):
+                    log_func(f'расхождения клиентов из заказов со статистикой по клиентам {reconciliation}',
+                             unit=params_set[2], severity='warning')
+        else:
+            dodois_storer.store(dodois_clients_statistic, dodois_orders)
+        stats['store_seconds'] = time.perf_counter() - store_started
+        stats['total_seconds'] = stats.pop('parse_seconds') + stats['store_seconds']
+        stats['rows'] = sum(len(df) for df in (dodois_clients_statistic, dodois_orders) if df is not None)
+        ledger.record(id_, stats)
+        if work_queue is not None:
+            work_queue.complete(id_)
+        db.commit()  # после каждой пиццерии
+    except (ValueError, BadZipFile, DodoAuthError, DodoResponseError, DodoEmptyExcelError) as e:
+        if isinstance(e, (ValueError, BadZipFile)):
+            log_func(f'Что-то пошло не так ({e})', unit=params_set[2])
+        else:
+            log_func(e.message, unit=params_set[2])
+        if stats is None:
+            # ошибка выгрузки: статистику до ошибки и этап передает parse_unit
+            stats, stage = getattr(e, 'unit_stats', None), getattr(e, 'unit_stage', None)
+        else:
+            # запись не удалась: откатываем недописанные строки пиццерии, фиксируется только строка журнала
+            # (предыдущие пиццерии, аренда и units к этому моменту уже зафиксированы)
+            db.rollback()
+            stats['store_seconds'] = time.perf_counter() - store_started
+            stats['total_seconds'] = stats.pop('parse_seconds') + stats['store_seconds']
+            stage = 'store'
+        ledger.record(id_, stats, error=str(getattr(e, 'message', e)), stage=stage)
+        if work_queue is not None:
+            # пиццерию с ошибкой в этом запуске больше не берем
+            work_queue.release(id_, retry_after=config.WORK_QUEUE_RETRY_DELAY)
+        db.commit()
+    except Exception as e:
+        log_func(f'Ошибка выгрузки из Додо ИС: {e}')
+        for other_future in futures:
+            other_future.cancel()
+        raise e
+
+
+def sync_units(db: Database):
+    """
+    Обновляет таблицу units по публичному API Dodo; если список пиццерий не изменился с прошлого раза,
+    таблица не меняется.
+    :param db: соединение с БД
+    :return: None
+    """
+    api_parser = DodoOpenAPIParser()
+    api_storer = DodoOpenAPIStorer(db=db)
+    api_result = api_parser.parse(api_storer.get_validators())
+    if api_result:
+        api_storer.store(*api_result)
+
+
+def refresh_stop_list(db: Database):
+    """
+    Обновляет стоп-лист из файла обзвоненных клиентов, если файл изменился (по md5 или дате изменения).
+    :param db: соединение с БД
+    :return: None
+    """
+    params_getter = ParametersGetter(db=db)
+    try:
+        stop_list_last_modified_date = params_getter.get_config_param('StopListLastModifiedDate')[0]
+    except TypeError:
+        stop_list_last_modified_date = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+    try:
+        stop_list_md5 = params_getter.get_config_param('StopListMd5')[0]
+    except TypeError:
+        stop_list_md5 = None
+    feedback_parser = FeedbackParser()
+    feedback_storer = FeedbackStorer(db=db)
+    feedback_result = feedback_parser.parse(stop_list_last_modified_date, stop_list_md5)
+    if feedback_result:
+        feedback_storer.store(*feedback_result)
+
+
+def run(db: Database = None, decoder: ReportDecoder = None):
+    """
+    :param db: открытое соединение с БД (демон держит его между запусками), по умолчанию новое
+    :param decoder: пул процессов для разбора Excel (демон держит его между запусками), по умолчанию новый
+    """
+    # сообщения для админов копятся и отправляются сводками: в фоне по таймеру и в конце выгрузки
+    try:
+        with DigestNotifier(send=print if debug else None) as notifier:
+            _run(notifier.notify, db, decoder)
+    finally:
+        # сводка по этапам выгрузки, в том числе при ошибке
+        metrics.report('run_parser')
+
+
+def _run(log_func: Callable, db: Database = None, decoder: ReportDecoder = None):
+    """
+    Выгрузка данных из Додо ИС в БД.
+    :param log_func: функция для сообщений админам (DigestNotifier.notify)
+    :param db: открытое соединение с БД; если не передано, открывается и закрывается здесь
+    :param decoder: пул процессов для разбора Excel; если не передан, создается на время выгрузки
+    :return: None
+    """
+    external_db = db is not None
+    if not external_db:
+        db = Database()
+        db.connect()
 
     # обновляем данные таблицы units
     try:
         print('Parsing OpenAPI...')
-        api_parser = DodoOpenAPIParser()
-        api_storer = DodoOpenAPIStorer(db=db)
-        api_result = api_parser.parse()
-        api_storer.store(api_result)
+        sync_units(db)
+        # фиксируем сразу: ошибка записи пиццерии откатывает транзакцию (см. store_unit)
+        db.commit()
     except Exception as e:
         log_func(f'Ошибка выгрузки DodoOpenAPI: {e}')
         raise e
@@ -37,50 +252,46 @@ def run():
     try:
         print('Getting params...')
         params_getter = ParametersGetter(db=db)
-        params = params_getter.get_parsing_params()
+        # в режиме очереди пиццерии арендуются ниже по мере выгрузки
+        params = [] if config.WORK_QUEUE else params_getter.get_parsing_params()
     except Exception as e:
         log_func(f'Ошибка получения параметров: {e}')
         raise e
 
-    # передаем парсерам
-    for (id_, *params_set) in params:  # (unit_id, unit_name, login... )
-        try:
-            print(f'parsing id {id_}, params {params_set}...')
-            dodois_parser = DodoISParser(*params_set)
-            dodois_storer = DodoISStorer(id_, db=db)
-            dodois_clients_statistic = dodois_parser.parse('clients_statistic')
-            dodois_orders = dodois_parser.parse('orders')
-            dodois_storer.store(dodois_clients_statistic, dodois_orders)
-            db.commit()  # после каждой пиццерии
-        except (ValueError, BadZipFile) as e:
-            log_func(f'{params_set[2]}: Что-то пошло не так ({e})')
-        except (DodoAuthError, DodoResponseError, DodoEmptyExcelError) as e:
-            log_func(f'{params_set[2]}: {e.message}')
-        except Exception as e:
-            log_func(f'Ошибка выгрузки из Додо ИС: {e}')
-            raise e
+    # передаем парсерам: выгрузка в общем цикле событий, разбор Excel в пуле процессов,
+    # запись в БД в основном потоке по мере готовности пиццерий
+    ledger = RunLedger(db=db)
+    with (ReportDecoder() if decoder is None else contextlib.nullcontext(decoder)) as decoder:
+        if config.WORK_QUEUE:
+            # пиццерии берем из общей очереди по мере освобождения мест, пока она не опустеет;
+            # другие воркеры делают то же самое
+            with UnitWorkQueue(db=db) as work_queue:
+                print(f'Worker {work_queue.worker_id} started')
+                _parse_units([], db, decoder, log_func, ledger, work_queue)
+        else:
+            _parse_units(params, db, decoder, log_func, ledger)
+
+    # пиццерии, которые выгружались заметно дольше обычного
+    for _, unit_name, seconds, median in ledger.regressions():
+        log_func(f'выгрузка заняла {seconds:.0f} с, обычно {median:.0f} с', unit=unit_name, severity='warning')
 
     # обновляем таблицы с фидбеком
     try:
         print('Updating stop list...')
-        try:
-            stop_list_last_modified_date = params_getter.get_config_param('StopListLastModifiedDate')[0]
-        except TypeError:
-            stop_list_last_modified_date = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
-        feedback_parser = FeedbackParser()
-        feedback_storer = FeedbackStorer(db=db)
-        feedback_result = feedback_parser.parse(stop_list_last_modified_date)
-        if feedback_result:
-            feedback_storer.store(*feedback_result)
+        refresh_stop_list(db)
     except Exception as e:
         log_func(f'Ошибка выгрузки файла с обзвоненными клиентами: {e}')
         raise e
 
     print('Parsing complete!')
 
-    # закрываем соединение
-    db.close()
+    # закрываем соединение (чужое только фиксируем)
+    if external_db:
+        db.commit()
+    else:
+        db.close()
 
 
 if __name__ == '__main__':  # явный запуск скрипта
+    profiling.configure()
     run()
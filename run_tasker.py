@@ -1,24 +1,83 @@
-from bot import Bot
-from config import YANDEX_NEW_CLIENTS_FOLDER, YANDEX_LOST_CLIENTS_FOLDER
+from typing import Callable, Dict, List, Tuple
+
+import metrics
+import profiling
+from bot import DigestNotifier
+from config import YANDEX_NEW_CLIENTS_FOLDER, YANDEX_LOST_CLIENTS_FOLDER, YANDEX_BUNDLE_FOLDER, REPORT_BUNDLE
+from postgresql import Database
+from report_pipeline import ReportPipeline
 from storage import YandexCreateFolderError, YandexUploadError, YandexFileNotFound
 from tasker import DatabaseTasker
 
 
-def run():
-    bot = Bot()
+def send_errors(log_func: Callable, errors: Dict[int, List[Tuple[str, Exception]]]):
+    """
+    Сообщает админам ошибки выгрузки отчетов; в сводке ошибки сгруппированы по клиентам.
+    :param log_func: функция для сообщений админам (DigestNotifier.notify)
+    :param errors: ошибки по клиентам (см. ReportPipeline.errors)
+    :return: None
+    """
+    for customer_id, customer_errors in errors.items():
+        title = 'Архив отчётов' if customer_id is None else f'Клиент {customer_id}'
+        for filename, e in customer_errors:
+            if isinstance(e, (YandexCreateFolderError, YandexUploadError, YandexFileNotFound)):
+                log_func(e.message, unit=title)
+            else:
+                log_func(f'{filename}: Что-то пошло не так ({e})', unit=title)
+
 
+def run(db: Database = None):
+    """
+    :param db: открытое соединение с БД (демон держит его между запусками), по умолчанию новое
+    """
+    # сообщения для админов копятся и отправляются сводками, как в run_parser
     try:
-        db_tasker = DatabaseTasker()
-        db_tasker.create_new_clients_tables()
-        db_tasker.create_lost_clients_tables()
-        db_tasker.db_close()
-    except (YandexCreateFolderError, YandexUploadError, YandexFileNotFound) as e:
-        bot.send_message(e.message)
+        with DigestNotifier() as notifier:
+            _run(notifier.notify, db)
+    finally:
+        # сводка по этапам выгрузки, в том числе при ошибке
+        metrics.report('run_tasker')
+
+
+def _run(log_func: Callable, db: Database = None):
+    """
+    Формирование и выгрузка отчетов о новых и пропавших клиентах.
+    :param log_func: функция для сообщений админам (DigestNotifier.notify)
+    :param db: открытое соединение с БД; если не передано, открывается и закрывается здесь
+    :return: None
+    """
+    with ReportPipeline(bundle=REPORT_BUNDLE) as pipeline:
+        db_tasker = DatabaseTasker(db=db, pipeline=pipeline)
+        with profiling.profile('run_tasker_new_clients', 'new_clients'):
+            db_tasker.create_new_clients_tables()
+        lost_params = db_tasker.get_lost_params()
+        with profiling.profile('run_tasker_lost_clients', 'lost_clients'):
+            db_tasker.create_lost_clients_tables(lost_params)
+    errors = pipeline.errors
+    # если отчет клиента не выгрузился, возвращаем lost_start_date его пиццерий, чтобы при следующем запуске
+    # отчет о пропавших клиентах сформировался заново; сдвиг остальных клиентов фиксируется.
+    # Ошибка без клиента (архив REPORT_BUNDLE) относится ко всем клиентам
+    failed = {customer_id for customer_id, customer_errors in errors.items() if customer_errors}
+    db_tasker.restore_lost_start_dates([row for row in lost_params if row[0] in failed or None in failed])
+    db_tasker.db_close()
+    if db is not None:
+        # чужое соединение не закрываем, только фиксируем
+        db.commit()
+    send_errors(log_func, errors)
 
-    bot.send_message(f'Выгрузка отчётов завершена.\n'
-                     f'Новые: https://disk.yandex.ru/client/disk/{YANDEX_NEW_CLIENTS_FOLDER}\n'
-                     f'Пропавшие: https://disk.yandex.ru/client/disk/{YANDEX_LOST_CLIENTS_FOLDER}')
+    if REPORT_BUNDLE:
+        log_func(f'Выгрузка отчётов завершена.\n'
+                 f'Архив: https://disk.yandex.ru/client/disk/{YANDEX_BUNDLE_FOLDER}', severity='info')
+        # отдельные файлы выгружаются в фоне после архива, сообщаем только о новых ошибках
+        published_errors = pipeline.wait_published()
+        send_errors(log_func, {customer_id: customer_errors[len(errors.get(customer_id, [])):]
+                          for customer_id, customer_errors in published_errors.items()})
+    else:
+        log_func(f'Выгрузка отчётов завершена.\n'
+                 f'Новые: https://disk.yandex.ru/client/disk/{YANDEX_NEW_CLIENTS_FOLDER}\n'
+                 f'Пропавшие: https://disk.yandex.ru/client/disk/{YANDEX_LOST_CLIENTS_FOLDER}', severity='info')
 
 
 if __name__ == '__main__':
+    profiling.configure()
     run()
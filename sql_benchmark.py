@@ -0,0 +1,336 @@
+"""
+Бенчмарк SQL-запросов отчетов и записи в БД на синтетических данных заданного объема.
+Скрипт заполняет отдельную БД Postgres таблицами units, auth, manager, clients, stop_list и orders
+(например, 10 млн клиентов и 100 млн заказов), затем выполняет рабочий код: DatabaseTasker (новые и пропавшие
+клиенты, заказы за период) и DodoISStorer.store (upsert клиентов и вставка заказов из синтетических выгрузок).
+Каждый запрос перед выполнением прогоняется через EXPLAIN (ANALYZE, BUFFERS) в точке сохранения, изменения
+которой откатываются; в конце откатываются и все изменения самих запросов, поэтому данные БД между запусками
+не меняются. Для каждого запроса сохраняются время (сумма, максимум, медиана по вызовам), буферы и форма плана
+(узлы, таблицы, индексы без оценок стоимости).
+
+Результаты сохраняются в BENCHMARK_DIR/sql_<коммит>.json; --compare сравнивает с сохраненным файлом и завершается
+с кодом 1, если запрос стал медленнее в --threshold раз (и больше чем на --min-delta мс) или изменился его план.
+Заполнение 100 млн заказов занимает десятки минут, поэтому после изменения схемы или индексов данные можно
+не пересоздавать: --skip-seed.
+
+Пример: python sql_benchmark.py --pg-database dodozvon_bench --clients 10000000 --orders 100000000
+        python sql_benchmark.py --pg-database dodozvon_bench --skip-seed --compare benchmark_results/sql_1a2b3c4.json
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+import synthetic
+from benchmark import BENCHMARK_DIR, git_commit
+from dodois import DodoEmptyExcelError, DodoISParser, DodoISStorer
+from postgresql import Database
+from tasker import DatabaseTasker
+
+TIMEZONE = 'Europe/Moscow'
+# строк в одной пачке заполнения: каждая пачка - отдельная транзакция
+SEED_BATCH = 1000000
+
+
+class ExplainDatabase(Database):
+    """
+    Соединение с БД, которое выполняет каждый запрос дважды: сначала EXPLAIN (ANALYZE, BUFFERS) в точке сохранения
+    с откатом, затем сам запрос. Запросы объясняются, только пока задана метка label.
+    """
+    def __init__(self, database: str):
+        """
+        :param database: имя БД
+        """
+        super().__init__()
+        self._database = database
+        # метка текущих запросов; None - запросы не объясняются (создание таблиц, заполнение)
+        self.label: Optional[str] = None
+        # {метка: [(время выполнения мс, время планирования мс, буферы, форма плана, план)]}
+        self.plans = defaultdict(list)
+
+    def execute(self, query: str, argslist: Union[List, Tuple] = None):
+        if self.label is not None:
+            self._explain(query, argslist)
+        super().execute(query, argslist)
+
+    def _explain(self, query: str, argslist: Union[List, Tuple] = None):
+        explain = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query
+        self._cur.execute('SAVEPOINT explain_analyze;')
+        # та же ветка, что и в Database.execute: много строк с одним %s - VALUES одним запросом
+        if argslist and len(argslist) > 1 and query.count('%s') == 1:
+            rows = execute_values(self._cur, explain, argslist, page_size=len(argslist), fetch=True)
+        else:
+            self._cur.execute(explain, argslist)
+            rows = self._cur.fetchall()
+        self._cur.execute('ROLLBACK TO SAVEPOINT explain_analyze;')
+        result = rows[0][0][0]
+        statement = re.match(r'\s*(INSERT INTO|UPDATE|DELETE FROM)\s+(\w+)', query, re.IGNORECASE)
+        # запросы на изменение записываются отдельно: store выполняет несколько разных запросов
+        label = self.label if statement is None else \
+            f'{self.label}_{statement.group(1).split()[0].lower()}_{statement.group(2)}'
+        plan = result['Plan']
+        self.plans[label].append((result['Execution Time'], result['Planning Time'], _buffers(plan),
+                                  _plan_shape(plan), result))
+
+
+def _buffers(plan: Dict) -> Dict[str, int]:
+    """
+    :return: буферы корневого узла плана (суммарно по всем узлам)
+    """
+    return {key: plan.get(key, 0) for key in ('Shared Hit Blocks', 'Shared Read Blocks', 'Temp Read Blocks',
+                                              'Temp Written Blocks')}
+
+
+def _plan_shape(plan: Dict, depth: int = 0) -> str:
+    """
+    Форма плана без оценок и фактических значений: узлы, таблицы и индексы с отступами по вложенности.
+    """
+    node = plan['Node Type']
+    for key in ('Join Type', 'Relation Name', 'Index Name', 'Strategy'):
+        if key in plan:
+            node += f' {plan[key]}'
+    lines = ['  ' * depth + node]
+    for child in plan.get('Plans', []):
+        lines.append(_plan_shape(child, depth + 1))
+    return '\n'.join(lines)
+
+
+class BenchmarkTasker(DatabaseTasker):
+    """
+    DatabaseTasker, который помечает запросы названием отчета и не формирует файлы отчетов.
+    """
+    def _query(self, report: str, query: str, args: Tuple = None) -> List[Tuple]:
+        self._db.label = report
+        try:
+            return super()._query(report, query, args)
+        finally:
+            self._db.label = None
+
+    def _upload_report(self, df: pd.DataFrame, filename: str, folder: str, customer_id: int = None):
+        pass
+
+
+def seed(db: Database, units: int, clients: int, orders: int, days: int, customers: int, stop_list: float):
+    """
+    Очищает таблицы и заполняет их синтетическими данными средствами Postgres (generate_series), пачками
+    по SEED_BATCH строк. Данные детерминированы: одинаковые параметры дают одинаковые таблицы.
+    :param db: соединение с БД
+    :param units: количество пиццерий
+    :param clients: количество клиентов
+    :param orders: количество заказов
+    :param days: за сколько дней распределены заказы и последние заказы клиентов
+    :param customers: количество клиентов сервиса (customer_id), между которыми распределяются пиццерии
+    :param stop_list: доля клиентов в списке обзвоненных
+    :return: None
+    """
+    db.execute('TRUNCATE units, clients, auth, manager, stop_list, orders, unit_runs RESTART IDENTITY CASCADE;')
+    # после RESTART IDENTITY id пиццерий - от 1 до units, на них ссылаются клиенты и заказы
+    db.execute("""
+        INSERT INTO units (country_code, unit_id, uuid, unit_name, tz_shift, begin_date_work)
+        SELECT 'ru', 1000 + g, md5(g::text), 'Тест ' || (g / 10 + 1) || '-' || (g % 10 + 1),
+            (ARRAY[2, 3, 4, 5, 7])[1 + g % 5], current_date - 1000
+        FROM generate_series(1, %s) g;
+    """, (units,))
+    db.execute("""
+        INSERT INTO auth (db_unit_id, login, password, is_active, last_update)
+        SELECT id, 'bench' || id, 'password', true, now()
+        FROM units;
+    """)
+    db.execute("""
+        INSERT INTO manager (db_unit_id, customer_id, new_shop_exclude, new_city,
+            new_source_deliv, new_source_rest, new_source_pickup, new_promo_deliv, new_promo_rest, new_promo_pickup,
+            pizzeria, new_is_active_deliv, new_is_active_rest, new_is_active_pickup,
+            lost_start_date, lost_shift_months, lost_shop_exclude, lost_city, lost_source, lost_is_active, lost_promo,
+            new_clients_promos_all, lost_clients_promos_all, custom_start_date, custom_end_date)
+        SELECT id, id %% %s + 1, false, 'Тест', 'Звонок', 'Звонок', 'Звонок', 'НОВЫЙ', 'НОВЫЙ', 'НОВЫЙ',
+            left(unit_name, 30), true, true, true,
+            current_date - interval '2 months', 1, false, 'Тест', 'Звонок', true, 'ВЕРНИСЬ',
+            'НОВЫЙ', 'ВЕРНИСЬ', current_date - 30, current_date
+        FROM units;
+    """, (customers,))
+    db.commit()
+
+    for start in range(0, clients, SEED_BATCH):
+        # последний заказ - за days дней, первый - до двух лет раньше; 10% клиентов последний раз заказывали
+        # в соседней пиццерии
+        db.execute("""
+            INSERT INTO clients (db_unit_id, phone, first_order_datetime, first_order_city,
+                last_order_datetime, last_order_city, first_order_type, orders_amt, orders_sum,
+                sms_text, sms_text_city, ftp_path_city)
+            SELECT u.id, 79000000000 + g,
+                now() - interval '1 second' * (g * 104729 %% (%s * 86400) + g * 7919 %% (700 * 86400)),
+                u.unit_name,
+                now() - interval '1 second' * (g * 104729 %% (%s * 86400)),
+                CASE WHEN g %% 10 = 0 THEN 'Тест 0-0' ELSE u.unit_name END,
+                g %% 3, 1 + g %% 20, (1 + g %% 20) * (300 + g %% 2000), '', '', ''
+            FROM generate_series(%s::bigint, %s::bigint) g
+            JOIN units u ON u.id = 1 + g %% %s;
+        """, (days, days, start, min(start + SEED_BATCH, clients) - 1, units))
+        db.commit()
+        print(f'clients: {min(start + SEED_BATCH, clients)}/{clients}')
+
+    db.execute("""
+        INSERT INTO stop_list (phone, last_call_date, do_not_call)
+        SELECT 79000000000 + g, now() - interval '1 day' * (g %% 365), g %% 20 = 0
+        FROM generate_series(0::bigint, %s::bigint - 1) g
+        WHERE g %% %s = 0;
+    """, (clients, max(round(1 / stop_list), 1) if stop_list else clients + 1))
+    db.commit()
+
+    for start in range(0, orders, SEED_BATCH):
+        # телефоны заказов - из клиентов, каждый 50-й заказ - отказ
+        db.execute("""
+            INSERT INTO orders (db_unit_id, date, order_id, order_type, phone, order_sum, status)
+            SELECT 1 + g %% %s, now() - interval '1 second' * (g * 7919 %% (%s * 86400)), g::text,
+                g / 7 %% 3, 79000000000 + g * 7919 %% %s, 300 + g %% 4700,
+                CASE WHEN g %% 50 = 0 THEN 1 ELSE 6 END
+            FROM generate_series(%s::bigint, %s::bigint) g;
+        """, (units, days, max(clients, 1), start, min(start + SEED_BATCH, orders) - 1))
+        db.commit()
+        print(f'orders: {min(start + SEED_BATCH, orders)}/{orders}')
+
+    db.execute('ANALYZE;')
+    db.commit()
+
+
+def run_queries(db: ExplainDatabase, upsert_rows: int):
+    """
+    Выполняет рабочие запросы с EXPLAIN ANALYZE и откатывает все изменения.
+    :param db: соединение с БД
+    :param upsert_rows: строк в синтетических выгрузках для DodoISStorer.store
+    :return: None
+    """
+    tasker = BenchmarkTasker(db=db)
+    for name, method in [('new_clients', tasker.create_new_clients_tables),
+                         ('lost_clients', tasker.create_lost_clients_tables),
+                         ('orders', tasker.create_orders_tables)]:
+        print(f'running {name}...')
+        try:
+            method()
+        except DodoEmptyExcelError as e:
+            print(e)
+
+    print('running store...')
+    df_clients = DodoISParser.decode('clients_statistic',
+                                     synthetic.workbook('clients_statistic', upsert_rows, seed=1), TIMEZONE)
+    df_orders = DodoISParser.decode('orders', synthetic.workbook('orders', upsert_rows, seed=1), TIMEZONE)
+    # пачки не фиксируются: все изменения откатываются в конце
+    storer = DodoISStorer(1, db=db, commit_batches=False)
+    db.label = 'store'
+    try:
+        storer.store(df_clients, None)
+        storer.store(None, df_orders)
+    finally:
+        db.label = None
+    db.rollback()
+
+
+def summarize(plans: Dict[str, List]) -> Dict[str, Dict]:
+    """
+    :return: {метка: время выполнения (сумма, максимум, медиана, мс), планирование, буферы и план самого
+        медленного вызова, различные формы планов}
+    """
+    results = {}
+    for label, calls in plans.items():
+        times = [call[0] for call in calls]
+        slowest = max(calls, key=lambda call: call[0])
+        results[label] = {'calls': len(calls),
+                          'total_ms': round(sum(times), 2),
+                          'max_ms': round(max(times), 2),
+                          'median_ms': round(statistics.median(times), 2),
+                          'planning_ms': round(sum(call[1] for call in calls), 2),
+                          'buffers': slowest[2],
+                          'shapes': sorted({call[3] for call in calls}),
+                          'plan': slowest[4]}
+        print(f'{label:36} calls {len(calls):6}  total {results[label]["total_ms"]:11.2f} ms  '
+              f'max {results[label]["max_ms"]:10.2f} ms  shared read {slowest[2]["Shared Read Blocks"]:9}')
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline_path: str, threshold: float, min_delta: float) -> List[str]:
+    """
+    Сравнивает результаты с сохраненными.
+    :return: список запросов, которые стали медленнее в threshold раз и больше чем на min_delta мс
+        (по суммарному времени) или у которых изменилась форма плана
+    """
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f'baseline: commit {baseline.get("commit")}, scale {baseline.get("scale")}')
+    regressions = []
+    for label, result in results.items():
+        if label not in baseline['results']:
+            continue
+        old = baseline['results'][label]
+        ratio = result['total_ms'] / old['total_ms'] if old['total_ms'] else float('inf')
+        marks = []
+        if ratio > threshold and result['total_ms'] - old['total_ms'] > min_delta:
+            marks.append('SLOWER')
+        if result['shapes'] != old['shapes']:
+            marks.append('PLAN CHANGED')
+        if marks:
+            regressions.append(label)
+        print(f'{label:36} {old["total_ms"]:11.2f} ms -> {result["total_ms"]:11.2f} ms  x{ratio:5.2f}'
+              f'{"  <-- " + ", ".join(marks) if marks else ""}')
+        if 'PLAN CHANGED' in marks:
+            for shape in result['shapes']:
+                if shape not in old['shapes']:
+                    print(shape)
+    return regressions
+
+
+def main(argv: List[str] = None):
+    arg_parser = argparse.ArgumentParser(description='Бенчмарк SQL-запросов отчетов и записи в БД')
+    arg_parser.add_argument('--pg-database', required=True, help='отдельная БД для бенчмарка (перезаписывается)')
+    arg_parser.add_argument('--units', type=int, default=1000)
+    arg_parser.add_argument('--clients', type=int, default=1000000)
+    arg_parser.add_argument('--orders', type=int, default=10000000)
+    arg_parser.add_argument('--days', type=int, default=365, help='период заказов в днях')
+    arg_parser.add_argument('--customers', type=int, default=20, help='клиентов сервиса (customer_id)')
+    arg_parser.add_argument('--stop-list', type=float, default=0.05, help='доля обзвоненных клиентов')
+    arg_parser.add_argument('--upsert-rows', type=int, default=50000, help='строк в выгрузках для store')
+    arg_parser.add_argument('--skip-seed', action='store_true', help='не пересоздавать данные')
+    arg_parser.add_argument('--output', help=f'файл результатов, по умолчанию {BENCHMARK_DIR}/sql_<коммит>.json')
+    arg_parser.add_argument('--compare', help='файл результатов для сравнения')
+    arg_parser.add_argument('--threshold', type=float, default=1.5, help='замедление, которое считается регрессией')
+    arg_parser.add_argument('--min-delta', type=float, default=50,
+                            help='минимальное замедление в мс, которое считается регрессией')
+    args = arg_parser.parse_args(argv)
+
+    db = ExplainDatabase(args.pg_database)
+    db.connect()
+    db.commit()
+    scale = {'units': args.units, 'clients': args.clients, 'orders': args.orders, 'days': args.days,
+             'customers': args.customers, 'stop_list': args.stop_list, 'upsert_rows': args.upsert_rows}
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seed(db, args.units, args.clients, args.orders, args.days, args.customers, args.stop_list)
+        print(f'seeded in {time.perf_counter() - started:.0f} s')
+
+    run_queries(db, args.upsert_rows)
+    db.close()
+    results = summarize(db.plans)
+
+    commit = git_commit()
+    output = args.output or os.path.join(BENCHMARK_DIR, f'sql_{commit}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'), 'scale': scale,
+                   'results': results}, f, ensure_ascii=False, indent=2, default=str)
+    print(f'results saved to {output}')
+
+    if args.compare and compare(results, args.compare, args.threshold, args.min_delta):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
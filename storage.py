@@ -1,9 +1,61 @@
+import asyncio
+import threading
+import time
+import weakref
 from datetime import datetime
+from typing import BinaryIO, Dict, Iterable, Tuple, Union
 from urllib.parse import quote
 
-import requests
+import aiohttp
 
-from config import YANDEX_API_TOKEN
+import async_http
+import metrics
+from config import YANDEX_API_TOKEN, YANDEX_API_URL, YANDEX_FOLDER_CACHE_TTL, YANDEX_UPLOAD_ATTEMPTS, \
+    YANDEX_UPLOAD_CONCURRENCY, CONNECT_TIMEOUT
+
+# размер куска файла, который читается и отправляется за один раз при выгрузке
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# папки, существование которых уже проверено в этом процессе: {папка: время проверки (time.monotonic)}
+_known_folders: Dict[str, float] = {}
+_known_folders_lock = threading.Lock()
+
+# ограничения одновременных выгрузок, общие для всех YandexUploadManager: для каждого цикла событий
+# {concurrency: семафор}; используются только внутри цикла событий, поэтому без блокировки
+_upload_semaphores: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[int, asyncio.Semaphore]]' = \
+    weakref.WeakKeyDictionary()
+# блокировки папок: для каждого цикла событий {папка: блокировка}, чтобы одну папку проверял и создавал
+# только один воркер; как и семафоры, используются только внутри цикла событий
+_folder_locks: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Lock]]' = \
+    weakref.WeakKeyDictionary()
+
+
+def _folder_lock(folder: str) -> asyncio.Lock:
+    loop_locks = _folder_locks.setdefault(asyncio.get_running_loop(), {})
+    if folder not in loop_locks:
+        loop_locks[folder] = asyncio.Lock()
+    return loop_locks[folder]
+
+
+def _is_folder_known(folder: str) -> bool:
+    with _known_folders_lock:
+        checked_at = _known_folders.get(folder)
+        if checked_at is None:
+            return False
+        if time.monotonic() - checked_at > YANDEX_FOLDER_CACHE_TTL:
+            del _known_folders[folder]
+            return False
+        return True
+
+
+def _remember_folder(folder: str):
+    with _known_folders_lock:
+        _known_folders[folder] = time.monotonic()
+
+
+def _forget_folder(folder: str):
+    with _known_folders_lock:
+        _known_folders.pop(folder, None)
 
 
 class YandexUploadError(Exception):
@@ -24,71 +76,292 @@ class YandexFileNotFound(Exception):
         super().__init__(self.message)
 
 
-class YandexDisk:
+class AsyncYandexDisk:
     """
-    Класс реализует работу с АПИ Яндекс.Диска.
+    Класс реализует работу с АПИ Яндекс.Диска. Запросы выполняются асинхронно через общий пул соединений
+    (async_http), поэтому несколько выгрузок можно выполнять одновременно. Синхронная обертка - YandexDisk.
+    Проверенные папки кэшируются на уровне процесса, поэтому выгрузка файла в известную папку - это два запроса:
+    получение ссылки и отправка файла.
     Доступные методы: выгрузка на диск, чтение даты последнего обноеления, скачивание с диска.
     """
     def __init__(self):
-        self._request_url = 'https://cloud-api.yandex.net/v1/disk/resources'
+        self._request_url = YANDEX_API_URL
         self._headers = {'Content-Type': 'application/json',
                          'Accept': 'application/json',
                          'Authorization': f'OAuth {YANDEX_API_TOKEN}'}
 
-    def upload(self, filename: str, folder: str):
+    @metrics.timed('yandex_upload')
+    async def upload(self, filename: str, folder: str, content: BinaryIO = None):
         """
         Выгрузка файла на Яндекс.Диск в заданную папку.
         :param filename: имя файла
         :param folder: имя папки
+        :param content: содержимое файла (файловый объект, например io.BytesIO); если не передано,
+        читается локальный файл filename
         :return: None
         """
-        # проверяем существует ли папка
-        check_folder_response = requests.get(f'{self._request_url}?path=%2F{folder}',
-                                             headers=self._headers).json()
-        if check_folder_response.get('error') == 'DiskNotFoundError':
-            # Если нет, создаем папку
-            put_folder_response = requests.put(f'{self._request_url}?path=%2F{folder}',
-                                               headers=self._headers).json()
-            if 'error' in put_folder_response.keys():
-                # если возникла ошибка при создании папки, выкидываем исключение
-                raise YandexCreateFolderError(folder, put_folder_response)
-
-        # выгружаем файл в папку
-        upload_response = requests.get(f'{self._request_url}/upload?path=%2F{folder}%2F{filename}'
-                                       f'&overwrite=true', headers=self._headers).json()
-        with open(filename, 'rb') as f:
-            try:
-                requests.put(upload_response['href'], files={'file': f})
-            except KeyError:
-                raise YandexUploadError(filename, upload_response)
+        if content is None:
+            with open(filename, 'rb') as f:
+                return await self._upload(filename, folder, f)
+        return await self._upload(filename, folder, content)
 
-    def get_modified_date(self, path: str) -> datetime:
+    async def _upload(self, filename: str, folder: str, content: BinaryIO):
+        """
+        Выгрузка файлового объекта с повторными попытками. Ссылка для выгрузки не поддерживает докачку,
+        поэтому при обрыве соединения запрашиваем новую ссылку и отправляем файл заново с исходной позиции.
+        :param filename: имя файла
+        :param folder: имя папки
+        :param content: файловый объект с поддержкой seek
+        :return: None
+        """
+        start_position = content.tell()
+        attempts = YANDEX_UPLOAD_ATTEMPTS
+        async with async_http.session(headers=self._headers) as session:
+            while True:
+                attempts -= 1
+                try:
+                    # существование папки проверяем один раз за YANDEX_FOLDER_CACHE_TTL секунд
+                    if not _is_folder_known(folder):
+                        await self._ensure_folder(session, folder)
+
+                    # получаем ссылку для выгрузки файла в папку
+                    upload_response = await self._get_upload_link(session, filename, folder)
+                    if upload_response.get('error') == 'DiskPathDoesntExistsError':
+                        # папку удалили после проверки - создаем заново и повторяем запрос
+                        _forget_folder(folder)
+                        await self._ensure_folder(session, folder)
+                        upload_response = await self._get_upload_link(session, filename, folder)
+                    try:
+                        href = upload_response['href']
+                    except KeyError:
+                        raise YandexUploadError(filename, upload_response)
+
+                    content.seek(start_position)
+                    await self._put(href, filename, content)
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # обрыв соединения или ошибка сервера: пробуем еще раз, если остались попытки
+                    if attempts <= 0:
+                        raise YandexUploadError(filename, {'error': repr(e)})
+                    await asyncio.sleep(2)
+
+    async def _ensure_folder(self, session: aiohttp.ClientSession, folder: str):
+        """
+        Проверяет, существует ли папка, и создает ее при необходимости. Запоминает папку в кэше.
+        Одну папку проверяет и создает только одна выгрузка, остальные ждут ее и берут результат из кэша.
+        :param session: сессия с заголовками АПИ
+        :param folder: имя папки
+        :return: None
+        """
+        async with _folder_lock(folder):
+            if _is_folder_known(folder):
+                return
+            # проверяем существует ли папка
+            async with session.get(f'{self._request_url}?path=%2F{folder}') as response:
+                check_folder_response = await response.json()
+            if check_folder_response.get('error') == 'DiskNotFoundError':
+                # Если нет, создаем папку
+                async with session.put(f'{self._request_url}?path=%2F{folder}') as response:
+                    put_folder_response = await response.json()
+                # папку уже создал другой процесс - это не ошибка
+                if put_folder_response.get('error', 'DiskPathPointsToExistentDirectoryError') != \
+                        'DiskPathPointsToExistentDirectoryError':
+                    # если возникла ошибка при создании папки, выкидываем исключение
+                    raise YandexCreateFolderError(folder, put_folder_response)
+            _remember_folder(folder)
+
+    async def _get_upload_link(self, session: aiohttp.ClientSession, filename: str, folder: str) -> dict:
+        """
+        Запрашивает ссылку для выгрузки файла.
+        :param session: сессия с заголовками АПИ
+        :param filename: имя файла
+        :param folder: имя папки
+        :return: ответ АПИ (словарь с href или с описанием ошибки)
+        """
+        async with session.get(f'{self._request_url}/upload',
+                               params={'path': f'/{folder}/{filename}', 'overwrite': 'true'}) as response:
+            return await response.json()
+
+    @staticmethod
+    async def _put(href: str, filename: str, content: BinaryIO):
+        """
+        Отправка содержимого файла по ссылке для выгрузки. Файл передается телом запроса как есть (без multipart)
+        и читается потоком, без загрузки целиком.
+        :param href: ссылка для выгрузки
+        :param filename: имя файла
+        :param content: файловый объект
+        :return: None
+        """
+        # большие файлы выгружаются дольше CONNECT_TIMEOUT, поэтому ограничиваем только ожидание соединения и ответа
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=CONNECT_TIMEOUT)
+        # размер передаем явно, чтобы файл ушел одним телом без chunked-кодирования
+        start_position = content.tell()
+        size = content.seek(0, 2) - start_position
+        content.seek(start_position)
+
+        async def read_chunks():
+            while True:
+                chunk = content.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        # ссылка для выгрузки не требует авторизации, заголовки АПИ не передаем
+        async with async_http.session() as upload_session:
+            async with upload_session.put(href, data=read_chunks(), headers={'Content-Length': str(size)},
+                                          timeout=timeout) as response:
+                await response.read()
+                if response.status >= 500:
+                    # ошибка на стороне сервера - выгрузку можно повторить
+                    response.raise_for_status()
+                if not response.ok:
+                    raise YandexUploadError(filename, {'status': response.status, 'reason': response.reason})
+
+    async def get_meta(self, path: str) -> dict:
+        """
+        Получение метаинформации о файле (дата изменения modified, контрольная сумма md5, размер size и т.д.)
+        :param path: имя файла с полным путем
+        :return: словарь с метаинформацией
+        """
+        async with async_http.session(headers=self._headers) as session:
+            async with session.get(f'{self._request_url}?path=%2F{quote(path)}') as meta_response:
+                if not meta_response.ok:
+                    # если путь неверный, выкидываем исключение
+                    raise YandexFileNotFound(path)
+                return await meta_response.json()
+
+    async def get_modified_date(self, path: str) -> datetime:
         """
         Получение даты изменения файла
         :param path: имя файла с полным путем
         :return: объект datetime
         """
-        meta_response = requests.get(f'{self._request_url}?path=%2F{quote(path)}',
-                                     headers=self._headers)
-        if not meta_response.ok:
-            # если путь неверный, выкидываем исключение
-            raise YandexFileNotFound(path)
+        # вызываем асинхронную версию явно: в YandexDisk get_meta переопределен синхронной оберткой
+        meta = await AsyncYandexDisk.get_meta(self, path)
 
         # преобразуем дату из строки в объект datetime
-        date_modified = datetime.strptime(meta_response.json()['modified'], '%Y-%m-%dT%H:%M:%S%z')
+        date_modified = datetime.strptime(meta['modified'], '%Y-%m-%dT%H:%M:%S%z')
 
         return date_modified
 
-    def download(self, path: str) -> bytes:
+    async def download(self, path: str) -> bytes:
         """
         Скачивание файла.
         :param path: полный путь к файлу.
         :return: возвращает содержимое файла в формате bytes (бинарная строка).
         """
-        download_response = requests.get(f'{self._request_url}/download?path=%2F{quote(path)}',
-                                         headers=self._headers)
-        if not download_response.ok:
-            raise YandexFileNotFound(path)
+        async with async_http.session(headers=self._headers) as session:
+            async with session.get(f'{self._request_url}/download?path=%2F{quote(path)}') as download_response:
+                if not download_response.ok:
+                    raise YandexFileNotFound(path)
+                download_link = (await download_response.json())['href']
+
+        async with async_http.session() as session:
+            async with session.get(download_link) as response:
+                return await response.read()
+
+
+class YandexUploadManager:
+    """
+    Параллельная выгрузка файлов на Яндекс.Диск. Число одновременных выгрузок во всем процессе ограничено
+    YANDEX_UPLOAD_CONCURRENCY (или параметром concurrency), остальные ждут своей очереди: менеджеры с одинаковым
+    concurrency (например, ReportPipeline разных клиентов в run_all) делят одно ограничение.
+    Для каждого выгруженного файла запоминает время выгрузки в секундах (свойство timings).
+    Методы upload и upload_many синхронные и могут вызываться из нескольких потоков.
+    """
+    def __init__(self, disk: AsyncYandexDisk = None, concurrency: int = None):
+        """
+        :param disk: асинхронный клиент Яндекс.Диска, по умолчанию AsyncYandexDisk()
+        :param concurrency: максимальное число одновременных выгрузок
+        """
+        self._disk = disk or AsyncYandexDisk()
+        self._concurrency = concurrency or YANDEX_UPLOAD_CONCURRENCY
+        self._timings: Dict[str, float] = {}
+        self._timings_lock = threading.Lock()
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        """
+        Время выгрузки файлов в секундах: {'папка/имя файла': секунды}
+        """
+        with self._timings_lock:
+            return dict(self._timings)
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop_semaphores = _upload_semaphores.setdefault(asyncio.get_running_loop(), {})
+        if self._concurrency not in loop_semaphores:
+            loop_semaphores[self._concurrency] = asyncio.Semaphore(self._concurrency)
+        return loop_semaphores[self._concurrency]
+
+    async def _upload(self, filename: str, folder: str, content: BinaryIO = None) -> float:
+        async with self._semaphore():
+            start = time.perf_counter()
+            await self._disk.upload(filename, folder, content)
+            elapsed = time.perf_counter() - start
+        with self._timings_lock:
+            self._timings[f'{folder}/{filename}'] = elapsed
+        return elapsed
+
+    def upload(self, filename: str, folder: str, content: BinaryIO = None) -> float:
+        """
+        Выгрузка одного файла (см. AsyncYandexDisk.upload).
+        :param filename: имя файла
+        :param folder: имя папки
+        :param content: содержимое файла; если не передано, читается локальный файл filename
+        :return: время выгрузки в секундах
+        """
+        return async_http.run_sync(self._upload(filename, folder, content))
+
+    def upload_many(self, files: Iterable[Tuple[str, str, BinaryIO]]) -> Dict[str, Union[float, Exception]]:
+        """
+        Одновременная выгрузка нескольких файлов. Ошибка выгрузки одного файла не прерывает остальные.
+        :param files: кортежи (имя файла, папка, содержимое)
+        :return: словарь {'папка/имя файла': время выгрузки в секундах или исключение}
+        """
+        files = list(files)
+
+        async def upload_all():
+            return await asyncio.gather(*(self._upload(*file) for file in files), return_exceptions=True)
+
+        results = async_http.run_sync(upload_all())
+        return {f'{folder}/{filename}': result for (filename, folder, _), result in zip(files, results)}
+
+
+class YandexDisk(AsyncYandexDisk):
+    """
+    Синхронная обертка над AsyncYandexDisk: запросы выполняются в общем цикле событий модуля async_http.
+    """
+
+    def upload(self, filename: str, folder: str, content: BinaryIO = None):
+        """
+        Выгрузка файла на Яндекс.Диск в заданную папку.
+        :param filename: имя файла
+        :param folder: имя папки
+        :param content: содержимое файла; если не передано, читается локальный файл filename
+        :return: None
+        """
+        return async_http.run_sync(super().upload(filename, folder, content))
 
-        download_link = download_response.json()['href']
-        return requests.get(download_link).content
+    def get_meta(self, path: str) -> dict:
+        """
+        Получение метаинформации о файле (дата изменения modified, контрольная сумма md5, размер size и т.д.)
+        :param path: имя файла с полным путем
+        :return: словарь с метаинформацией
+        """
+        return async_http.run_sync(super().get_meta(path))
+
+    def get_modified_date(self, path: str) -> datetime:
+        """
+        Получение даты изменения файла
+        :param path: имя файла с полным путем
+        :return: объект datetime
+        """
+        return async_http.run_sync(super().get_modified_date(path))
+
+    def download(self, path: str) -> bytes:
+        """
+        Скачивание файла.
+        :param path: полный путь к файлу.
+        :return: возвращает содержимое файла в формате bytes (бинарная строка).
+        """
+        return async_http.run_sync(super().download(path))
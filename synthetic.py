@@ -0,0 +1,237 @@
+"""
+Модуль для генерации синтетических Excel-выгрузок Додо ИС: "Статистика по клиентам", "Заказы"
+и "Расход промокодов". Файлы повторяют структуру настоящих выгрузок: строки заголовка отчета перед таблицей
+(10, 7 и 4 строки, как REPORTS[...]['rows'] в dodois.py), русские названия столбцов, телефоны строкой "+7 (9xx) ...",
+в том числе пустые и некорректные. Используется бенчмарками и тестовым сервером Додо ИС.
+Генерация детерминирована: одинаковые параметры и seed дают одинаковый файл.
+"""
+
+import io
+from datetime import datetime, timedelta
+from typing import List
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+# максимальное количество строк листа Excel
+EXCEL_MAX_ROWS = 1048576
+
+DEPARTMENTS = ['Москва 1-1', 'Москва 1-2', 'Москва 2-1', 'Казань 1-1', 'Казань 1-2', 'Сыктывкар 1-1',
+               'Сыктывкар 2-1', 'Пермь 1-1', 'Екатеринбург 3-1', 'Тюмень 1-1']
+ORDER_TYPES = ['Доставка', 'Самовывоз', 'Ресторан']
+ORDER_STATUSES = ['Доставка', 'Отказ', 'Просрочен', 'Упакован', 'В работе', 'Принят', 'Выполнен']
+PROMO_CODES = ['НОВЫЙ', 'ВЕРНИСЬ', 'ПИЦЦА20', 'ДРУГ', 'ЛЕТО', 'ОСЕНЬ', 'ДР2024']
+
+# строки заголовка отчета перед таблицей
+TITLE_ROWS = {'clients_statistic': 10, 'orders': 7, 'promo': 4}
+
+TITLES = {'clients_statistic': 'Статистика по клиентам',
+          'orders': 'Заказы',
+          'promo': 'Расход промокодов'}
+
+
+def _phones(rng: np.random.Generator, rows: int, pool: int) -> np.ndarray:
+    """
+    Телефоны в формате выгрузки: +7 (9xx) xxx-xx-xx; около 1% пустых и 1% городских номеров.
+    :param pool: количество разных номеров (меньше rows - телефоны повторяются)
+    """
+    numbers = 79000000000 + rng.integers(0, max(pool, 1), rows) * 7919 % 1000000000
+    digits = pd.Series(numbers.astype(str))
+    phones = ('+7 (' + digits.str[1:4] + ') ' + digits.str[4:7] + '-' + digits.str[7:9] + '-' + digits.str[9:11])
+    kind = rng.random(rows)
+    phones[kind < 0.01] = ''
+    phones[(kind >= 0.01) & (kind < 0.02)] = '+7 (495) 123-45-67'
+    return phones.to_numpy(dtype=object)
+
+
+def _dates(rng: np.random.Generator, rows: int, start: datetime, end: datetime) -> pd.Series:
+    seconds = int((end - start).total_seconds())
+    offsets = rng.integers(0, max(seconds, 1), rows)
+    return pd.Series(pd.Timestamp(start) + pd.to_timedelta(offsets, unit='s')).dt.floor('s')
+
+
+def clients_statistic_frame(rows: int, seed: int = 0, start: datetime = None, end: datetime = None,
+                            phone_pool: int = None, departments: List[str] = None) -> pd.DataFrame:
+    """
+    Таблица отчета "Статистика по клиентам" (как в выгрузке, без строк заголовка).
+    :param rows: количество строк
+    :param seed: зерно генератора
+    :param start: начало периода
+    :param end: конец периода
+    :param phone_pool: количество разных телефонов, по умолчанию rows (телефоны в куске почти не повторяются)
+    :param departments: названия отделов, по умолчанию DEPARTMENTS
+    :return: датафрейм
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime(2024, 1, 31)
+    start = start or end - timedelta(days=30)
+    # первый заказ - за два года до конца периода, последний - в периоде
+    first = _dates(rng, rows, start - timedelta(days=700), end)
+    last = _dates(rng, rows, start, end)
+    first = first.where(first <= last, last)
+    amounts = rng.integers(1, 40, rows)
+    departments = departments or DEPARTMENTS
+    return pd.DataFrame({
+        '№': np.arange(1, rows + 1),
+        'Имя клиента': rng.choice(['Анна', 'Иван', 'Мария', 'Олег', ''], rows),
+        '№ телефона': _phones(rng, rows, phone_pool or rows),
+        'Дата первого заказа': first,
+        'Отдел первого заказа': rng.choice(departments, rows),
+        'Направление первого заказа': rng.choice(ORDER_TYPES, rows, p=[0.7, 0.2, 0.1]),
+        'Дата последнего заказа': last,
+        'Отдел последнего заказа': rng.choice(departments, rows),
+        'Кол-во заказов': amounts,
+        'Сумма заказа': amounts * rng.integers(300, 2500, rows),
+    })
+
+
+def orders_frame(rows: int, seed: int = 0, start: datetime = None, end: datetime = None,
+                 phone_pool: int = None, departments: List[str] = None) -> pd.DataFrame:
+    """
+    Таблица отчета "Заказы" (как в выгрузке, без строк заголовка).
+    :param rows: количество строк
+    :param seed: зерно генератора
+    :param start: начало периода
+    :param end: конец периода
+    :param phone_pool: количество разных телефонов, по умолчанию rows // 3 (клиент делает несколько заказов)
+    :param departments: названия отделов, по умолчанию DEPARTMENTS
+    :return: датафрейм
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime(2024, 1, 31)
+    start = start or end - timedelta(days=30)
+    dates = _dates(rng, rows, start, end)
+    departments = rng.choice(departments or DEPARTMENTS, rows)
+    return pd.DataFrame({
+        'Подразделение': pd.Series(departments).str.extract(r'(.+)(?=-)')[0],
+        'Отдел': departments,
+        'Дата': dates,
+        'Время': dates.dt.strftime('%H:%M'),
+        'Время продажи (печати чека)': dates.dt.strftime('%H:%M'),
+        '№ заказа': [f'{number}-{index % 3 + 1}' for index, number in enumerate(rng.integers(1, 999, rows))],
+        'Тип заказа': rng.choice(ORDER_TYPES, rows, p=[0.7, 0.2, 0.1]),
+        'Имя клиента': rng.choice(['Анна', 'Иван', 'Мария', 'Олег', ''], rows),
+        'Номер телефона': _phones(rng, rows, phone_pool or max(rows // 3, 1)),
+        'Сумма заказа': rng.integers(300, 5000, rows),
+        'Способ оплаты': rng.choice(['Наличные', 'Карта', 'Онлайн'], rows),
+        'Статус заказа': rng.choice(ORDER_STATUSES, rows, p=[0.02, 0.03, 0.05, 0.01, 0.01, 0.01, 0.87]),
+        'Оператор заказа': rng.choice(['Оператор 1', 'Оператор 2', 'Сайт', 'Мобильное приложение'], rows),
+        'Курьер': rng.choice(['Курьер 1', 'Курьер 2', ''], rows),
+        'Причина просрочки': '',
+        'Адрес': 'ул. Ленина, д. 1',
+        'id заказа': [f'{value:032x}' for value in rng.integers(0, 2 ** 62, rows)],
+        'id транзакции': rng.integers(10 ** 8, 10 ** 9, rows),
+    })
+
+
+def promo_frame(rows: int, seed: int = 0, start: datetime = None, end: datetime = None,
+                phone_pool: int = None, departments: List[str] = None) -> pd.DataFrame:
+    """
+    Таблица отчета "Расход промокодов" (как в выгрузке, без строк заголовка).
+    :param rows: количество строк
+    :param seed: зерно генератора
+    :param start: начало периода
+    :param end: конец периода
+    :param phone_pool: количество разных телефонов, по умолчанию rows
+    :param departments: названия отделов, по умолчанию DEPARTMENTS
+    :return: датафрейм
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime(2024, 1, 31)
+    start = start or end - timedelta(days=30)
+    return pd.DataFrame({
+        'Отдел': rng.choice(departments or DEPARTMENTS, rows),
+        'Дата': _dates(rng, rows, start, end),
+        '№ заказа': rng.integers(1, 999, rows),
+        'Промокод': rng.choice(PROMO_CODES, rows),
+        'Описание': 'Скидка на первый заказ',
+        'Тип заказа': rng.choice(ORDER_TYPES, rows),
+        'Сумма заказа': rng.integers(300, 5000, rows),
+        'Номер телефона': _phones(rng, rows, phone_pool or rows),
+    })
+
+
+FRAMES = {'clients_statistic': clients_statistic_frame,
+          'orders': orders_frame,
+          'promo': promo_frame}
+
+
+def to_excel(report_type: str, df: pd.DataFrame, unit_name: str = 'Москва 1-1') -> bytes:
+    """
+    Записывает таблицу в Excel-файл выгрузки: строки заголовка отчета, затем таблица с шапкой.
+    :param report_type: тип отчета (ключ TITLE_ROWS)
+    :param df: таблица (clients_statistic_frame, orders_frame, promo_frame)
+    :param unit_name: название пиццерии в заголовке отчета
+    :return: содержимое xlsx-файла
+    """
+    title_rows = TITLE_ROWS[report_type]
+    if len(df) + title_rows + 1 > EXCEL_MAX_ROWS:
+        raise ValueError(f'В лист Excel помещается не больше {EXCEL_MAX_ROWS - title_rows - 1} строк')
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    datetime_format = workbook.add_format({'num_format': 'dd.mm.yyyy hh:mm:ss'})
+
+    # строки заголовка заполнены все, чтобы skiprows совпадал с настоящей выгрузкой
+    title = [TITLES[report_type], f'Пиццерия: {unit_name}', f'Сформирован: {datetime(2024, 2, 1):%d.%m.%Y %H:%M}']
+    for row in range(title_rows):
+        worksheet.write_string(row, 0, title[row] if row < len(title) else '-')
+
+    for col, name in enumerate(df.columns):
+        worksheet.write_string(title_rows, col, name)
+    row = title_rows + 1
+    for values in df.astype(object).itertuples(index=False, name=None):
+        for col, value in enumerate(values):
+            if isinstance(value, str):
+                if value:
+                    worksheet.write_string(row, col, value)
+            elif isinstance(value, datetime):
+                worksheet.write_datetime(row, col, value, datetime_format)
+            else:
+                worksheet.write_number(row, col, value)
+        row += 1
+    workbook.close()
+    return buffer.getvalue()
+
+
+def workbook(report_type: str, rows: int, seed: int = 0, **kwargs) -> bytes:
+    """
+    Синтетическая выгрузка отчета.
+    :param report_type: тип отчета (ключ FRAMES)
+    :param rows: количество строк
+    :param seed: зерно генератора
+    :param kwargs: параметры генератора таблицы (start, end, phone_pool, departments)
+    :return: содержимое xlsx-файла
+    """
+    return to_excel(report_type, FRAMES[report_type](rows, seed, **kwargs))
+
+
+def stop_list_workbook(rows: int, seed: int = 0, phone_pool: int = None) -> bytes:
+    """
+    Синтетический файл обзвоненных клиентов (main_base/MainBase.xlsm): столбцы feedback.STOP_LIST_COLUMNS.
+    :param rows: количество строк
+    :param seed: зерно генератора
+    :param phone_pool: количество разных телефонов, по умолчанию rows
+    :return: содержимое xlsx-файла
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'Телефон': _phones(rng, rows, phone_pool or rows),
+        'Дата завершения': _dates(rng, rows, datetime(2023, 1, 1), datetime(2024, 1, 31)),
+        'forbiden': rng.choice(['', '', '', 'не звонить'], rows),
+    })
+    buffer = io.BytesIO()
+    workbook_ = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    worksheet = workbook_.add_worksheet()
+    datetime_format = workbook_.add_format({'num_format': 'dd.mm.yyyy hh:mm:ss'})
+    for col, name in enumerate(df.columns):
+        worksheet.write_string(0, col, name)
+    for row, (phone, date, forbiden) in enumerate(df.astype(object).itertuples(index=False, name=None), start=1):
+        if phone:
+            worksheet.write_string(row, 0, phone)
+        worksheet.write_datetime(row, 1, date, datetime_format)
+        if forbiden:
+            worksheet.write_string(row, 2, forbiden)
+    workbook_.close()
+    return buffer.getvalue()
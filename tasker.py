@@ -1,16 +1,20 @@
-import os
 from datetime import datetime, timedelta, timezone
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 import config
-from dodois import DodoEmptyExcelError
+import metrics
+import profiling
 from storage import YandexDisk
 from config import YANDEX_NEW_CLIENTS_FOLDER, YANDEX_LOST_CLIENTS_FOLDER, YANDEX_NEW_PROMO_FOLDER, \
     YANDEX_LOST_PROMO_FOLDER, YANDEX_ORDERS_FOLDER
+from frames import apply_dtypes, concat_frames
 from parser import DatabaseWorker
+from phones import format_phones
+from reports import render_xlsx
+from report_pipeline import ReportPipeline
 from postgresql import Database
 
 
@@ -18,17 +22,68 @@ class DatabaseTasker(DatabaseWorker):
     """
     Класс выгружает отчеты из БД.
     """
-    def __init__(self, db: Database = None):
+    def __init__(self, db: Database = None, pipeline: ReportPipeline = None):
+        """
+        :param db: открытое соединение с БД (см. DatabaseWorker)
+        :param pipeline: конвейер формирования и выгрузки отчетов; если не передан,
+            отчеты формируются и выгружаются сразу в вызывающем потоке
+        """
         # инициализируем хранилище для записи отчетов
         self._storage = YandexDisk()
+        self._pipeline = pipeline
         super().__init__(db)
 
-    def _get_new_params(self) -> Union[List, Tuple]:
+    def _upload_report(self, df: pd.DataFrame, filename: str, folder: str, customer_id: int = None):
+        """
+        Формирует Excel-файл отчета в памяти и загружает его в хранилище. Файлы на диск не пишутся,
+        поэтому одновременные выгрузки не конфликтуют по именам файлов.
+        Если задан конвейер, отчет ставится в его очередь, а метод сразу возвращается к следующему запросу.
+        :param df: датафрейм отчета
+        :param filename: имя файла в хранилище
+        :param folder: папка в хранилище
+        :param customer_id: клиент, к которому относится отчет
+        :return: None
+        """
+        if self._pipeline is not None:
+            self._pipeline.submit(df, filename, folder, customer_id)
+        else:
+            self._storage.upload(filename, folder, render_xlsx(df))
+
+    def _query(self, report: str, query: str, args: Tuple = None) -> List[Tuple]:
+        """
+        Выполняет запрос отчета и возвращает строки результата, время запроса записывается в метрики (tasker_query).
+        :param report: название отчета или запроса (метка метрики)
+        :param query: SQL-запрос
+        :param args: параметры запроса
+        :return: строки результата
+        """
+        with metrics.span('tasker_query', report=report):
+            self._db.execute(query, args)
+            return self._db.fetch()
+
+    def get_customer_units(self) -> Dict[int, List[int]]:
+        """
+        Получает активные пиццерии клиентов (для зависимостей отчетов клиента от выгрузки его пиццерий, см. run_all).
+        :return: словарь {customer_id: [units.id]}
+        """
+        customer_units = {}
+        for customer_id, db_unit_id in self._query('customer_units', """
+            SELECT m.customer_id, u.id
+            FROM units u
+            JOIN manager m on m.db_unit_id = u.id
+            JOIN auth a on u.id = a.db_unit_id
+            WHERE a.is_active = true
+            ORDER BY m.customer_id, u.id;
+        """):
+            customer_units.setdefault(customer_id, []).append(db_unit_id)
+        return customer_units
+
+    def get_new_params(self) -> Union[List, Tuple]:
         """
         Получает параметры для формирования отчета о новых клиентах.
         :return: список или кортеж
         """
-        self._db.execute("""
+        return self._query('new_params', """
             SELECT m.customer_id, u.tz_shift
             FROM units u
             JOIN manager m on m.db_unit_id = u.id
@@ -37,14 +92,13 @@ class DatabaseTasker(DatabaseWorker):
             AND m.new_shop_exclude = false
             GROUP BY m.customer_id, u.tz_shift;
         """)
-        return self._db.fetch()
 
-    def _get_lost_params(self) -> Union[List, Tuple]:
+    def get_lost_params(self) -> Union[List, Tuple]:
         """
         Получает параметры для формирования отчета о пропавших клиентах.
         :return: список или кортеж
         """
-        self._db.execute("""
+        return self._query('lost_params', """
             SELECT m.customer_id, u.tz_shift, u.id, m.lost_start_date, m.lost_shift_months
             FROM units u
             JOIN manager m on m.db_unit_id = u.id
@@ -54,17 +108,17 @@ class DatabaseTasker(DatabaseWorker):
             GROUP BY m.customer_id, u.tz_shift, u.id, m.lost_start_date, m.lost_shift_months
             ORDER BY m.customer_id, u.tz_shift;
         """)
-        return self._db.fetch()
 
-    def create_new_clients_tables(self):
+    def create_new_clients_tables(self, pairs: List[Tuple] = None):
         """
         Формирует отчет о новых клиентах.
+        :param pairs: пары (customer_id, tz_shift), по умолчанию все (get_new_params)
         :return: None
         """
-        pairs = self._get_new_params()
+        pairs = self.get_new_params() if pairs is None else pairs
         # выгрузка раздельно по каждому набору параметров
         for customer_id, tz_shift in pairs:
-            self._db.execute("""
+            table = self._query('new_clients', """
             WITH pair_table AS (
                 SELECT 
                     c.phone,
@@ -112,12 +166,15 @@ class DatabaseTasker(DatabaseWorker):
                 AND length(promocode) > 0;
             """, (customer_id, tz_shift))
 
-            table = self._db.fetch()
-
             df = pd.DataFrame(table, columns=[
                 'phone', 'first_order_type', 'source', 'promokod', 'city', 'pizzeria', 'otdel',
                 'first-order'
             ])
+            df = apply_dtypes(df, {'source': 'category', 'promokod': 'category', 'city': 'category',
+                                   'pizzeria': 'category', 'otdel': 'category'})
+
+            # телефоны хранятся числом, в отчете - строкой "+7..."
+            df['phone'] = format_phones(df['phone'])
 
             # преобразуем first-order в правильную таймзону, чтобы в итоговом файле были правильные даты
             df['first-order'] = df['first-order'].dt.tz_convert(config.TIMEZONES[tz_shift]).dt.tz_localize(None)
@@ -137,21 +194,21 @@ class DatabaseTasker(DatabaseWorker):
             # удаляем лишние поля
             df = df[['phone', 'promokod', 'city', 'pizzeria', 'otdel', 'first-order', 'source']]
 
-            # сохраняем файл локально, загружаем в хранилище и удаляем локально.
-            df.to_excel(filename, index=False)
-            self._storage.upload(filename, YANDEX_NEW_CLIENTS_FOLDER)
-            os.remove(filename)
+            # формируем файл в памяти и загружаем в хранилище
+            self._upload_report(df, filename, YANDEX_NEW_CLIENTS_FOLDER, customer_id)
 
-    def create_lost_clients_tables(self):
+    def create_lost_clients_tables(self, params: List[Tuple] = None):
         """
         Формирует отчет о пропавших клиентах.
         Логика формирования отчета прописана в ТЗ:
         https://docs.google.com/document/d/1XxGJ_m0LIqEudvVknUMsI0lnXCy1IjfQCrDZUEfblxU/
+        :param params: параметры пиццерий, по умолчанию все (get_lost_params)
         :return: None
         """
+        params = self.get_lost_params() if params is None else params
         dfs = []
         param_cursor = []  # хранит customer_id, tz_shift в кортеже
-        for customer_id, tz_shift, unit_id, lost_start_date, lost_shift_months in self._get_lost_params():
+        for customer_id, tz_shift, unit_id, lost_start_date, lost_shift_months in params:
             lost_end_date = lost_start_date + relativedelta(months=1)
             local_time = datetime.now(timezone.utc) + timedelta(hours=tz_shift)
             shift_duration = relativedelta(months=lost_shift_months)
@@ -165,7 +222,7 @@ class DatabaseTasker(DatabaseWorker):
                 report_start_date = lost_start_date
                 report_end_date = shift_end.date()
                 lost_start_date = shift_end
-            self._db.execute("""
+            table = self._query('lost_clients', """
             SELECT 
                 c.phone,
                 m.lost_promo,
@@ -193,14 +250,17 @@ class DatabaseTasker(DatabaseWorker):
                 AND (sl.do_not_call IS NULL OR NOT sl.do_not_call);
             """, (customer_id, tz_shift, unit_id, report_start_date, report_end_date))
 
-            table = self._db.fetch()
-
             df = pd.DataFrame(table, columns=[
                 'phone', 'promokod', 'city', 'pizzeria', 'otdel', 'last-order', 'source'
             ])
+            df = apply_dtypes(df, {'promokod': 'category', 'city': 'category', 'pizzeria': 'category',
+                                   'otdel': 'category', 'source': 'category'})
 
             if len(df) > 0:
 
+                # телефоны хранятся числом, в отчете - строкой "+7..."
+                df['phone'] = format_phones(df['phone'])
+
                 # преобразовываем first-order в правильную таймзону, чтобы в итоговом файле были правильные даты
                 df['last-order'] = df['last-order'].dt.tz_convert(config.TIMEZONES[tz_shift]).dt.tz_localize(None)
 
@@ -219,20 +279,32 @@ class DatabaseTasker(DatabaseWorker):
             for idx, params in enumerate(param_cursor):
                 # начался новый файл, записываем старый
                 if idx == len(param_cursor) - 1 or params != param_cursor[idx + 1]:
-                    df = pd.concat(dfs[prev_new_idx:idx + 1])
+                    df = concat_frames(dfs[prev_new_idx:idx + 1])
                     customer_id, tz_shift, _, _ = params
                     start_date = min([row[2] for row in param_cursor[prev_new_idx:idx + 1]])
                     end_date = max([row[3] for row in param_cursor[prev_new_idx:idx + 1]])
                     filename = f'{datetime.now(timezone.utc) + timedelta(hours=3):%d.%m.%Y}_PROPAL_Blok-{customer_id}_'\
                                f'{start_date:%d.%m.%Y}-{end_date:%d.%m.%Y}_tz-{tz_shift - 3}.xlsx'
                     prev_new_idx = idx + 1
-                    # save file, upload to Yandex Disk and delete
-                    df.to_excel(filename, index=False)
-                    self._storage.upload(filename, YANDEX_LOST_CLIENTS_FOLDER)
-                    os.remove(filename)
+                    # формируем файл в памяти и загружаем на Яндекс.Диск
+                    self._upload_report(df, filename, YANDEX_LOST_CLIENTS_FOLDER, customer_id)
+
+    def restore_lost_start_dates(self, params: List[Tuple]):
+        """
+        Возвращает lost_start_date пиццерий к значениям до create_lost_clients_tables (в той же транзакции),
+        чтобы при следующем запуске отчет о пропавших клиентах сформировался заново.
+        :param params: параметры пиццерий из get_lost_params, полученные до формирования отчета
+        :return: None
+        """
+        for _, _, unit_id, lost_start_date, _ in params:
+            self._db.execute("""
+                UPDATE manager
+                SET lost_start_date = %s
+                WHERE db_unit_id = %s;
+                """, (lost_start_date, unit_id))
 
     def get_new_promo_params(self):
-        self._db.execute("""
+        return self._query('new_promo_params', """
             SELECT 
                 u.id,
                 m.customer_id,
@@ -256,10 +328,9 @@ class DatabaseTasker(DatabaseWorker):
                 m.custom_end_date IS NOT NULL AND
                 m.new_clients_promos_all IS NOT NULL;
         """)
-        return self._db.fetch()
 
     def get_lost_promo_params(self):
-        self._db.execute("""
+        return self._query('lost_promo_params', """
             SELECT 
                 u.id,
                 m.customer_id,
@@ -283,24 +354,21 @@ class DatabaseTasker(DatabaseWorker):
                 m.custom_end_date IS NOT NULL AND
                 m.lost_clients_promos_all IS NOT NULL;
         """)
-        return self._db.fetch()
 
     def create_promo_tables(self, df: pd.DataFrame, customer_id: int, shop_name: str,
                             start_date: datetime, end_date: datetime,
                             suffix: str):
         filename = f'Расход промо-кодов_{customer_id}_{shop_name}_{suffix}_({start_date:%Y-%m-%d} - {end_date:%Y-%m-%d}).xlsx'
-        df.to_excel(filename, index=False)
         if suffix == 'НК':
             folder = YANDEX_NEW_PROMO_FOLDER
         elif suffix == 'ПК':
             folder = YANDEX_LOST_PROMO_FOLDER
         else:
             raise ValueError('wrong suffix!')
-        self._storage.upload(filename, folder)
-        os.remove(filename)
+        self._upload_report(df, filename, folder, customer_id)
 
-    def _get_orders_params(self):
-        self._db.execute("""
+    def get_orders_params(self):
+        return self._query('orders_params', """
             SELECT
                 u.id,
                 u.unit_name,
@@ -315,52 +383,69 @@ class DatabaseTasker(DatabaseWorker):
                 AND m.custom_start_date IS NOT NULL
                 AND m.custom_end_date IS NOT NULL;
         """)
-        return self._db.fetch()
 
-    def create_orders_tables(self):
-        for db_unit_id, shop_name, tz_shift, customer_id, start_date, end_date in self._get_orders_params():
-            print(f'parsing orders for {shop_name}...')
-            start_date_full = datetime(start_date.year, start_date.month, start_date.day, 0, 0) - timedelta(hours=tz_shift)
-            end_date_full = datetime(end_date.year, end_date.month, end_date.day, 0) - timedelta(hours=tz_shift)
-            self._db.execute("""
-                SELECT o.*, u.unit_name FROM orders o
-                JOIN units u ON u.id = o.db_unit_id
-                WHERE o.db_unit_id = %s
-                    AND o.date >= %s
-                    AND o.date < %s;
-            """, (db_unit_id, start_date_full, (end_date_full + timedelta(days=1))))
-
-            df = pd.DataFrame(self._db.fetch(), columns = [
-                'id', 'db_unit_id', 'Дата', '№ заказа', 'Тип заказа', 'Номер телефона', 'Сумма заказа',
-                'Статус заказа', 'Отдел'])
-
-            if len(df) == 0:
-                raise DodoEmptyExcelError(f'Выгружен пустой файл Excel для пиццерии {shop_name}. Возможно,'
-                                          f' на сервере нет заказов от этой пиццерии.')
-            else:
-                # восстановление полей таблицы
-                df['Подразделение'] = df['Отдел'].str.extract(r'(.+)(?=-)')
-                df['Дата'] = df['Дата'].dt.tz_convert(config.TIMEZONES[tz_shift]).dt.tz_localize(None)
-                df['Время'] = df['Дата']
-                df['Время продажи (печати чека)'] = 0
-                df['Тип заказа'].replace(to_replace={0: 'Доставка', 1: 'Самовывоз', 2: 'Ресторан'}, inplace=True)
-                df['Имя клиента'] = '**********'
-                df['Способ оплаты'] = 0
-                df['Статус заказа'].replace(to_replace={0: 'Доставка', 1: 'Отказ', 2: 'Просрочен', 3: 'Упакован',
-                                                        4: 'В работе', 5: 'Принят', 6: 'Выполнен'}, inplace=True)
-                df['Оператор заказа'] = 0
-                df['Курьер'] = 0
-                df['Причина просрочки'] = 0
-                df['Адрес'] = '**********'
-                df['id заказа'] = 0
-                df['id транзакции'] = 0
-
-                df = df[['Подразделение', 'Отдел', 'Дата', 'Время', 'Время продажи (печати чека)', '№ заказа', 'Тип заказа',
-                         'Имя клиента', 'Номер телефона', 'Сумма заказа', 'Способ оплаты', 'Статус заказа',
-                         'Оператор заказа', 'Курьер', 'Причина просрочки', 'Адрес', 'id заказа', 'id транзакции']]
-
-                filename = f'Заказы_{customer_id}_{shop_name}_({start_date:%Y-%m-%d} - {end_date:%Y-%m-%d}).xlsx'
-                df.to_excel(filename, index=False)
-                self._storage.upload(filename, YANDEX_ORDERS_FOLDER)
-                os.remove(filename)
-                print(f'orders for {shop_name} uploaded successfully!')
+    def create_orders_tables(self, params: List[Tuple] = None):
+        """
+        Формирует отчеты по заказам пиццерий за период custom_start_date - custom_end_date.
+        Пиццерии из целей профилирования (см. profiling.py) профилируются по отдельности.
+        :param params: параметры пиццерий, по умолчанию все (get_orders_params)
+        :return: None
+        """
+        params = self.get_orders_params() if params is None else params
+        for unit_params in params:
+            db_unit_id, shop_name = unit_params[:2]
+            with profiling.profile(f'run_custom_orders_{db_unit_id}_{shop_name}', db_unit_id, shop_name, 'orders'):
+                self._create_orders_table(*unit_params)
+
+    def _create_orders_table(self, db_unit_id: int, shop_name: str, tz_shift: int, customer_id: int,
+                             start_date: datetime, end_date: datetime):
+        print(f'parsing orders for {shop_name}...')
+        start_date_full = datetime(start_date.year, start_date.month, start_date.day, 0, 0) - timedelta(hours=tz_shift)
+        end_date_full = datetime(end_date.year, end_date.month, end_date.day, 0) - timedelta(hours=tz_shift)
+        table = self._query('orders', """
+            SELECT o.*, u.unit_name FROM orders o
+            JOIN units u ON u.id = o.db_unit_id
+            WHERE o.db_unit_id = %s
+                AND o.date >= %s
+                AND o.date < %s;
+        """, (db_unit_id, start_date_full, (end_date_full + timedelta(days=1))))
+
+        df = pd.DataFrame(table, columns = [
+            'id', 'db_unit_id', 'Дата', '№ заказа', 'Тип заказа', 'Номер телефона', 'Сумма заказа',
+            'Статус заказа', 'Отдел'])
+        df = apply_dtypes(df, {'Сумма заказа': 'int32', 'Отдел': 'category'})
+
+        if len(df) == 0:
+            # dodois загружает весь стек выгрузки (bs4, aiohttp), поэтому run_tasker импортирует его только здесь
+            from dodois import DodoEmptyExcelError
+            raise DodoEmptyExcelError(f'Выгружен пустой файл Excel для пиццерии {shop_name}. Возможно,'
+                                      f' на сервере нет заказов от этой пиццерии.')
+        else:
+            # восстановление полей таблицы
+            df['Подразделение'] = df['Отдел'].astype(object).str.extract(r'(.+)(?=-)')[0].astype('category')
+            df['Дата'] = df['Дата'].dt.tz_convert(config.TIMEZONES[tz_shift]).dt.tz_localize(None)
+            df['Время'] = df['Дата']
+            df['Номер телефона'] = format_phones(df['Номер телефона'])
+            df['Время продажи (печати чека)'] = 0
+            df['Тип заказа'] = df['Тип заказа'].replace(
+                to_replace={0: 'Доставка', 1: 'Самовывоз', 2: 'Ресторан'}).astype('category')
+            df['Имя клиента'] = '**********'
+            df['Способ оплаты'] = 0
+            df['Статус заказа'] = df['Статус заказа'].replace(
+                to_replace={0: 'Доставка', 1: 'Отказ', 2: 'Просрочен', 3: 'Упакован',
+                            4: 'В работе', 5: 'Принят', 6: 'Выполнен'}).astype('category')
+            df['Оператор заказа'] = 0
+            df['Курьер'] = 0
+            df['Причина просрочки'] = 0
+            df['Адрес'] = '**********'
+            df['id заказа'] = 0
+            df['id транзакции'] = 0
+
+            df = df[['Подразделение', 'Отдел', 'Дата', 'Время', 'Время продажи (печати чека)', '№ заказа', 'Тип заказа',
+                     'Имя клиента', 'Номер телефона', 'Сумма заказа', 'Способ оплаты', 'Статус заказа',
+                     'Оператор заказа', 'Курьер', 'Причина просрочки', 'Адрес', 'id заказа', 'id транзакции']]
+
+            filename = f'Заказы_{customer_id}_{shop_name}_({start_date:%Y-%m-%d} - {end_date:%Y-%m-%d}).xlsx'
+            self._upload_report(df, filename, YANDEX_ORDERS_FOLDER, customer_id)
+            print(f'orders for {shop_name} queued for upload.' if self._pipeline is not None
+                  else f'orders for {shop_name} uploaded successfully!')
@@ -0,0 +1,141 @@
+"""
+Модуль для распределенной выгрузки пиццерий несколькими воркерами (режим WORK_QUEUE).
+Очередь хранится в таблице auth: воркер арендует пачку устаревших пиццерий (SELECT ... FOR UPDATE SKIP LOCKED),
+записывая себя в lease_owner и срок аренды в lease_until, продлевает аренду, пока работает, и освобождает
+пиццерии после выгрузки. Если воркер упал, аренда истекает и пиццерии забирают другие воркеры.
+Координатор не нужен: несколько run_parser на разных машинах или в разных процессах делят пиццерии между собой.
+"""
+
+import os
+import socket
+import threading
+from typing import List, Tuple
+
+import config
+from ledger import EXPECTED_SECONDS_JOIN
+from parameters import ParametersGetter
+from parser import DatabaseWorker
+from postgresql import Database
+
+
+class UnitWorkQueue(DatabaseWorker):
+    """
+    Очередь пиццерий для выгрузки поверх таблиц auth и units.
+    """
+    def __init__(self, db: Database = None, worker_id: str = None):
+        """
+        :param db: открытое соединение с БД (см. DatabaseWorker)
+        :param worker_id: имя воркера, по умолчанию config.WORKER_ID или "хост:pid"
+        """
+        super().__init__(db)
+        self._worker_id = (worker_id or config.WORKER_ID or f'{socket.gethostname()}:{os.getpid()}')[:64]
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    @property
+    def worker_id(self) -> str:
+        return self._worker_id
+
+    def claim(self, limit: int = None) -> List[Tuple]:
+        """
+        Арендует пачку пиццерий, которые не обновлялись сегодня и не арендованы другими воркерами
+        (или аренда которых истекла). Сначала берутся самые долгие пиццерии по журналу запусков.
+        Изменения сразу фиксируются, чтобы аренду видели другие воркеры.
+        :param limit: размер пачки, по умолчанию config.WORK_QUEUE_BATCH
+        :return: параметры для парсера, как ParametersGetter.get_parsing_params
+        """
+        self._db.execute(f"""
+            WITH candidates AS (
+                SELECT a.id
+                FROM auth a
+                JOIN units u ON u.id = a.db_unit_id
+                {EXPECTED_SECONDS_JOIN}
+                WHERE a.is_active = true
+                    AND (a.last_update IS NULL OR
+                         a.last_update < date_trunc('day', now() AT TIME ZONE 'UTC'))
+                    AND (a.lease_until IS NULL OR a.lease_until < now())
+                ORDER BY expected.seconds DESC NULLS FIRST, a.id
+                LIMIT %s
+                FOR UPDATE OF a SKIP LOCKED
+            )
+            UPDATE auth
+            SET lease_owner = %s, lease_until = now() + interval '1 second' * %s
+            FROM candidates
+            WHERE auth.id = candidates.id
+            RETURNING auth.db_unit_id;
+        """, (config.LEDGER_HISTORY_RUNS, limit or config.WORK_QUEUE_BATCH, self._worker_id,
+              config.WORK_QUEUE_LEASE_TTL))
+        db_unit_ids = [row[0] for row in self._db.fetch()]
+        self._db.commit()
+        if not db_unit_ids:
+            return []
+        return ParametersGetter(db=self._db).get_parsing_params(db_unit_ids)
+
+    def complete(self, db_unit_id: int):
+        """
+        Снимает аренду с выгруженной пиццерии. Пиццерия считается выгруженной по auth.last_update,
+        которое обновляет DodoISStorer.
+        :param db_unit_id: id пиццерии (units.id)
+        :return: None
+        """
+        self._db.execute("""
+            UPDATE auth
+            SET lease_owner = NULL, lease_until = NULL
+            WHERE db_unit_id = %s AND lease_owner = %s;
+        """, (db_unit_id, self._worker_id))
+
+    def release(self, db_unit_id: int, retry_after: int = 0):
+        """
+        Возвращает пиццерию в очередь. Если задан retry_after, другие воркеры смогут взять ее только
+        через retry_after секунд (чтобы пиццерия с ошибкой не выгружалась по кругу).
+        :param db_unit_id: id пиццерии (units.id)
+        :param retry_after: задержка в секундах
+        :return: None
+        """
+        self._db.execute("""
+            UPDATE auth
+            SET lease_owner = NULL,
+                lease_until = CASE WHEN %s > 0 THEN now() + interval '1 second' * %s END
+            WHERE db_unit_id = %s AND lease_owner = %s;
+        """, (retry_after, retry_after, db_unit_id, self._worker_id))
+
+    def _heartbeat(self):
+        # отдельное соединение: основное соединение используется в другом потоке
+        db = Database()
+        db.connect(init_schema=False)
+        try:
+            while not self._heartbeat_stop.wait(config.WORK_QUEUE_HEARTBEAT):
+                db.execute("""
+                    UPDATE auth
+                    SET lease_until = now() + interval '1 second' * %s
+                    WHERE lease_owner = %s;
+                """, (config.WORK_QUEUE_LEASE_TTL, self._worker_id))
+                db.commit()
+        finally:
+            db.close()
+
+    def start_heartbeat(self):
+        """
+        Запускает фоновый поток, который раз в WORK_QUEUE_HEARTBEAT секунд продлевает аренду пиццерий воркера.
+        :return: None
+        """
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='work_queue_heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """
+        Останавливает продление аренды.
+        :return: None
+        """
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def __enter__(self):
+        self.start_heartbeat()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_heartbeat()